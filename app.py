@@ -9,6 +9,7 @@
 # not expressly granted therein are reserved by Shotgun Software Inc.
 
 
+import sgtk
 from sgtk.platform import Application
 
 class StgkStarterApp(Application):
@@ -38,4 +39,63 @@ class StgkStarterApp(Application):
 
         # now register the command with the engine
         self.engine.register_command("Show Starter Template App...", menu_callback)
+
+        # the headless ingest runs without any UI, so that deliveries can be
+        # ingested from a shell or on the farm. Engines with a UI would show it
+        # as a menu entry doing nothing when clicked, so it is left out there;
+        # the ingest method remains available to scripts.
+        if not self.engine.has_ui:
+            self.engine.register_command(
+                "ingest_delivery",
+                self._ingest_command,
+                {"short_name": "ingest_delivery",
+                 "description": "Ingests a delivery without UI. "
+                                "Arguments: DELIVERY_PATH [--rules FILE] [--shard I/N]"}
+            )
+
+    def ingest(self, delivery_path, rules_path=None, shard_index=0, shard_count=1, stream=None):
+        """
+        Scans, verifies, copies and registers a delivery without any UI.
+
+        :param delivery_path: Delivery folder to ingest.
+        :param rules_path: Optional JSON or YAML rule file.
+        :param shard_index: Zero based shard of the delivery to process.
+        :param shard_count: Number of shards the delivery is split into. Every
+                            item is processed by exactly one shard.
+        :param stream: Stream progress is written to as line delimited JSON.
+                       Defaults to stdout.
+        :returns: Summary dictionary of the ingest.
+        """
+        app_payload = self.import_module("app")
+        return app_payload.pipeline.run_ingest(
+            self, delivery_path, rules_path, shard_index, shard_count, stream
+        )
+
+    def _ingest_command(self, *args):
+        """
+        Callback of the ingest_delivery command, parsing command line style arguments.
+        """
+        import argparse
+
+        parser = argparse.ArgumentParser(prog="ingest_delivery")
+        parser.add_argument("delivery_path", help="Delivery folder to ingest.")
+        parser.add_argument("--rules", help="JSON or YAML rule file.")
+        parser.add_argument(
+            "--shard", default="1/1",
+            help="Shard to process, as I/N with I from 1 to N, for splitting a delivery over N machines."
+        )
+        try:
+            options = parser.parse_args(list(args))
+        except SystemExit:
+            # usage or help has been printed by argparse already
+            return None
+
+        try:
+            index, count = [int(value) for value in options.shard.split("/")]
+        except ValueError:
+            index, count = 0, 0
+        if not 1 <= index <= count:
+            raise sgtk.TankError("Invalid shard '%s', expected I/N with I from 1 to N." % options.shard)
+
+        return self.ingest(options.delivery_path, options.rules, index - 1, count)
         
@@ -0,0 +1,111 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Measures how long importing the app module takes.
+
+The app module is imported every time an engine starts up, in every DCC session,
+whether or not the ingest is used, so it must stay cheap. Every measurement runs
+in a fresh interpreter. Exits with status 1 if the median import time exceeds
+the budget, or if any module that should only be loaded on demand was imported.
+
+Usage: python benchmarks/import_time.py [--budget-ms 50] [--runs 5]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+PYTHON_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "python")
+
+# modules that must not be loaded by merely importing the app module
+DEFERRED_MODULES = (
+    "app.dialog",
+    "app.ui",
+    "app.ui.dialog",
+    "app.ui.resources_rc",
+    "app.model",
+    "app.thumbnails",
+    "app.pipeline",
+    "app.scanner",
+    "app.scan_index",
+    "app.verify",
+    "app.copier",
+    "app.registration",
+    "app.mock_shotgun",
+    "app.stats",
+    "app.benchmark",
+    "sgtk.platform.qt",
+    "PySide",
+    "PySide2",
+    "PyQt4",
+    "PyQt5",
+    "sqlite3",
+    "concurrent.futures",
+    "multiprocessing",
+)
+
+_CHILD = """
+import json, sys, time
+sys.path.insert(0, %(folder)r)
+start = time.perf_counter()
+import app
+elapsed = time.perf_counter() - start
+loaded = [name for name in %(deferred)r if name in sys.modules]
+print(json.dumps({"seconds": elapsed, "loaded": loaded}))
+"""
+
+
+def measure(python=sys.executable):
+    """
+    Imports the app module in a fresh interpreter.
+
+    :returns: Tuple of (seconds, list of deferred modules that were loaded).
+    """
+    code = _CHILD % {"folder": PYTHON_FOLDER, "deferred": DEFERRED_MODULES}
+    output = subprocess.check_output([python, "-c", code], cwd=PYTHON_FOLDER)
+    result = json.loads(output.decode("utf-8").strip().splitlines()[-1])
+    return result["seconds"], result["loaded"]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--budget-ms", type=float, default=50.0,
+                        help="Maximum median import time in milliseconds.")
+    parser.add_argument("--runs", type=int, default=5, help="Number of fresh interpreters to measure.")
+    options = parser.parse_args(argv)
+
+    timings = []
+    loaded = set()
+    for _ in range(max(1, options.runs)):
+        seconds, modules = measure()
+        timings.append(seconds * 1000.0)
+        loaded.update(modules)
+    timings.sort()
+    median = timings[len(timings) // 2]
+
+    print("import app: median %.2f ms, min %.2f ms, max %.2f ms over %d runs (budget %.2f ms)" % (
+        median, timings[0], timings[-1], len(timings), options.budget_ms
+    ))
+
+    failed = False
+    if median > options.budget_ms:
+        print("FAIL: import time exceeds the budget")
+        failed = True
+    if loaded:
+        print("FAIL: modules loaded at import time: %s" % ", ".join(sorted(loaded)))
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,144 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Runs the ingest pipeline on a synthetic delivery against a mock Shotgun.
+
+Prints the stats of a cold and a warm run. With --output, the results are
+saved as JSON; with --baseline, they are compared against a previously saved
+run and the script exits with status 1 if any stage got slower, or made more
+Shotgun calls per item, by more than the tolerance. Stages finishing within
+--min-duration seconds are not timed reliably, and their rates not compared.
+The script also exits with status 1 if the warm run's scan did not take every
+folder listing from the scan index.
+
+Usage: python benchmarks/pipeline.py [--scale small|medium|large] [--latency 0.05]
+                                     [--output results.json] [--baseline results.json]
+"""
+
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "python"))
+
+from app import benchmark  # noqa: E402
+from app.stats import PipelineStats, format_size  # noqa: E402
+
+# stage metrics compared against the baseline, and whether higher values are better
+COMPARED_METRICS = (
+    ("files_per_second", True),
+    ("bytes_per_second", True),
+)
+
+# stages taking less time than this, in either run, are too short for their
+# rates to be more than noise, and are not compared
+MIN_STAGE_SECONDS = 0.5
+
+
+def compare(results, baseline, tolerance, min_duration=MIN_STAGE_SECONDS):
+    """
+    Returns a list of messages describing regressions against a baseline.
+    """
+    regressions = []
+    for run in ("cold", "warm"):
+        current = dict((s["stage"], s) for s in results[run]["stats"]["stages"])
+        previous = dict((s["stage"], s) for s in baseline[run]["stats"]["stages"])
+        for name, stage in current.items():
+            if min(stage["elapsed"], previous.get(name, {}).get("elapsed", 0)) < min_duration:
+                continue
+            for metric, higher_is_better in COMPARED_METRICS:
+                old = previous.get(name, {}).get(metric)
+                new = stage.get(metric)
+                if not old or new is None:
+                    continue
+                change = (new - old) / old
+                if (change < -tolerance) if higher_is_better else (change > tolerance):
+                    regressions.append("%s %s %s: %.1f -> %.1f (%+.0f%%)" % (
+                        run, name, metric, old, new, change * 100
+                    ))
+        old = baseline[run]["stats"].get("shotgun_calls_per_item")
+        new = results[run]["stats"].get("shotgun_calls_per_item")
+        if old and new is not None and (new - old) / old > tolerance:
+            regressions.append("%s shotgun_calls_per_item: %.3f -> %.3f" % (run, old, new))
+    return regressions
+
+
+def check_warm_scan(results):
+    """
+    Returns a list of messages if the warm run's scan did not reuse the listing
+    of every folder from the scan index, which the cold run should have filled.
+    """
+    scan = dict((s["stage"], s) for s in results["warm"]["stats"]["stages"]).get("scan")
+    if scan is None:
+        return ["warm run has no scan stage"]
+    hit_rate = scan.get("cache_hit_rate")
+    if hit_rate is None or hit_rate < 1.0:
+        return ["warm scan cache_hit_rate: %s, expected 100%%" % (
+            "n/a" if hit_rate is None else "%.0f%%" % (hit_rate * 100)
+        )]
+    return []
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scale", choices=sorted(benchmark.SCALES), default="small",
+                        help="Size of the generated delivery.")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Seconds every mock Shotgun call takes.")
+    parser.add_argument("--work-folder", help="Folder to generate the delivery in. Defaults to a temporary folder.")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated files.")
+    parser.add_argument("--output", help="Save the results to this JSON file.")
+    parser.add_argument("--baseline", help="Compare against results saved with --output.")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed relative slowdown before a metric counts as regressed.")
+    parser.add_argument("--min-duration", type=float, default=MIN_STAGE_SECONDS,
+                        help="Seconds a stage must take, in both runs, for its rates to be compared.")
+    options = parser.parse_args(argv)
+
+    results = benchmark.run_benchmark(
+        options.scale, work_folder=options.work_folder, latency=options.latency, keep=options.keep
+    )
+
+    delivery = results["delivery"]
+    print("Delivery: %d folders, %d files, %s" % (
+        delivery["folders"], delivery["files"], format_size(delivery["bytes"])
+    ))
+    for run in ("cold", "warm"):
+        summary = results[run]
+        print("%s run: %d items ingested, Shotgun calls %s" % (
+            run, summary["ingested"], summary["shotgun_calls"]
+        ))
+        for line in PipelineStats().format_lines(summary["stats"]):
+            print("    %s" % line)
+
+    if options.output:
+        with open(options.output, "w") as fh:
+            json.dump(results, fh, indent=2, sort_keys=True, default=str)
+
+    status = 0
+    for message in check_warm_scan(results):
+        print("FAILURE: %s" % message)
+        status = 1
+
+    if options.baseline:
+        with open(options.baseline, "r") as fh:
+            baseline = json.load(fh)
+        regressions = compare(results, baseline, options.tolerance, options.min_duration)
+        for message in regressions:
+            print("REGRESSION: %s" % message)
+        if regressions:
+            status = 1
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,4 +8,26 @@
 # agreement to the Shotgun Pipeline Toolkit Source Code License. All rights 
 # not expressly granted therein are reserved by Shotgun Software Inc.
 
-from . import dialog
+"""
+The app's modules are loaded on first access rather than on import. The app
+package is imported whenever an engine starts up, but the dialog pulls in Qt,
+the generated UI and the compiled resources, and the pipeline pulls in process
+pools and SQLite; none of it is needed until the ingest is actually used.
+"""
+
+import importlib
+
+# submodules available as attributes of this package, loaded on first access
+_LAZY_MODULES = ("dialog", "pipeline")
+
+
+def __getattr__(name):
+    if name in _LAZY_MODULES:
+        module = importlib.import_module("%s.%s" % (__name__, name))
+        globals()[name] = module
+        return module
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_MODULES))
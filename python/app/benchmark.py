@@ -0,0 +1,196 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Offline benchmark harness for the ingest pipeline.
+
+Generates a synthetic delivery in a temporary folder and runs the headless
+pipeline on it, copying into a scratch destination and registering against
+a MockShotgun. Neither toolkit, Qt nor a Shotgun site are required.
+
+The pipeline is run twice on the same delivery: a cold run, where nothing is
+cached and every file is copied, and a warm run, which exercises the scan
+index and the copy journal the way re-running an ingest does, and finds all
+items registered already.
+"""
+
+import hashlib
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from .mock_shotgun import MockShotgun
+from .pipeline import IngestPipeline, load_rules
+from .stats import PipelineStats
+
+# delivery layouts. Leaf folders sit depth levels deep, with branching
+# subfolders per level, and each hold sequences of frames plus a few stills
+# of mixed sizes. Every delivery also holds one or more large files.
+SCALES = {
+    "small": {
+        "depth": 3, "branching": 2,
+        "sequences": 2, "frames": 50, "frame_size": 32 * 1024,
+        "stills": 4, "still_sizes": (1024, 256 * 1024),
+        "large_files": 1, "large_size": 16 * 1024 * 1024,
+    },
+    "medium": {
+        "depth": 4, "branching": 3,
+        "sequences": 3, "frames": 100, "frame_size": 16 * 1024,
+        "stills": 8, "still_sizes": (1024, 1024 * 1024),
+        "large_files": 2, "large_size": 64 * 1024 * 1024,
+    },
+    "large": {
+        "depth": 5, "branching": 3,
+        "sequences": 4, "frames": 200, "frame_size": 4 * 1024,
+        "stills": 8, "still_sizes": (1024, 1024 * 1024),
+        "large_files": 4, "large_size": 256 * 1024 * 1024,
+    },
+}
+
+
+class MirrorResolver(object):
+    """
+    Destination resolver placing every file at the same relative path below
+    a destination folder.
+    """
+
+    def __init__(self, source_root, destination_root):
+        self._source_root = source_root
+        self._destination_root = destination_root
+
+    def __call__(self, item):
+        return [(path, self._destination(path)) for path in item.files()]
+
+    def destination_path(self, item):
+        """
+        Returns the destination of an item, with the frame token for sequences.
+        """
+        return self._destination(item.path)
+
+    def _destination(self, path):
+        return os.path.join(self._destination_root, os.path.relpath(path, self._source_root))
+
+
+def generate_delivery(root, scale="small", seed=0):
+    """
+    Writes a synthetic delivery, along with an md5 manifest covering all of its files.
+    The modification times of its folders are set an hour back.
+
+    :param root: Folder to create the delivery in.
+    :param scale: One of the keys of SCALES, or a dictionary with the same keys.
+    :param seed: Seed for file sizes and contents, so that deliveries are reproducible.
+    :returns: Dictionary with the number of folders, files and bytes written.
+    """
+    layout = SCALES[scale] if isinstance(scale, str) else scale
+    rng = random.Random(seed)
+    # a block of random data that file contents are cut from, prefixed with the
+    # file's path so that no two files are identical
+    block = rng.getrandbits(8 * 1024 * 1024).to_bytes(1024 * 1024, "little")
+
+    checksums = []
+    folders = []
+    counts = {"folders": 0, "files": 0, "bytes": 0}
+
+    def write(path, size):
+        hasher = hashlib.md5()
+        with open(path, "wb") as fh:
+            header = path.encode("utf-8")[:size]
+            fh.write(header)
+            hasher.update(header)
+            remaining = size - len(header)
+            offset = rng.randrange(len(block))
+            while remaining > 0:
+                chunk = block[offset:offset + remaining]
+                fh.write(chunk)
+                hasher.update(chunk)
+                remaining -= len(chunk)
+                offset = 0
+        checksums.append((hasher.hexdigest(), os.path.relpath(path, root)))
+        counts["files"] += 1
+        counts["bytes"] += size
+
+    def populate(folder, level):
+        os.makedirs(folder)
+        folders.append(folder)
+        counts["folders"] += 1
+        if level < layout["depth"]:
+            for idx in range(layout["branching"]):
+                populate(os.path.join(folder, "dir%02d" % idx), level + 1)
+            return
+        for seq in range(layout["sequences"]):
+            for frame in range(1001, 1001 + layout["frames"]):
+                write(os.path.join(folder, "plate%02d_v001.%04d.exr" % (seq, frame)), layout["frame_size"])
+        low, high = layout["still_sizes"]
+        for idx in range(layout["stills"]):
+            write(os.path.join(folder, "still%02d_v001.jpg" % idx), rng.randint(low, high))
+
+    populate(root, 0)
+    for idx in range(layout["large_files"]):
+        write(os.path.join(root, "reference%02d_v001.mov" % idx), layout["large_size"])
+
+    with open(os.path.join(root, "checksums.md5"), "w") as fh:
+        for digest, name in checksums:
+            fh.write("%s  %s\n" % (digest, name.replace(os.sep, "/")))
+
+    # date the folders back, as if the delivery had been copied in a while ago.
+    # Listings of folders modified within the scan index's racy window are not
+    # cached, which would leave nothing for a scan right after this one to reuse.
+    modified = time.time() - 3600
+    for folder in folders:
+        os.utime(folder, (modified, modified))
+    return counts
+
+
+def run_benchmark(scale="small", work_folder=None, latency=0.0, rules=None, keep=False, reporter=None):
+    """
+    Generates a delivery and runs the ingest pipeline on it, cold and warm.
+
+    :param scale: One of the keys of SCALES, or a dictionary with the same keys.
+    :param work_folder: Folder to generate the delivery, destination and caches
+                        in. Defaults to a new temporary folder.
+    :param latency: Seconds every MockShotgun call takes.
+    :param rules: Rules dictionary. Defaults to the default rules.
+    :param keep: Keep the temporary work folder rather than deleting it afterwards.
+                 A work folder passed in is never deleted.
+    :param reporter: Optional callable receiving the pipeline events.
+    :returns: Dictionary with the generated delivery's counts and, for both the
+              "cold" and the "warm" run, the pipeline summary.
+    """
+    created = work_folder is None
+    if created:
+        work_folder = tempfile.mkdtemp(prefix="ingest-benchmark-")
+    delivery = os.path.join(work_folder, "delivery")
+    destination = os.path.join(work_folder, "destination")
+    cache_location = os.path.join(work_folder, "cache")
+    try:
+        result = {"scale": scale, "delivery": generate_delivery(delivery, scale)}
+        shotgun = MockShotgun(latency)
+        rules = rules or load_rules()
+        for run in ("cold", "warm"):
+            shotgun.reset_counters()
+            pipeline = IngestPipeline(
+                delivery,
+                rules,
+                resolver=MirrorResolver(delivery, destination),
+                shotgun=shotgun,
+                context_fields={"project": {"type": "Project", "id": 1}},
+                cache_location=cache_location,
+                reporter=reporter,
+                stats=PipelineStats(),
+            )
+            summary = pipeline.run()
+            summary["shotgun_calls"] = dict(shotgun.calls)
+            result[run] = summary
+        return result
+    finally:
+        if created and not keep:
+            shutil.rmtree(work_folder, ignore_errors=True)
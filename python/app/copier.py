@@ -0,0 +1,732 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Bulk copy of scanned ingest items into the project tree.
+
+Files are copied by a pool of threads using the kernel's copy_file_range or
+sendfile where available. Every finished file is recorded in a journal, so an
+interrupted ingest can be resumed without copying finished files again, and
+the total throughput can be capped so that ingest does not saturate the file
+server.
+"""
+
+import errno
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from concurrent import futures
+
+# item outcomes reported by the copy engine
+STATUS_COPIED = "copied"
+STATUS_SKIPPED = "skipped"
+STATUS_ERROR = "error"
+
+# splits "shot_v001." into a name and a version number. The version must be
+# separated from the name, so that names such as "cut_rev3" are left whole.
+VERSION_REGEX = re.compile(r"^(?P<name>.+?)[._-]v(?P<version>\d+)[._-]?$", re.IGNORECASE)
+
+# errors after which the next, less optimized copy method is tried
+_FALLBACK_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF)
+
+
+class CopyCancelled(Exception):
+    """
+    Raised inside a copy when the engine has been cancelled.
+    """
+
+
+class TemplateDestinationResolver(object):
+    """
+    Computes destination paths for scan items from a toolkit template.
+
+    Fields are taken from the context the resolver was created with, plus the
+    following fields derived from the scanned file name:
+
+    - name: File name without frame number, version and extension.
+    - version: Version number, if the file name contains one (shot_v003.1001.exr).
+    - extension: File extension without the dot.
+    - SEQ: Frame number, for sequences.
+
+    Only fields known to the template are applied.
+    """
+
+    def __init__(self, template, context_fields=None):
+        """
+        Constructor
+
+        :param template: Template object to resolve paths with.
+        :param context_fields: Template fields of the current context, typically
+                               obtained via context.as_template_fields(template).
+        """
+        self._template = template
+        self._context_fields = dict(context_fields or {})
+
+    def fields_for_item(self, item):
+        """
+        Returns the template fields for an item, excluding the frame number.
+        """
+        fields = dict(self._context_fields)
+
+        if item.is_sequence:
+            base, extension = item.head, item.tail
+        else:
+            base, extension = os.path.splitext(item.head)
+        base = base.rstrip("._-")
+        fields["extension"] = extension.lstrip(".")
+
+        match = VERSION_REGEX.match(base)
+        if match:
+            fields["name"] = match.group("name")
+            fields["version"] = int(match.group("version"))
+        else:
+            fields["name"] = base
+
+        return dict((key, value) for key, value in fields.items() if key in self._template.keys)
+
+    def destination_path(self, item):
+        """
+        Returns the destination path of an item. For sequences, the frame number
+        is represented by a %0Nd token, as defined by the template's SEQ key.
+
+        :raises ValueError: If the template cannot be resolved for this item.
+        """
+        fields = self.fields_for_item(item)
+        if item.is_sequence:
+            fields["SEQ"] = "FORMAT: %d"
+        self._check_fields(item, fields)
+        return self._template.apply_fields(fields)
+
+    def __call__(self, item):
+        """
+        Returns a list of (source, destination) tuples for every file of an item.
+
+        :raises ValueError: If the template cannot be resolved for this item.
+        """
+        fields = self.fields_for_item(item)
+        if item.is_sequence:
+            fields["SEQ"] = item.frames[0]
+        self._check_fields(item, fields)
+
+        if not item.is_sequence:
+            return [(item.path, self._template.apply_fields(fields))]
+
+        pairs = []
+        for frame in item.frames:
+            fields["SEQ"] = frame
+            pairs.append((item.frame_path(frame), self._template.apply_fields(fields)))
+        return pairs
+
+    def _check_fields(self, item, fields):
+        """
+        Raises a ValueError if fields are missing to resolve the template for an item.
+        """
+        missing = self._template.missing_keys(fields)
+        if missing:
+            raise ValueError(
+                "Cannot resolve template %s for %s, missing fields: %s" % (
+                    self._template, item.name, ", ".join(missing)
+                )
+            )
+
+
+class BandwidthLimiter(object):
+    """
+    Token bucket shared by all copy threads to cap the total transfer rate.
+    """
+
+    def __init__(self, bytes_per_second, burst_seconds=1.0):
+        """
+        Constructor
+
+        :param bytes_per_second: Maximum average rate. Zero or None disables the limit.
+        :param burst_seconds: Number of seconds worth of transfer that may be
+                              spent at once after a period of inactivity.
+        """
+        self._rate = bytes_per_second or 0
+        self._capacity = self._rate * burst_seconds
+        self._tokens = self._capacity
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, num_bytes):
+        """
+        Blocks until num_bytes may be transferred.
+        """
+        if not self._rate:
+            return
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self._capacity, self._tokens + (now - self._last) * self._rate)
+            self._last = now
+            # tokens may go negative; the caller then sleeps off the debt. Taking
+            # the tokens while holding the lock keeps concurrent callers fair.
+            self._tokens -= num_bytes
+            delay = -self._tokens / self._rate if self._tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+class CopyJournal(object):
+    """
+    Append-only record of finished copies, stored as one JSON object per line.
+    """
+
+    # number of records after which the journal is synced to disk
+    SYNC_INTERVAL = 100
+
+    def __init__(self, path):
+        """
+        Constructor. Existing records are loaded from the journal file.
+
+        :param path: Path to the journal file. Missing parent folders are created.
+        """
+        self._path = path
+        self._lock = threading.Lock()
+        self._records = {}
+        self._unsynced = 0
+
+        if os.path.exists(path):
+            with open(path, "rb+") as fh:
+                # offset just past the last complete line
+                end = 0
+                for line in fh:
+                    if not line.endswith(b"\n"):
+                        # a torn last line from an interrupted run. It is cut
+                        # off, as the next record would be appended to it.
+                        fh.truncate(end)
+                        break
+                    end += len(line)
+                    try:
+                        record = json.loads(line.decode("utf-8"))
+                    except ValueError:
+                        continue
+                    self._records[record["dst"]] = record
+
+        folder = os.path.dirname(path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        self._fh = open(path, "a")
+
+    @property
+    def path(self):
+        """
+        Path to the journal file.
+        """
+        return self._path
+
+    def __len__(self):
+        return len(self._records)
+
+    def is_done(self, src, dst, src_stat):
+        """
+        True if a previous run already copied src to dst and neither has changed since.
+        """
+        record = self._records.get(dst)
+        if record is None or record["src"] != src:
+            return False
+        if record["size"] != src_stat.st_size or record["mtime"] != src_stat.st_mtime:
+            return False
+        try:
+            return os.path.getsize(dst) == record["size"]
+        except OSError:
+            return False
+
+    def record(self, src, dst, src_stat):
+        """
+        Records a finished copy.
+        """
+        record = {"src": src, "dst": dst, "size": src_stat.st_size, "mtime": src_stat.st_mtime}
+        with self._lock:
+            self._records[dst] = record
+            self._fh.write(json.dumps(record) + "\n")
+            self._unsynced += 1
+            if self._unsynced >= self.SYNC_INTERVAL:
+                self._sync()
+
+    def close(self):
+        """
+        Syncs and closes the journal file.
+        """
+        with self._lock:
+            if not self._fh.closed:
+                self._sync()
+                self._fh.close()
+
+    def _sync(self):
+        """
+        Flushes buffered records to disk. Must be called with the lock held.
+        """
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+        self._unsynced = 0
+
+
+def _copy_range(src_fd, dst_fd, size, chunk_size, after_chunk):
+    """
+    Copies using copy_file_range, which lets the kernel or a network file
+    system copy server side without passing the data through user space.
+    """
+    offset = 0
+    while offset < size:
+        copied = os.copy_file_range(src_fd, dst_fd, min(chunk_size, size - offset))
+        if not copied:
+            break
+        offset += copied
+        after_chunk(copied)
+    return offset
+
+
+def _copy_sendfile(src_fd, dst_fd, size, chunk_size, after_chunk):
+    """
+    Copies using sendfile, which avoids copying the data through user space.
+    """
+    offset = 0
+    while offset < size:
+        copied = os.sendfile(dst_fd, src_fd, offset, min(chunk_size, size - offset))
+        if not copied:
+            break
+        offset += copied
+        after_chunk(copied)
+    return offset
+
+
+def _copy_buffered(src_fd, dst_fd, size, chunk_size, after_chunk):
+    """
+    Copies through a large, reused user space buffer.
+    """
+    buf = bytearray(max(1, min(chunk_size, size)))
+    view = memoryview(buf)
+    offset = 0
+    with os.fdopen(os.dup(src_fd), "rb", buffering=0) as src_fh:
+        while True:
+            count = src_fh.readinto(view)
+            if not count:
+                break
+            written = 0
+            while written < count:
+                written += os.write(dst_fd, view[written:count])
+            offset += count
+            after_chunk(count)
+    return offset
+
+
+def copy_file(src, dst, chunk_size=16 * 1024 * 1024, chunk_callback=None):
+    """
+    Copies a single file, preserving its modification time.
+
+    The data is written to a temporary file next to the destination, which is
+    renamed into place once complete. The fastest available copy method is used:
+    copy_file_range, then sendfile, then a buffered copy. A method which fails
+    or stops short of the end of the file is replaced by the next one, and the
+    copy fails if the buffered copy does not copy exactly the size of the source.
+
+    :param src: Source file path.
+    :param dst: Destination file path. Missing parent folders are created.
+    :param chunk_size: Number of bytes copied per system call.
+    :param chunk_callback: Optional callable invoked with zero before the copy
+                           starts and with the number of bytes actually copied
+                           after every chunk. If a copy method fails part way
+                           and the copy starts over with the next method, it is
+                           invoked with the negated number of bytes discarded.
+                           It may block to throttle the copy or raise
+                           CopyCancelled to abort it.
+    :returns: Number of bytes copied.
+    """
+    chunk_callback = chunk_callback or (lambda count: None)
+    # bytes copied by the current method, given back if it fails
+    method_bytes = [0]
+
+    def after_chunk(count):
+        method_bytes[0] += count
+        chunk_callback(count)
+
+    chunk_callback(0)
+    folder = os.path.dirname(dst)
+    if folder and not os.path.isdir(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            # another copy thread may have created it in the meantime
+            if not os.path.isdir(folder):
+                raise
+
+    tmp_path = dst + ".part"
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        size = os.fstat(src_fd).st_size
+        dst_fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            methods = []
+            if hasattr(os, "copy_file_range"):
+                methods.append(_copy_range)
+            if hasattr(os, "sendfile"):
+                methods.append(_copy_sendfile)
+            methods.append(_copy_buffered)
+
+            for method in methods:
+                method_bytes[0] = 0
+                try:
+                    copied = method(src_fd, dst_fd, size, chunk_size, after_chunk)
+                except OSError as e:
+                    if e.errno not in _FALLBACK_ERRNOS or method is _copy_buffered:
+                        raise
+                    # the file system does not support this method, start over
+                    # with the next one.
+                else:
+                    if copied == size:
+                        break
+                    if method is _copy_buffered:
+                        # the buffered copy reads until the end of the file: the
+                        # source changed size while it was being copied.
+                        raise IOError(
+                            errno.EIO, "Copied %d bytes out of %d, the source changed during the copy" % (
+                                copied, size
+                            ), src,
+                        )
+                    # the method stopped short of the end of the file, start
+                    # over with the next one.
+                if method_bytes[0]:
+                    chunk_callback(-method_bytes[0])
+                os.lseek(src_fd, 0, os.SEEK_SET)
+                os.lseek(dst_fd, 0, os.SEEK_SET)
+                os.ftruncate(dst_fd, 0)
+        finally:
+            os.close(dst_fd)
+        shutil.copystat(src, tmp_path)
+        os.replace(tmp_path, dst)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    finally:
+        os.close(src_fd)
+    return copied
+
+
+def _item_status(statuses):
+    """
+    Folds the statuses of the files of an item into a status for the item.
+    """
+    if STATUS_ERROR in statuses:
+        return STATUS_ERROR
+    if STATUS_COPIED in statuses:
+        return STATUS_COPIED
+    return STATUS_SKIPPED
+
+
+class CopyEngine(object):
+    """
+    Copies the files of a list of scan items to their resolved destinations.
+
+    Files are copied by a pool of threads; the copy system calls release the
+    GIL, so threads are sufficient to keep several transfers in flight. Files
+    recorded in the journal by a previous run are skipped. Existing destination
+    files that are not in the journal are only skipped if their size and
+    modification time match the source, and are otherwise reported as errors
+    rather than overwritten. Items resolving to the same destination as another
+    item are reported as errors and not copied at all.
+
+    The engine is driven from its own background thread. All callbacks are
+    executed from that thread.
+    """
+
+    def __init__(self, items, resolver, journal=None, num_workers=4,
+                 bandwidth=0, chunk_size=16 * 1024 * 1024,
+                 item_callback=None, progress_callback=None, finished_callback=None,
+                 progress_interval=0.5):
+        """
+        Constructor
+
+        :param items: List of ScanItems to copy.
+        :param resolver: Callable returning a list of (source, destination)
+                         tuples for a ScanItem, such as a TemplateDestinationResolver.
+        :param journal: Optional CopyJournal used to skip files finished by a
+                        previous run and to record finished files. The journal
+                        is closed once the engine has finished.
+        :param num_workers: Number of files copied concurrently.
+        :param bandwidth: Maximum total transfer rate in bytes per second.
+                          Zero means unlimited.
+        :param chunk_size: Number of bytes copied per system call.
+        :param item_callback: Called with (item, status, errors) once every file
+                              of an item has been handled. Errors is a list of
+                              (path, message) tuples.
+        :param progress_callback: Called with a copy of the progress dictionary
+                                  at most every progress_interval seconds.
+        :param finished_callback: Called with the final progress dictionary.
+        :param progress_interval: Seconds between progress callbacks.
+        """
+        self._items = items
+        self._resolver = resolver
+        self._journal = journal
+        self._num_workers = max(1, num_workers)
+        self._limiter = BandwidthLimiter(bandwidth)
+        self._chunk_size = chunk_size
+        self._item_callback = item_callback
+        self._progress_callback = progress_callback
+        self._finished_callback = finished_callback
+        self._progress_interval = progress_interval
+
+        self._cancelled = threading.Event()
+        self._done = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+        self._progress = {
+            "files_total": sum(item.file_count for item in items),
+            "bytes_total": sum(item.size for item in items),
+            "files_done": 0,
+            "bytes_done": 0,
+            "bytes_copied": 0,
+            "bytes_per_second": 0.0,
+            "in_flight": 0,
+            "max_in_flight": 0,
+            "copied": 0,
+            "skipped": 0,
+            "error": 0,
+            "start_time": 0,
+            "end_time": 0,
+            "cancelled": False,
+        }
+
+    @property
+    def progress(self):
+        """
+        Copy of the current progress counters.
+        """
+        with self._lock:
+            return dict(self._progress)
+
+    def start(self):
+        """
+        Starts copying in the background and returns immediately.
+        """
+        if self._thread:
+            raise RuntimeError("A copy engine can only be started once.")
+        self._thread = threading.Thread(target=self._run, name="ingest-copy")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def run(self):
+        """
+        Copies in the calling thread and returns the final progress dictionary.
+        """
+        self._run()
+        return self.progress
+
+    def cancel(self):
+        """
+        Requests copying to stop. Files being copied are aborted and their
+        partial copies removed.
+        """
+        self._cancelled.set()
+
+    def wait(self, timeout=None):
+        """
+        Blocks until copying has finished.
+
+        :returns: True if copying finished, False if the timeout expired.
+        """
+        return self._done.wait(timeout)
+
+    def is_running(self):
+        """
+        True while copying has been started and has not yet finished.
+        """
+        return self._thread is not None and not self._done.is_set()
+
+    def _on_chunk(self, count):
+        """
+        Counts and throttles the bytes copied by every chunk, and aborts copies
+        once cancelled. Bytes discarded by a failed copy method are given back
+        to the count, but not to the bandwidth limit, as they were transferred.
+        """
+        if self._cancelled.is_set():
+            raise CopyCancelled()
+        if count > 0:
+            self._limiter.consume(count)
+        if count:
+            with self._lock:
+                self._progress["bytes_copied"] += count
+
+    def _copy_task(self, src, dst):
+        """
+        Pool entry point copying a single file.
+
+        :returns: Tuple of (status, size, error message).
+        """
+        if self._cancelled.is_set():
+            return STATUS_ERROR, 0, "Cancelled"
+        try:
+            src_stat = os.stat(src)
+            if self._journal is not None and self._journal.is_done(src, dst, src_stat):
+                return STATUS_SKIPPED, src_stat.st_size, None
+            if os.path.exists(dst):
+                dst_stat = os.stat(dst)
+                if (dst_stat.st_size, dst_stat.st_mtime) == (src_stat.st_size, src_stat.st_mtime):
+                    status = STATUS_SKIPPED
+                else:
+                    return STATUS_ERROR, 0, "Destination %s already exists" % dst
+            else:
+                copy_file(src, dst, self._chunk_size, self._on_chunk)
+                status = STATUS_COPIED
+            if self._journal is not None:
+                self._journal.record(src, dst, src_stat)
+            return status, src_stat.st_size, None
+        except CopyCancelled:
+            return STATUS_ERROR, 0, "Cancelled"
+        except Exception as e:
+            return STATUS_ERROR, 0, "%s: %s" % (e.__class__.__name__, e)
+
+    def _resolve(self):
+        """
+        Resolves the destinations of all items before anything is copied, so
+        that items resolving to the same destination are detected up front.
+        Such items would overwrite each other's files, or have the later copy
+        mistaken for a file that is already in place, so none of them is copied.
+
+        :returns: List of (item, pairs, error) tuples, where pairs is the list of
+                  (source, destination) tuples of the item, or None if the item
+                  cannot be copied, in which case error holds the reason.
+        """
+        resolved = []
+        # destination path -> index in resolved of the item resolving to it
+        owners = {}
+        clashes = {}
+        for item in self._items:
+            if self._cancelled.is_set():
+                break
+            try:
+                pairs = self._resolver(item)
+            except Exception as e:
+                resolved.append((item, None, str(e)))
+                continue
+            index = len(resolved)
+            seen = set()
+            for src, dst in pairs:
+                # a destination may also repeat within a sequence, if the
+                # template has no frame number key
+                owner = owners.setdefault(dst, index)
+                if owner != index or dst in seen:
+                    clashes.setdefault(owner, dst)
+                    clashes.setdefault(index, dst)
+                seen.add(dst)
+            resolved.append((item, pairs, None))
+
+        for index, dst in clashes.items():
+            item = resolved[index][0]
+            resolved[index] = (
+                item, None, "Destination %s is shared with another delivered file" % dst
+            )
+        return resolved
+
+    def _iter_jobs(self, resolved):
+        """
+        Yields (item, file count, src, dst) for every file of the resolved items.
+        Items that cannot be copied yield a single job with src set to None and
+        the error message as dst.
+        """
+        for item, pairs, error in resolved:
+            if pairs is None:
+                yield item, 1, None, error
+                continue
+            for src, dst in pairs:
+                yield item, len(pairs), src, dst
+
+    def _run(self):
+        """
+        Feeds all files to the thread pool and collects the results.
+        """
+        with self._lock:
+            self._progress["start_time"] = time.time()
+        last_report = 0
+        max_in_flight = self._num_workers * 2
+
+        pending = {}
+        remaining = {}
+        errors = {}
+        statuses = {}
+        jobs = self._iter_jobs(self._resolve())
+        exhausted = False
+
+        executor = futures.ThreadPoolExecutor(self._num_workers)
+        try:
+            while True:
+                while not exhausted and len(pending) < max_in_flight and not self._cancelled.is_set():
+                    try:
+                        item, count, src, dst = next(jobs)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    if id(item) not in remaining:
+                        remaining[id(item)] = count
+                        errors[id(item)] = []
+                        statuses[id(item)] = set()
+                    if src is None:
+                        future = futures.Future()
+                        future.set_result((STATUS_ERROR, 0, dst))
+                    else:
+                        future = executor.submit(self._copy_task, src, dst)
+                    pending[future] = (item, src)
+
+                with self._lock:
+                    self._progress["in_flight"] = len(pending)
+                    self._progress["max_in_flight"] = max(self._progress["max_in_flight"], len(pending))
+                if not pending:
+                    break
+
+                done, _ = futures.wait(
+                    list(pending), timeout=self._progress_interval,
+                    return_when=futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    item, src = pending.pop(future)
+                    status, size, error = future.result()
+                    with self._lock:
+                        self._progress["files_done"] += 1
+                        self._progress["bytes_done"] += size
+                        self._progress[status] += 1
+                    statuses[id(item)].add(status)
+                    if error:
+                        errors[id(item)].append((src or item.path, error))
+                    remaining[id(item)] -= 1
+                    if remaining[id(item)] == 0:
+                        del remaining[id(item)]
+                        item_statuses = statuses.pop(id(item))
+                        item_errors = errors.pop(id(item))
+                        if self._item_callback:
+                            self._item_callback(item, _item_status(item_statuses), item_errors)
+
+                now = time.time()
+                with self._lock:
+                    elapsed = now - self._progress["start_time"]
+                    if elapsed > 0:
+                        self._progress["bytes_per_second"] = self._progress["bytes_copied"] / elapsed
+                    progress = dict(self._progress)
+                if self._progress_callback and now - last_report >= self._progress_interval:
+                    last_report = now
+                    self._progress_callback(progress)
+        finally:
+            executor.shutdown(wait=True)
+            if self._journal is not None:
+                self._journal.close()
+            with self._lock:
+                self._progress["end_time"] = time.time()
+                self._progress["in_flight"] = 0
+                self._progress["cancelled"] = self._cancelled.is_set()
+            self._done.set()
+
+        if self._finished_callback:
+            self._finished_callback(self.progress)
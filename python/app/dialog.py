@@ -9,6 +9,8 @@
 # not expressly granted therein are reserved by Shotgun Software Inc.
 
 import sgtk
+import fnmatch
+import hashlib
 import os
 import sys
 import threading
@@ -17,6 +19,18 @@ import threading
 # the code will be compatible with both PySide and PyQt.
 from sgtk.platform.qt import QtCore, QtGui
 from .ui.dialog import Ui_Dialog
+from .scanner import ScanEngine
+from .scan_index import ScanIndex
+from .verify import VerifyEngine, scanned_manifests, STATUS_MISMATCH, STATUS_ERROR as VERIFY_ERROR
+from .copier import CopyEngine, CopyJournal, TemplateDestinationResolver, STATUS_ERROR as COPY_ERROR
+from .registration import (
+    BatchRegistrar, IngestRegistration, find_or_create_published_file_type, path_cache_resolver,
+    STATUS_EXISTING as REGISTER_EXISTING,
+)
+from .model import IngestItemModel, format_size
+from .thumbnails import ThumbnailCache, ThumbnailPool
+from .stats import PipelineStats, ShotgunCallCounter
+from .pipeline import DEFAULT_RULES
 
 def show_dialog(app_instance):
     """
@@ -31,6 +45,51 @@ def show_dialog(app_instance):
     app_instance.engine.show_dialog("Starter Template App...", app_instance, AppDialog)
     
 
+class ScanSignals(QtCore.QObject):
+    """
+    Carries scan engine callbacks from the worker threads over to the main thread.
+
+    The scan engine calls back from its own threads. Emitting a signal from there
+    results in a queued connection, so the connected slots run in the UI thread.
+    Batch and finished signals carry the emitting engine along, so that results
+    still in flight from a cancelled scan can be told apart from the current one.
+    """
+    batch_ready = QtCore.Signal(object, object)
+    scan_finished = QtCore.Signal(object, object)
+    scan_error = QtCore.Signal(str, str)
+
+
+class VerifySignals(QtCore.QObject):
+    """
+    Carries verify engine callbacks from its background thread over to the main thread.
+    """
+    item_verified = QtCore.Signal(object, object, str)
+    progress = QtCore.Signal(object, object)
+    verify_finished = QtCore.Signal(object, object)
+
+
+class CopySignals(QtCore.QObject):
+    """
+    Carries copy engine callbacks from its background thread over to the main thread.
+    """
+    item_copied = QtCore.Signal(object, object, str, object)
+    progress = QtCore.Signal(object, object)
+    copy_finished = QtCore.Signal(object, object)
+
+
+class RegisterSignals(QtCore.QObject):
+    """
+    Carries the outcome of registering items over to the main thread.
+    """
+    register_finished = QtCore.Signal(object, object, object)
+
+
+class ThumbnailSignals(QtCore.QObject):
+    """
+    Carries rendered thumbnails from the thumbnail workers over to the main thread.
+    """
+    thumbnail_ready = QtCore.Signal(object, object)
+
 
 class AppDialog(QtGui.QWidget):
     """
@@ -60,4 +119,649 @@ class AppDialog(QtGui.QWidget):
         # lastly, set up our very basic UI
         self.ui.context.setText("Current Context: %s" % self._app.context)
         
+        # the scan engine runs in background threads and reports back via signals
+        self._scan_engine = None
+        self._scan_index = None
+        self._scan_signals = ScanSignals(self)
+        self._scan_signals.batch_ready.connect(self._on_scan_batch)
+        self._scan_signals.scan_finished.connect(self._on_scan_finished)
+        self._scan_signals.scan_error.connect(self._on_scan_error)
+
+        # scanned items are held by a lazily populated model, which sorts and
+        # filters all of them rather than just the rows the view has fetched.
+        self._model = IngestItemModel(self)
+        self.ui.results.setModel(self._model)
+        self.ui.results.sortByColumn(IngestItemModel.COLUMN_NAME, QtCore.Qt.AscendingOrder)
+
+        # re-filtering a large model on every keystroke is wasteful, so wait
+        # until typing has paused.
+        self._filter_timer = QtCore.QTimer(self)
+        self._filter_timer.setSingleShot(True)
+        self._filter_timer.setInterval(250)
+        self._filter_timer.timeout.connect(self._apply_filter)
+        self.ui.filter.textChanged.connect(self._filter_timer.start)
+
+        # thumbnails are requested by the model as rows get painted. While
+        # scrolling, the set of visible rows is passed on to the thumbnail pool
+        # so that it renders those first.
+        self._thumbnail_pool = None
+        self._thumbnail_signals = ThumbnailSignals(self)
+        self._thumbnail_signals.thumbnail_ready.connect(self._on_thumbnail_ready)
+        self._visible_timer = QtCore.QTimer(self)
+        self._visible_timer.setSingleShot(True)
+        self._visible_timer.setInterval(100)
+        self._visible_timer.timeout.connect(self._update_visible_thumbnails)
+        self._setup_thumbnails()
+
+        self._verify_engine = None
+        self._verify_signals = VerifySignals(self)
+        self._verify_signals.item_verified.connect(self._on_item_verified)
+        self._verify_signals.progress.connect(self._on_verify_progress)
+        self._verify_signals.verify_finished.connect(self._on_verify_finished)
+
+        self._copy_engine = None
+        self._copy_signals = CopySignals(self)
+        self._copy_signals.item_copied.connect(self._on_item_copied)
+        self._copy_signals.progress.connect(self._on_copy_progress)
+        self._copy_signals.copy_finished.connect(self._on_copy_finished)
+
+        # copy status by id() of the item, and the resolver used for the last copy
+        self._copy_status = {}
+        self._resolver = None
+
+        self._register_thread = None
+        self._register_signals = RegisterSignals(self)
+        self._register_signals.register_finished.connect(self._on_register_finished)
+
+        # timings and counters of every stage, shown in the stats panel while
+        # it is open. The panel is refreshed on a timer rather than on every
+        # engine callback, so keeping it open costs next to nothing.
+        self._stats = PipelineStats()
+        self._stats_timer = QtCore.QTimer(self)
+        self._stats_timer.setInterval(1000)
+        self._stats_timer.timeout.connect(self._refresh_stats)
+        self.ui.stats_button.toggled.connect(self._on_stats_toggled)
         
+        self.ui.browse_button.clicked.connect(self._on_browse)
+        self.ui.scan_button.clicked.connect(self._on_scan_clicked)
+        self.ui.delivery_path.returnPressed.connect(self._on_scan_clicked)
+        self.ui.verify_button.clicked.connect(self._on_verify_clicked)
+        self.ui.ingest_button.clicked.connect(self._on_ingest_clicked)
+
+    def closeEvent(self, event):
+        """
+        Makes sure background work is stopped when the dialog goes away.
+        """
+        self._stats_timer.stop()
+        self._cancel_scan()
+        if self._thumbnail_pool:
+            self._thumbnail_pool.stop()
+        if self._verify_engine:
+            self._verify_engine.cancel()
+        if self._copy_engine:
+            self._copy_engine.cancel()
+            self._copy_engine.wait(5)
+        if self._scan_engine:
+            self._scan_engine.wait(5)
+        if self._scan_index:
+            self._scan_index.close()
+            self._scan_index = None
+        QtGui.QWidget.closeEvent(self, event)
+
+    ############################################################################
+    # scanning
+
+    def _on_browse(self):
+        """
+        Lets the user pick a delivery folder.
+        """
+        path = QtGui.QFileDialog.getExistingDirectory(
+            self, "Select Delivery Folder", self.ui.delivery_path.text()
+        )
+        if path:
+            self.ui.delivery_path.setText(path)
+
+    def _on_scan_clicked(self):
+        """
+        Starts a new scan, or cancels the one currently running.
+        """
+        if self._scan_engine and self._scan_engine.is_running():
+            self._cancel_scan()
+            return
+
+        path = self.ui.delivery_path.text().strip()
+        if not os.path.isdir(path):
+            QtGui.QMessageBox.warning(self, "Scan Delivery", "'%s' is not a folder." % path)
+            return
+
+        self._model.clear(os.path.abspath(path))
+        if self._thumbnail_pool:
+            self._thumbnail_pool.clear()
+        self.ui.status.setText("Scanning %s..." % path)
+        self.ui.scan_button.setText("Cancel")
+        self.ui.verify_button.setEnabled(False)
+        self.ui.ingest_button.setEnabled(False)
+
+        signals = self._scan_signals
+        engine = ScanEngine(
+            path,
+            lambda items: signals.batch_ready.emit(engine, items),
+            finished_callback=lambda stats: signals.scan_finished.emit(engine, stats),
+            error_callback=lambda p, e: signals.scan_error.emit(p, str(e)),
+            num_workers=self._app.get_setting("scan_threads"),
+            batch_size=self._app.get_setting("scan_batch_size"),
+            index=self._get_scan_index(),
+        )
+        self._scan_engine = engine
+        self._app.log_debug("Starting scan of %s" % path)
+
+        # stats cover a single delivery, from its scan through to its registration
+        self._stats.clear()
+        self._stats.stage("scan").start(lambda: engine.stats)
+        if self._thumbnail_pool:
+            self._stats.stage("thumbnails").start(lambda: self._thumbnail_pool.stats)
+        engine.start()
+
+    def _get_scan_index(self):
+        """
+        Returns the scan index shared by all scans of this dialog, or None if
+        the index is disabled or could not be opened.
+        """
+        if self._scan_index is None and self._app.get_setting("scan_cache_enabled"):
+            path = os.path.join(self._app.cache_location, "scan_index.db")
+            try:
+                self._scan_index = ScanIndex(
+                    path, self._app.get_setting("scan_cache_max_mb") * 1024 * 1024
+                )
+            except Exception as e:
+                self._app.log_warning("Could not open scan index %s: %s" % (path, e))
+        return self._scan_index
+
+    def _cancel_scan(self):
+        """
+        Requests the running scan, if any, to stop.
+        """
+        if self._scan_engine:
+            self._scan_engine.cancel()
+
+    def _on_scan_batch(self, engine, items):
+        """
+        Adds a batch of scanned items to the results.
+        """
+        if engine is not self._scan_engine:
+            return
+        self._model.append_items(items)
+        self.ui.status.setText("Scanning... %d items found" % self._model.item_count())
+
+    def _on_scan_finished(self, engine, stats):
+        """
+        Called once the scan engine has completed its walk.
+        """
+        if engine is not self._scan_engine:
+            return
+        self._stop_stage("scan", stats)
+        self.ui.scan_button.setText("Scan")
+        self.ui.verify_button.setEnabled(bool(self._model.item_count()))
+        self.ui.ingest_button.setEnabled(bool(self._model.item_count()))
+        duration = stats["end_time"] - stats["start_time"]
+        msg = "%d items (%d files, %s) in %d folders, scanned in %.1fs" % (
+            stats["items"], stats["files"], format_size(stats["bytes"]),
+            stats["directories"], duration
+        )
+        if stats["cached_directories"] == stats["directories"] and stats["directories"]:
+            msg += " (all from cache)"
+        elif stats["cached_directories"]:
+            msg += " (%d folders from cache, %d rescanned)" % (
+                stats["cached_directories"], stats["directories"] - stats["cached_directories"]
+            )
+        else:
+            msg += " (fresh scan)"
+        if stats["cancelled"]:
+            msg = "Scan cancelled. " + msg
+        if stats["errors"]:
+            msg += ", %d folders could not be read" % stats["errors"]
+        self.ui.status.setText(msg)
+        self._app.log_debug(msg)
+
+    def _on_scan_error(self, path, message):
+        """
+        Called for every folder the scan engine failed to read.
+        """
+        self._app.log_warning("Could not scan %s: %s" % (path, message))
+
+    def _apply_filter(self):
+        """
+        Filters the results by the text entered in the filter field.
+        """
+        self._model.set_filter_text(self.ui.filter.text())
+
+    ############################################################################
+    # thumbnails
+
+    def _setup_thumbnails(self):
+        """
+        Creates the thumbnail pool and hooks it up to the model, if thumbnails
+        are enabled and a decoder is available.
+        """
+        if not self._app.get_setting("thumbnails_enabled"):
+            return
+
+        folder = os.path.join(self._app.cache_location, "thumbnails")
+        try:
+            cache = ThumbnailCache(folder, self._app.get_setting("thumbnail_cache_max_mb") * 1024 * 1024)
+        except Exception as e:
+            self._app.log_warning("Could not open thumbnail cache %s: %s" % (folder, e))
+            return
+
+        signals = self._thumbnail_signals
+        pool = ThumbnailPool(
+            cache,
+            signals.thumbnail_ready.emit,
+            num_workers=self._app.get_setting("thumbnail_workers"),
+            size=self._app.get_setting("thumbnail_size"),
+        )
+        if not pool.decoders:
+            self._app.log_debug("No thumbnail decoder available, thumbnails are disabled.")
+            return
+        self._app.log_debug(
+            "Rendering thumbnails using %s" % ", ".join(decoder.name for decoder in pool.decoders)
+        )
+
+        self._thumbnail_pool = pool
+        self._model.set_thumbnail_provider(pool.request)
+        self.ui.results.setIconSize(QtCore.QSize(64, 36))
+        self.ui.results.verticalScrollBar().valueChanged.connect(self._visible_timer.start)
+
+    def _on_thumbnail_ready(self, item, path):
+        """
+        Displays a rendered thumbnail.
+        """
+        pixmap = None
+        if path:
+            pixmap = QtGui.QPixmap(path)
+            if pixmap.isNull():
+                pixmap = None
+            else:
+                size = self.ui.results.iconSize()
+                pixmap = pixmap.scaled(size, QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation)
+        self._model.set_thumbnail(item, pixmap)
+
+    def _update_visible_thumbnails(self):
+        """
+        Tells the thumbnail pool which items are on screen after scrolling, and
+        queues the next screenful below them at a lower priority.
+        """
+        view = self.ui.results
+        viewport = view.viewport()
+        top = view.indexAt(QtCore.QPoint(0, 0))
+        bottom = view.indexAt(QtCore.QPoint(0, viewport.height() - 1))
+        if not top.isValid():
+            return
+        first = top.row()
+        last = bottom.row() if bottom.isValid() else self._model.rowCount() - 1
+        page = last - first + 1
+
+        def items_in(start, end):
+            items = []
+            for row in range(start, min(end, self._model.rowCount() - 1) + 1):
+                item = self._model.index(row, 0).data(IngestItemModel.ITEM_ROLE)
+                if item is not None:
+                    items.append(item)
+            return items
+
+        self._thumbnail_pool.set_visible(items_in(first, last))
+        for item in items_in(last + 1, last + page):
+            self._thumbnail_pool.request(item, visible=False)
+
+    ############################################################################
+    # verification
+
+    def _on_verify_clicked(self):
+        """
+        Starts verifying all scanned items, or cancels the verification currently running.
+        """
+        if self._verify_engine and self._verify_engine.is_running():
+            self._verify_engine.cancel()
+            return
+
+        items = self._model.items()
+        try:
+            signals = self._verify_signals
+            # the manifests are among the scanned items. They are read on the
+            # verify thread, as parsing them can take a while on large deliveries.
+            engine = VerifyEngine(
+                items,
+                algorithm=self._app.get_setting("verify_hash_algorithm"),
+                manifest_paths=scanned_manifests(items),
+                num_workers=self._app.get_setting("verify_workers"),
+                buffer_size=self._app.get_setting("verify_read_buffer_mb") * 1024 * 1024,
+                use_mmap=self._app.get_setting("verify_use_mmap"),
+                item_callback=lambda item, status, results: signals.item_verified.emit(engine, item, status),
+                progress_callback=lambda progress: signals.progress.emit(engine, progress),
+                finished_callback=lambda progress: signals.verify_finished.emit(engine, progress),
+            )
+        except Exception as e:
+            QtGui.QMessageBox.warning(self, "Verify Delivery", "Could not start verification: %s" % e)
+            return
+
+        self._app.log_debug("Verifying %d items" % len(items))
+
+        self._model.clear_status(IngestItemModel.COLUMN_VERIFY)
+        self._verify_engine = engine
+        self._stats.stage("verify").start(lambda: engine.progress)
+        self.ui.scan_button.setEnabled(False)
+        self.ui.ingest_button.setEnabled(False)
+        self.ui.verify_button.setText("Cancel")
+        self.ui.status.setText("Verifying...")
+        engine.start()
+
+    def _on_item_verified(self, engine, item, status):
+        """
+        Displays the verification status of an item.
+        """
+        if engine is not self._verify_engine:
+            return
+        self._model.set_status(item, IngestItemModel.COLUMN_VERIFY, status)
+
+    def _on_verify_progress(self, engine, progress):
+        """
+        Displays verification throughput.
+        """
+        if engine is not self._verify_engine:
+            return
+        self.ui.status.setText(
+            "Verifying... %d/%d files, %s/%s at %s/s" % (
+                progress["files_done"], progress["files_total"],
+                format_size(progress["bytes_done"]), format_size(progress["bytes_total"]),
+                format_size(progress["bytes_per_second"]),
+            )
+        )
+
+    def _on_verify_finished(self, engine, progress):
+        """
+        Called once all files have been hashed, or verification was cancelled.
+        """
+        if engine is not self._verify_engine:
+            return
+        self._stop_stage("verify", progress)
+        manifest = engine.manifest
+        for path, message in manifest.errors:
+            self._app.log_warning("Could not read manifest %s: %s" % (path, message))
+        self._app.log_debug(
+            "Verified against %d manifest entries from %s" % (
+                len(manifest), ", ".join(manifest.sources) or "no manifests"
+            )
+        )
+        self.ui.scan_button.setEnabled(True)
+        self.ui.ingest_button.setEnabled(True)
+        self.ui.verify_button.setText("Verify")
+        msg = "%d files verified: %d ok, %d mismatched, %d without checksum, %d unreadable. %s at %s/s" % (
+            progress["files_done"], progress["ok"], progress["mismatch"],
+            progress["unverified"], progress["error"],
+            format_size(progress["bytes_done"]), format_size(progress["bytes_per_second"]),
+        )
+        if progress["cancelled"]:
+            msg = "Verification cancelled. " + msg
+        self.ui.status.setText(msg)
+        self._app.log_info(msg)
+
+    ############################################################################
+    # copying
+
+    def _on_ingest_clicked(self):
+        """
+        Starts copying all scanned items into the project, or cancels the copy
+        currently running.
+        """
+        if self._copy_engine and self._copy_engine.is_running():
+            self._copy_engine.cancel()
+            return
+
+        template = self._app.get_template("ingest_template")
+        if template is None:
+            QtGui.QMessageBox.warning(
+                self, "Ingest Delivery", "No ingest_template has been configured for this app."
+            )
+            return
+
+        root = self._scan_engine.root
+        # the journal is specific to a delivery and a destination, so that
+        # re-running the same ingest picks up where the last run left off.
+        journal_key = hashlib.md5(("%s|%s" % (root, template.name)).encode("utf-8")).hexdigest()
+        journal_path = os.path.join(self._app.cache_location, "copy_journals", "%s.jsonl" % journal_key)
+
+        # like the headless pipeline, checksum manifests and partial copies
+        # matching its default exclude rules, and items that failed verification
+        # are never copied into the project. Items that have not been verified are.
+        items = []
+        excluded = []
+        failed = []
+        for item in self._model.items():
+            if any(fnmatch.fnmatch(item.name, pattern) for pattern in DEFAULT_RULES["exclude"]):
+                excluded.append(item)
+            elif self._model.status(item, IngestItemModel.COLUMN_VERIFY) in (STATUS_MISMATCH, VERIFY_ERROR):
+                failed.append(item)
+            else:
+                items.append(item)
+        if not items:
+            QtGui.QMessageBox.warning(
+                self, "Ingest Delivery", "All items are excluded from ingest or failed verification."
+            )
+            return
+
+        try:
+            resolver = TemplateDestinationResolver(
+                template, self._app.context.as_template_fields(template)
+            )
+            journal = CopyJournal(journal_path)
+            signals = self._copy_signals
+            engine = CopyEngine(
+                items,
+                resolver,
+                journal=journal,
+                num_workers=self._app.get_setting("copy_workers"),
+                bandwidth=self._app.get_setting("copy_bandwidth_mb") * 1024 * 1024,
+                chunk_size=self._app.get_setting("copy_chunk_mb") * 1024 * 1024,
+                item_callback=lambda item, status, errors: signals.item_copied.emit(engine, item, status, errors),
+                progress_callback=lambda progress: signals.progress.emit(engine, progress),
+                finished_callback=lambda progress: signals.copy_finished.emit(engine, progress),
+            )
+        except Exception as e:
+            QtGui.QMessageBox.warning(self, "Ingest Delivery", "Could not start ingest: %s" % e)
+            return
+
+        if len(journal):
+            self._app.log_debug("Resuming ingest using journal %s" % journal_path)
+
+        self._model.clear_status(IngestItemModel.COLUMN_INGEST)
+        for item in excluded:
+            self._model.set_status(item, IngestItemModel.COLUMN_INGEST, "excluded")
+        for item in failed:
+            self._model.set_status(item, IngestItemModel.COLUMN_INGEST, "failed verification")
+        if failed:
+            self._app.log_warning("Not ingesting %d items that failed verification." % len(failed))
+        self._copy_status = {}
+        self._resolver = resolver
+        self._copy_engine = engine
+        self._stats.stage("copy").start(lambda: engine.progress)
+        self.ui.scan_button.setEnabled(False)
+        self.ui.verify_button.setEnabled(False)
+        self.ui.ingest_button.setText("Cancel")
+        self.ui.status.setText("Copying...")
+        engine.start()
+
+    def _on_item_copied(self, engine, item, status, errors):
+        """
+        Displays the copy status of an item.
+        """
+        if engine is not self._copy_engine:
+            return
+        self._copy_status[id(item)] = status
+        self._model.set_status(item, IngestItemModel.COLUMN_INGEST, status)
+        for path, message in errors:
+            self._app.log_warning("Could not copy %s: %s" % (path, message))
+
+    def _on_copy_progress(self, engine, progress):
+        """
+        Displays copy throughput.
+        """
+        if engine is not self._copy_engine:
+            return
+        self.ui.status.setText(
+            "Copying... %d/%d files, %s/%s at %s/s" % (
+                progress["files_done"], progress["files_total"],
+                format_size(progress["bytes_done"]), format_size(progress["bytes_total"]),
+                format_size(progress["bytes_per_second"]),
+            )
+        )
+
+    def _on_copy_finished(self, engine, progress):
+        """
+        Called once all files have been copied, or copying was cancelled.
+        """
+        if engine is not self._copy_engine:
+            return
+        self._stop_stage("copy", progress)
+        self.ui.ingest_button.setText("Ingest")
+        msg = "%d files ingested: %d copied, %d already in place, %d failed. %s copied at %s/s" % (
+            progress["files_done"], progress["copied"], progress["skipped"], progress["error"],
+            format_size(progress["bytes_copied"]), format_size(progress["bytes_per_second"]),
+        )
+        if progress["cancelled"]:
+            msg = "Ingest cancelled. " + msg
+        self.ui.status.setText(msg)
+        self._app.log_info(msg)
+
+        copied = [
+            item for item in self._model.items()
+            if self._copy_status.get(id(item), COPY_ERROR) != COPY_ERROR
+        ]
+        if progress["cancelled"] or not copied or not self._app.get_setting("register_in_shotgun"):
+            self._stats.log(self._app.log_info)
+            self._set_idle()
+            return
+        self._start_registration(copied)
+
+    def _set_idle(self):
+        """
+        Re-enables the buttons once a pipeline stage has completed.
+        """
+        self.ui.scan_button.setEnabled(True)
+        self.ui.verify_button.setEnabled(True)
+        self.ui.ingest_button.setEnabled(True)
+
+    ############################################################################
+    # registration
+
+    def _start_registration(self, items):
+        """
+        Registers copied items in Shotgun from a background thread.
+        """
+        self.ui.ingest_button.setEnabled(False)
+        self.ui.status.setText("Registering %d items in Shotgun..." % len(items))
+
+        # the context is resolved here, in the main thread, before handing
+        # the work off to the registration thread.
+        context = self._app.context
+        context_fields = {"project": context.project, "entity": context.entity, "task": context.task}
+        resolver = self._resolver
+        root = self._scan_engine.root
+        signals = self._register_signals
+        stage = self._stats.stage("register")
+
+        def register():
+            try:
+                sg = ShotgunCallCounter(self._app.shotgun)
+                registrar = BatchRegistrar(
+                    sg,
+                    chunk_size=self._app.get_setting("shotgun_batch_size"),
+                    max_retries=self._app.get_setting("shotgun_max_retries"),
+                )
+                stage.start(lambda: dict(
+                    registrar.stats, items=len(items), queued=len(registrar), shotgun_calls=sg.call_count
+                ))
+                entity_type = sgtk.util.get_published_file_entity_type(self._app.tk)
+                published_file_type = find_or_create_published_file_type(
+                    sg, entity_type, self._app.get_setting("published_file_type")
+                )
+                registration = IngestRegistration(
+                    registrar, context_fields, entity_type, published_file_type,
+                    description="Ingested from %s" % root,
+                    path_cache_fields=path_cache_resolver(self._app.tk, sg),
+                )
+                results = registration.register(items, resolver.destination_path)
+                signals.register_finished.emit(thread, results, registrar.stats)
+            except Exception as e:
+                signals.register_finished.emit(thread, e, None)
+
+        thread = threading.Thread(target=register, name="ingest-register")
+        thread.daemon = True
+        self._register_thread = thread
+        thread.start()
+
+    def _on_register_finished(self, thread, results, stats):
+        """
+        Displays the outcome of registering items in Shotgun.
+        """
+        if thread is not self._register_thread:
+            return
+        self._stop_stage("register")
+        self._stats.log(self._app.log_info)
+        self._set_idle()
+
+        if isinstance(results, Exception):
+            msg = "Could not register items in Shotgun: %s" % results
+            self.ui.status.setText(msg)
+            self._app.log_error(msg)
+            return
+
+        failed = 0
+        existing = 0
+        for item, status, version, publish, error in results:
+            if error is not None:
+                failed += 1
+                self._app.log_warning("Could not register %s: %s" % (item.path, error))
+            existing += status == REGISTER_EXISTING
+            self._model.set_status(
+                item, IngestItemModel.COLUMN_INGEST,
+                "registration failed" if error is not None else status
+            )
+
+        msg = (
+            "%d items registered in Shotgun (%d of them already were), %d failed, "
+            "using %d batch calls (%d retried)" % (
+                len(results) - failed, existing, failed, stats["batch_calls"], stats["retries"]
+            )
+        )
+        self.ui.status.setText(msg)
+        self._app.log_info(msg)
+
+    ############################################################################
+    # stats
+
+    def _stop_stage(self, name, counters=None):
+        """
+        Records the final counters of a stage and logs its stats.
+        """
+        self._stats.stage(name).stop(counters)
+        self._stats.log(self._app.log_debug, stages=[name])
+        if self.ui.stats_panel.isVisible():
+            self._refresh_stats()
+
+    def _on_stats_toggled(self, checked):
+        """
+        Shows or hides the stats panel.
+        """
+        self.ui.stats_panel.setVisible(checked)
+        if checked:
+            self._refresh_stats()
+            self._stats_timer.start()
+        else:
+            self._stats_timer.stop()
+
+    def _refresh_stats(self):
+        """
+        Displays the current stats of every stage.
+        """
+        lines = self._stats.format_lines()
+        self.ui.stats_panel.setPlainText("\n".join(lines) or "No stats yet, scan a delivery first.")
@@ -0,0 +1,112 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Hashing of single files, shared by the verify engine and its worker processes.
+
+This module deliberately has no imports from the rest of the app. Worker
+processes started with the spawn or forkserver methods load it by its file
+path, without importing the app package. They do however re-import the main
+module of the process that started them, like any spawned process.
+"""
+
+import hashlib
+import mmap
+import os
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# hash algorithms that can be selected through the app configuration
+HASHLIB_ALGORITHMS = ("md5", "sha1", "sha256")
+XXHASH_ALGORITHMS = ("xxh64", "xxh3_64", "xxh128")
+ALGORITHMS = HASHLIB_ALGORITHMS + XXHASH_ALGORITHMS
+
+def available_algorithms():
+    """
+    Returns the hash algorithms that can be used in this python environment.
+    """
+    if xxhash is None:
+        return HASHLIB_ALGORITHMS
+    return ALGORITHMS
+
+
+def new_hasher(algorithm):
+    """
+    Returns a new hash object for the given algorithm name.
+
+    :raises ValueError: If the algorithm is unknown or its module is not installed.
+    """
+    if algorithm in HASHLIB_ALGORITHMS:
+        return hashlib.new(algorithm)
+    if algorithm in XXHASH_ALGORITHMS:
+        if xxhash is None:
+            raise ValueError(
+                "The %s hash algorithm requires the xxhash python module, "
+                "which is not installed." % algorithm
+            )
+        return getattr(xxhash, algorithm)()
+    raise ValueError(
+        "Unknown hash algorithm '%s'. Supported algorithms are: %s" % (algorithm, ", ".join(ALGORITHMS))
+    )
+
+
+def hash_file(path, algorithms, buffer_size=8 * 1024 * 1024, use_mmap=True):
+    """
+    Computes one or more digests of a file in a single read pass.
+
+    :param path: File to hash.
+    :param algorithms: List of algorithm names.
+    :param buffer_size: Number of bytes fed to the hashers at a time.
+    :param use_mmap: Map files larger than the buffer into memory rather than
+                     copying them through a read buffer.
+    :returns: Tuple of (file size, dictionary of algorithm name to hex digest).
+    """
+    hashers = [(name, new_hasher(name)) for name in algorithms]
+    with open(path, "rb") as fh:
+        size = os.fstat(fh.fileno()).st_size
+        if use_mmap and size > buffer_size:
+            mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                view = memoryview(mapped)
+                try:
+                    for offset in range(0, size, buffer_size):
+                        chunk = view[offset:offset + buffer_size]
+                        for _, hasher in hashers:
+                            hasher.update(chunk)
+                        chunk.release()
+                finally:
+                    view.release()
+            finally:
+                mapped.close()
+        else:
+            buf = bytearray(min(buffer_size, max(size, 1)))
+            view = memoryview(buf)
+            while True:
+                count = fh.readinto(buf)
+                if not count:
+                    break
+                for _, hasher in hashers:
+                    hasher.update(view[:count])
+    return size, dict((name, hasher.hexdigest()) for name, hasher in hashers)
+
+
+def hash_task(path, algorithms, buffer_size, use_mmap):
+    """
+    Pool entry point. Errors are returned rather than raised, so that a single
+    unreadable file does not have to travel back as a pickled exception.
+    """
+    try:
+        size, digests = hash_file(path, algorithms, buffer_size, use_mmap)
+        return path, size, digests, None
+    except Exception as e:
+        return path, 0, {}, "%s: %s" % (e.__class__.__name__, e)
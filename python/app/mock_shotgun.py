@@ -0,0 +1,211 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+In-memory stand-in for a Shotgun API connection.
+
+Implements the subset of the shotgun_api3.Shotgun interface used by the ingest
+registration layer, so that it can be exercised and benchmarked without a site.
+"""
+
+import copy
+import threading
+import time
+
+
+class MockShotgunError(Exception):
+    """
+    Raised by the mock for invalid requests, like the Fault raised by the
+    Shotgun API when the server rejects a request.
+    """
+
+
+class MockTransportError(OSError):
+    """
+    Raised by the mock for injected failures, like the socket errors raised
+    by the Shotgun API when the connection to the server fails.
+    """
+
+
+class MockShotgun(object):
+    """
+    Minimal in-memory Shotgun.
+
+    Every public API method counts as one round trip: it sleeps for the configured
+    latency and increments the call counters. Transport failures can be injected
+    to test retry behaviour, either before the call reaches the server or after
+    the server has applied it. Like the real server, batch() is transactional:
+    if any request in a batch fails, none of them are applied.
+    """
+
+    def __init__(self, latency=0.0):
+        """
+        Constructor
+
+        :param latency: Seconds every API call sleeps for, to simulate the round
+                        trip to a real server.
+        """
+        self.latency = latency
+        self.call_count = 0
+        self.calls = {}
+        self._entities = {}
+        self._next_id = 1
+        self._fail_next = 0
+        self._fail_after_commit = False
+        self._lock = threading.RLock()
+
+    def fail_next(self, count=1, after_commit=False):
+        """
+        Makes the next count API calls raise MockTransportError.
+
+        :param count: Number of calls to fail.
+        :param after_commit: If True, the calls are applied before they fail, as
+                             if the response was lost on its way back.
+        """
+        with self._lock:
+            self._fail_next = count
+            self._fail_after_commit = after_commit
+
+    def reset_counters(self):
+        """
+        Resets the call counters.
+        """
+        with self._lock:
+            self.call_count = 0
+            self.calls = {}
+
+    def entities(self, entity_type):
+        """
+        Returns copies of all stored entities of a type, bypassing the call counters.
+        """
+        with self._lock:
+            return [copy.deepcopy(e) for e in self._entities.get(entity_type, {}).values()]
+
+    ############################################################################
+    # shotgun_api3 interface
+
+    def create(self, entity_type, data, return_fields=None):
+        return self._round_trip("create", self._create, entity_type, data, return_fields)
+
+    def update(self, entity_type, entity_id, data):
+        return self._round_trip("update", self._update, entity_type, entity_id, data)
+
+    def delete(self, entity_type, entity_id):
+        return self._round_trip("delete", self._delete, entity_type, entity_id)
+
+    def find(self, entity_type, filters, fields=None, order=None, limit=0):
+        return self._round_trip("find", self._find, entity_type, filters, fields, limit)
+
+    def find_one(self, entity_type, filters, fields=None, order=None):
+        results = self.find(entity_type, filters, fields, order, limit=1)
+        return results[0] if results else None
+
+    def batch(self, requests):
+        return self._round_trip("batch", self._batch, requests)
+
+    ############################################################################
+    # internals, called with the lock held
+
+    def _round_trip(self, method, func, *args):
+        """
+        Simulates latency, counts the call, applies it and raises injected failures.
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.call_count += 1
+            self.calls[method] = self.calls.get(method, 0) + 1
+            fail = bool(self._fail_next)
+            if fail:
+                self._fail_next -= 1
+                if not self._fail_after_commit:
+                    raise MockTransportError("Injected failure in %s()" % method)
+            result = func(*args)
+            if fail:
+                raise MockTransportError("Injected failure in %s(), after it was applied" % method)
+            return result
+
+    def _batch(self, requests):
+        snapshot = copy.deepcopy(self._entities), self._next_id
+        try:
+            results = []
+            for request in requests:
+                request_type = request.get("request_type")
+                if request_type == "create":
+                    results.append(self._create(
+                        request["entity_type"], request["data"], request.get("return_fields")
+                    ))
+                elif request_type == "update":
+                    results.append(self._update(
+                        request["entity_type"], request["entity_id"], request["data"]
+                    ))
+                elif request_type == "delete":
+                    results.append(self._delete(request["entity_type"], request["entity_id"]))
+                else:
+                    raise MockShotgunError("Invalid request_type '%s'" % request_type)
+            return results
+        except Exception:
+            self._entities, self._next_id = snapshot
+            raise
+
+    def _find(self, entity_type, filters, fields, limit):
+        results = []
+        for entity in self._entities.get(entity_type, {}).values():
+            if all(self._matches(entity, f) for f in filters or []):
+                results.append(self._project(entity, fields))
+                if limit and len(results) >= limit:
+                    break
+        return results
+
+    def _create(self, entity_type, data, return_fields):
+        entity = copy.deepcopy(data)
+        entity["type"] = entity_type
+        entity["id"] = self._next_id
+        self._next_id += 1
+        self._entities.setdefault(entity_type, {})[entity["id"]] = entity
+        result = dict((k, copy.deepcopy(v)) for k, v in entity.items())
+        for field in return_fields or []:
+            result.setdefault(field, None)
+        return result
+
+    def _update(self, entity_type, entity_id, data):
+        entity = self._entities.get(entity_type, {}).get(entity_id)
+        if entity is None:
+            raise MockShotgunError("%s %s does not exist" % (entity_type, entity_id))
+        entity.update(copy.deepcopy(data))
+        result = {"type": entity_type, "id": entity_id}
+        result.update(copy.deepcopy(data))
+        return result
+
+    def _delete(self, entity_type, entity_id):
+        return self._entities.get(entity_type, {}).pop(entity_id, None) is not None
+
+    def _matches(self, entity, sg_filter):
+        field, relation, value = sg_filter[0], sg_filter[1], sg_filter[2]
+        actual = entity.get(field)
+        if relation == "is":
+            return self._equal(actual, value)
+        if relation == "is_not":
+            return not self._equal(actual, value)
+        if relation == "in":
+            return any(self._equal(actual, v) for v in value)
+        raise MockShotgunError("Unsupported filter relation '%s'" % relation)
+
+    def _equal(self, actual, expected):
+        # entity links compare by type and id only
+        if isinstance(actual, dict) and isinstance(expected, dict):
+            return (actual.get("type"), actual.get("id")) == (expected.get("type"), expected.get("id"))
+        return actual == expected
+
+    def _project(self, entity, fields):
+        result = {"type": entity["type"], "id": entity["id"]}
+        for field in fields or []:
+            result[field] = copy.deepcopy(entity.get(field))
+        return result
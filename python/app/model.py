@@ -0,0 +1,392 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+import bisect
+import collections
+import os
+
+# by importing QT from sgtk rather than directly, we ensure that
+# the code will be compatible with both PySide and PyQt.
+from sgtk.platform.qt import QtCore
+
+from .stats import format_size
+
+
+class IngestItemModel(QtCore.QAbstractTableModel):
+    """
+    Table model holding the scanned items of a delivery.
+
+    Scanned items are appended in batches as they arrive, but rows are only
+    exposed to views in pages through canFetchMore/fetchMore, as the view is
+    scrolled. Nothing is computed per row up front; display strings are built
+    on demand in data(), so the cost of a batch is independent of what the
+    view shows and the model never needs a full reset while a scan is running.
+
+    Sorting and filtering are done by the model itself, over all items rather
+    than only the rows exposed so far, which is all a proxy model would see.
+    Pages fetched later on are thus always added below the rows already shown.
+    Items arriving while sorted are inserted where they belong; those landing
+    among the exposed rows are shown straight away. The verify and ingest
+    columns sort by the statuses the items had when the sort was applied.
+    """
+
+    (COLUMN_NAME, COLUMN_FRAMES, COLUMN_FILES, COLUMN_SIZE,
+     COLUMN_VERIFY, COLUMN_INGEST, COLUMN_FOLDER) = range(7)
+
+    HEADERS = ("Name", "Frames", "Files", "Size", "Verify", "Ingest", "Folder")
+
+    # role returning raw values, used for sorting
+    SORT_ROLE = QtCore.Qt.UserRole + 1
+    # role returning the ScanItem of a row
+    ITEM_ROLE = QtCore.Qt.UserRole + 2
+
+    # number of rows exposed per fetchMore call
+    FETCH_SIZE = 1000
+
+    # number of thumbnails kept in memory. Evicted thumbnails are requested
+    # again when they are next displayed, which is cheap thanks to the disk cache.
+    MAX_THUMBNAILS = 2000
+
+    def __init__(self, parent=None):
+        """
+        Constructor
+        """
+        QtCore.QAbstractTableModel.__init__(self, parent)
+        self._root = ""
+        # all items, in the order they were scanned
+        self._items = []
+        # items passing the filter, in display order, and their sort keys
+        self._view = []
+        self._keys = []
+        # row of every item in the view, rebuilt on demand once rows moved
+        self._rows = {}
+        self._fetched = 0
+        self._sort_column = None
+        self._sort_order = QtCore.Qt.AscendingOrder
+        self._filter_text = ""
+        self._status = {self.COLUMN_VERIFY: {}, self.COLUMN_INGEST: {}}
+        self._thumbnails = collections.OrderedDict()
+        self._thumbnail_provider = None
+
+    ############################################################################
+    # public interface
+
+    def clear(self, root=""):
+        """
+        Removes all items.
+
+        :param root: Delivery folder the upcoming items are displayed relative to.
+        """
+        self.beginResetModel()
+        self._root = root
+        self._items = []
+        self._view = []
+        self._keys = []
+        self._rows = {}
+        self._fetched = 0
+        for statuses in self._status.values():
+            statuses.clear()
+        self._thumbnails.clear()
+        self.endResetModel()
+
+    def append_items(self, items):
+        """
+        Adds a batch of scanned items.
+
+        Only the first page of rows is exposed right away. Further rows become
+        visible as views request them through fetchMore.
+        """
+        self._items.extend(items)
+        accepted = [item for item in items if self._accepts(item)]
+        if self._sort_column is None:
+            if self._rows is not None:
+                for row, item in enumerate(accepted, len(self._view)):
+                    self._rows[id(item)] = row
+            self._view.extend(accepted)
+        else:
+            for item in accepted:
+                key = self._sort_key(item)
+                row = bisect.bisect_right(self._keys, key)
+                exposed = row < self._fetched
+                if exposed:
+                    self.beginInsertRows(QtCore.QModelIndex(), row, row)
+                self._view.insert(row, item)
+                self._keys.insert(row, key)
+                self._rows = None
+                if exposed:
+                    self._fetched += 1
+                    self.endInsertRows()
+        if self._fetched < self.FETCH_SIZE:
+            self.fetchMore(QtCore.QModelIndex())
+
+    def set_filter_text(self, text):
+        """
+        Shows only items whose path contains the given text, case insensitively.
+        """
+        text = text.strip().lower()
+        if text == self._filter_text:
+            return
+        self._filter_text = text
+        self._rebuild_view()
+
+    def items(self):
+        """
+        Returns all items, including the ones not yet fetched by a view.
+        """
+        return list(self._items)
+
+    def item_count(self):
+        """
+        Returns the number of items, including the ones not yet fetched by a view.
+        """
+        return len(self._items)
+
+    def set_status(self, item, column, status):
+        """
+        Sets the verify or ingest status shown for an item.
+
+        :param item: ScanItem held by this model.
+        :param column: Either COLUMN_VERIFY or COLUMN_INGEST.
+        :param status: Status string.
+        """
+        self._status[column][id(item)] = status
+        row = self._row(item)
+        if row is not None and row < self._fetched:
+            index = self.index(row, column)
+            self.dataChanged.emit(index, index)
+
+    def clear_status(self, column):
+        """
+        Clears the verify or ingest status of all items.
+        """
+        self._status[column].clear()
+        if self._fetched:
+            self.dataChanged.emit(self.index(0, column), self.index(self._fetched - 1, column))
+
+    def set_thumbnail_provider(self, provider):
+        """
+        Sets the callable asked for the thumbnail of an item that is displayed
+        without one. It is expected to call set_thumbnail later on, once the
+        thumbnail is available. Since views only query rows they are about to
+        paint, thumbnails are only ever requested for visible rows.
+
+        :param provider: Callable accepting a ScanItem, or None.
+        """
+        self._thumbnail_provider = provider
+
+    def set_thumbnail(self, item, pixmap):
+        """
+        Sets the thumbnail displayed next to the name of an item.
+
+        :param item: ScanItem held by this model.
+        :param pixmap: QPixmap, or None if no thumbnail could be generated.
+        """
+        row = self._row(item)
+        if row is None or self._view[row] is not item:
+            # rendered for an item of a previous scan, or one filtered out since.
+            # Thumbnails are keyed by id, which a later item may reuse.
+            return
+        self._thumbnails[id(item)] = pixmap
+        self._thumbnails.move_to_end(id(item))
+        while len(self._thumbnails) > self.MAX_THUMBNAILS:
+            self._thumbnails.popitem(last=False)
+        if row < self._fetched:
+            index = self.index(row, self.COLUMN_NAME)
+            self.dataChanged.emit(index, index)
+
+    def status(self, item, column):
+        """
+        Returns the verify or ingest status of an item, or an empty string.
+        """
+        return self._status[column].get(id(item), "")
+
+    ############################################################################
+    # QAbstractItemModel overrides
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return self._fetched
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.HEADERS)
+
+    def canFetchMore(self, parent):
+        if parent.isValid():
+            return False
+        return self._fetched < len(self._view)
+
+    def fetchMore(self, parent):
+        if parent.isValid():
+            return
+        count = min(self.FETCH_SIZE, len(self._view) - self._fetched)
+        if count <= 0:
+            return
+        self.beginInsertRows(QtCore.QModelIndex(), self._fetched, self._fetched + count - 1)
+        self._fetched += count
+        self.endInsertRows()
+
+    def sort(self, column, order=QtCore.Qt.AscendingOrder):
+        if column < 0:
+            column = None
+        self._sort_column = column
+        self._sort_order = order
+        self._rebuild_view()
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if orientation == QtCore.Qt.Horizontal and role == QtCore.Qt.DisplayRole:
+            return self.HEADERS[section]
+        return None
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid() or index.row() >= self._fetched:
+            return None
+        item = self._view[index.row()]
+        column = index.column()
+
+        if role == QtCore.Qt.DisplayRole:
+            return self._display_data(item, column)
+        if role == self.SORT_ROLE:
+            return self._sort_data(item, column)
+        if role == self.ITEM_ROLE:
+            return item
+        if role == QtCore.Qt.DecorationRole and column == self.COLUMN_NAME:
+            return self._thumbnail(item)
+        if role == QtCore.Qt.ToolTipRole:
+            return self._tooltip(item)
+        if role == QtCore.Qt.TextAlignmentRole and column in (self.COLUMN_FILES, self.COLUMN_SIZE):
+            return int(QtCore.Qt.AlignRight | QtCore.Qt.AlignVCenter)
+        return None
+
+    ############################################################################
+    # internals
+
+    def _accepts(self, item):
+        """
+        True if an item passes the filter.
+        """
+        return not self._filter_text or self._filter_text in item.path.lower()
+
+    def _sort_key(self, item):
+        """
+        Returns the key an item is sorted by, in the current column and order.
+        """
+        key = self._sort_data(item, self._sort_column)
+        if self._sort_order == QtCore.Qt.DescendingOrder:
+            return _Descending(key)
+        return key
+
+    def _rebuild_view(self):
+        """
+        Filters and sorts all items again. As many rows as were exposed before,
+        and at least one page, are exposed afterwards.
+        """
+        self.beginResetModel()
+        view = [item for item in self._items if self._accepts(item)]
+        if self._sort_column is None:
+            self._keys = []
+        else:
+            keyed = sorted(((self._sort_key(item), idx), item) for idx, item in enumerate(view))
+            view = [item for _, item in keyed]
+            self._keys = [key for (key, _), _ in keyed]
+        self._view = view
+        self._rows = None
+        self._fetched = min(len(view), max(self._fetched, self.FETCH_SIZE))
+        self.endResetModel()
+
+    def _row(self, item):
+        """
+        Returns the row of an item in the view, or None if it is filtered out.
+        """
+        if self._rows is None:
+            self._rows = dict((id(view_item), row) for row, view_item in enumerate(self._view))
+        return self._rows.get(id(item))
+
+    def _display_data(self, item, column):
+        """
+        Returns the text displayed for an item in a column.
+        """
+        if column == self.COLUMN_NAME:
+            return item.name
+        if column == self.COLUMN_FRAMES:
+            if item.is_sequence:
+                return "%d-%d" % (item.frames[0], item.frames[-1])
+            return ""
+        if column == self.COLUMN_FILES:
+            return str(item.file_count)
+        if column == self.COLUMN_SIZE:
+            return format_size(item.size)
+        if column in self._status:
+            return self._status[column].get(id(item), "")
+        if column == self.COLUMN_FOLDER:
+            return self._relative_folder(item)
+        return None
+
+    def _thumbnail(self, item):
+        """
+        Returns the thumbnail of an item, requesting it if it is not available yet.
+        """
+        if id(item) in self._thumbnails:
+            return self._thumbnails[id(item)]
+        if self._thumbnail_provider:
+            self._thumbnail_provider(item)
+        return None
+
+    def _sort_data(self, item, column):
+        """
+        Returns the raw value of an item in a column, so that numbers sort as numbers.
+        """
+        if column == self.COLUMN_FRAMES:
+            return item.frames[0] if item.is_sequence else -1
+        if column == self.COLUMN_FILES:
+            return item.file_count
+        if column == self.COLUMN_SIZE:
+            return item.size
+        return self._display_data(item, column)
+
+    def _tooltip(self, item):
+        """
+        Returns the tooltip of an item, its full path and any missing frames.
+        """
+        tooltip = item.path
+        missing = item.missing_frames
+        if missing:
+            shown = ", ".join(str(frame) for frame in missing[:20])
+            if len(missing) > 20:
+                shown += ", ..."
+            tooltip += "\n%d missing frames: %s" % (len(missing), shown)
+        return tooltip
+
+    def _relative_folder(self, item):
+        """
+        Returns the folder of an item relative to the delivery root.
+        """
+        if not self._root:
+            return item.directory
+        return os.path.relpath(item.directory, self._root)
+
+
+class _Descending(object):
+    """
+    Sort key wrapper reversing the order of the wrapped key.
+    """
+
+    __slots__ = ("key",)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+    def __eq__(self, other):
+        return self.key == other.key
@@ -0,0 +1,564 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Headless ingest pipeline: scan, verify, copy and register a delivery without Qt.
+
+This is what the ingest_delivery command runs, on the farm or from a shell.
+Progress is reported as a stream of events, which JsonLinesReporter writes out
+as one JSON object per line. A delivery can be split into shards, so that
+several machines can each ingest part of it in parallel.
+"""
+
+import copy
+import fnmatch
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+import zlib
+
+from .scanner import ScanEngine
+from .scan_index import ScanIndex
+from .verify import VerifyEngine, scanned_manifests, STATUS_OK, STATUS_UNVERIFIED
+from .copier import CopyEngine, CopyJournal, TemplateDestinationResolver, STATUS_ERROR as COPY_ERROR
+from .registration import (
+    BatchRegistrar, IngestRegistration, find_or_create_published_file_type, path_cache_resolver,
+    STATUS_EXISTING as REGISTER_EXISTING,
+)
+from .stats import PipelineStats, ShotgunCallCounter
+
+# rules used for anything not set in a rule file. Settings of the app, where
+# available, take precedence over these.
+DEFAULT_RULES = {
+    "include": ["*"],
+    "exclude": ["*.md5", "*.mhl", "*.part"],
+    "scan": {
+        "threads": 8,
+        "cache": True,
+        "cache_max_mb": 256,
+    },
+    "verify": {
+        "enabled": True,
+        "algorithm": "md5",
+        "workers": 0,
+        "read_buffer_mb": 8,
+        "use_mmap": True,
+        # hash in worker processes rather than threads, where possible
+        "processes": True,
+        # items with mismatching or unreadable files are not copied
+        "skip_failed": True,
+    },
+    "copy": {
+        "enabled": True,
+        # name of the template to resolve destinations with. Defaults to the
+        # app's ingest_template setting.
+        "template": None,
+        "workers": 4,
+        "bandwidth_mb": 0,
+        "chunk_mb": 16,
+    },
+    "register": {
+        "enabled": True,
+        "published_file_type": "Ingested File",
+        "batch_size": 100,
+        "max_retries": 3,
+    },
+}
+
+# app settings mapped to the rule they provide the default for
+_SETTING_RULES = {
+    "scan_threads": ("scan", "threads"),
+    "scan_cache_enabled": ("scan", "cache"),
+    "scan_cache_max_mb": ("scan", "cache_max_mb"),
+    "verify_hash_algorithm": ("verify", "algorithm"),
+    "verify_workers": ("verify", "workers"),
+    "verify_read_buffer_mb": ("verify", "read_buffer_mb"),
+    "verify_use_mmap": ("verify", "use_mmap"),
+    "copy_workers": ("copy", "workers"),
+    "copy_bandwidth_mb": ("copy", "bandwidth_mb"),
+    "copy_chunk_mb": ("copy", "chunk_mb"),
+    "register_in_shotgun": ("register", "enabled"),
+    "published_file_type": ("register", "published_file_type"),
+    "shotgun_batch_size": ("register", "batch_size"),
+    "shotgun_max_retries": ("register", "max_retries"),
+}
+
+
+def load_rules(path=None, app=None):
+    """
+    Loads an ingest rule file and fills in defaults.
+
+    Rule files are JSON, or YAML if their extension is .yml or .yaml. They use the
+    layout of DEFAULT_RULES; any section or value left out keeps its default.
+
+    :param path: Rule file, or None to only use defaults.
+    :param app: Optional app instance whose settings provide the defaults.
+    :returns: Rules dictionary.
+    """
+    rules = copy.deepcopy(DEFAULT_RULES)
+    if app is not None:
+        for setting, (section, key) in _SETTING_RULES.items():
+            rules[section][key] = app.get_setting(setting)
+
+    if path is None:
+        return rules
+
+    with open(path, "r") as fh:
+        if os.path.splitext(path)[1].lower() in (".yml", ".yaml"):
+            try:
+                import yaml
+            except ImportError:
+                from tank_vendor import yaml
+            data = yaml.safe_load(fh) or {}
+        else:
+            data = json.load(fh)
+
+    for key, value in data.items():
+        if isinstance(value, dict) and isinstance(rules.get(key), dict):
+            rules[key].update(value)
+        else:
+            rules[key] = value
+    return rules
+
+
+def shard_of(item, root, shard_count):
+    """
+    Returns the shard an item belongs to.
+
+    Shards are assigned by a checksum of the item's path relative to the delivery,
+    so every machine computes the same assignment independently of where the
+    delivery is mounted and of the order in which items were scanned.
+    """
+    relative = os.path.relpath(item.path, root).replace(os.sep, "/")
+    return zlib.crc32(relative.encode("utf-8")) % shard_count
+
+
+class JsonLinesReporter(object):
+    """
+    Writes pipeline events to a stream, one JSON object per line.
+    """
+
+    def __init__(self, stream=None):
+        """
+        Constructor
+
+        :param stream: File like object to write to. Defaults to stdout.
+        """
+        self._stream = stream or sys.stdout
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        event = dict(event)
+        event.setdefault("time", time.time())
+        line = json.dumps(event, sort_keys=True, default=str)
+        with self._lock:
+            self._stream.write(line + "\n")
+            self._stream.flush()
+
+
+class IngestPipeline(object):
+    """
+    Runs scan, verify, copy and register on a delivery, in that order.
+
+    Every stage is optional: copying requires a destination resolver, and
+    registration requires a Shotgun connection. Only items copied into the
+    project are registered, so registration is skipped if copying is. Events are passed to the
+    reporter as dictionaries with an "event" key; see run() for the sequence.
+    """
+
+    def __init__(self, delivery_path, rules=None, resolver=None, shotgun=None,
+                 context_fields=None, published_file_entity_type="PublishedFile",
+                 cache_location=None, reporter=None, shard_index=0, shard_count=1, stats=None,
+                 path_cache_fields=None):
+        """
+        Constructor
+
+        :param delivery_path: Delivery folder to ingest.
+        :param rules: Rules dictionary, as returned by load_rules.
+        :param resolver: Callable returning the (source, destination) pairs of a
+                         ScanItem, such as a TemplateDestinationResolver. If None,
+                         nothing is copied.
+        :param shotgun: Shotgun connection to register with. If None, nothing is registered.
+        :param context_fields: Dictionary with the project, entity and task links
+                               to register against.
+        :param published_file_entity_type: Either PublishedFile or TankPublishedFile.
+        :param cache_location: Folder for the scan index and copy journals. If
+                               None, neither is used.
+        :param reporter: Callable receiving event dictionaries.
+        :param shard_index: Shard of the delivery this pipeline processes.
+        :param shard_count: Number of shards the delivery is split into.
+        :param stats: PipelineStats to record stage timings and counters in.
+                      Defaults to a new instance.
+        :param path_cache_fields: Optional callable returning the path_cache and
+                                  path_cache_storage fields of a published file
+                                  from its path, such as returned by
+                                  path_cache_resolver.
+        """
+        if not 0 <= shard_index < shard_count:
+            raise ValueError("Invalid shard %d of %d" % (shard_index, shard_count))
+
+        self._root = os.path.abspath(delivery_path)
+        self._rules = rules or load_rules()
+        self._resolver = resolver
+        self._shotgun = shotgun
+        self._context_fields = context_fields or {}
+        self._published_file_entity_type = published_file_entity_type
+        self._cache_location = cache_location
+        self._report = reporter or (lambda event: None)
+        self._shard_index = shard_index
+        self._shard_count = shard_count
+        self._stats = stats or PipelineStats()
+        self._path_cache_fields = path_cache_fields
+        self._cancelled = threading.Event()
+        self._engine = None
+        self._manifest_paths = []
+
+    @property
+    def stats(self):
+        """
+        PipelineStats holding the timings and counters of every stage run so far.
+        """
+        return self._stats
+
+    def cancel(self):
+        """
+        Stops the pipeline after the current stage has been wound down.
+        """
+        self._cancelled.set()
+        engine = self._engine
+        if engine is not None:
+            engine.cancel()
+
+    def run(self):
+        """
+        Runs all stages in the calling thread.
+
+        Emits "start", then "stage_start", "progress", "item" and "stage_end"
+        events for every stage that runs, and finally "done" with a summary.
+        Every "stage_end" event carries the stage's timings and derived metrics
+        as "metrics".
+
+        :returns: Summary dictionary, with the stats of every stage that ran, the
+                  number of items that made it through all of them and a
+                  snapshot of the pipeline stats.
+        """
+        summary = {"delivery": self._root, "shard": self._shard_index, "shards": self._shard_count}
+        self._report({
+            "event": "start", "delivery": self._root,
+            "shard": self._shard_index, "shards": self._shard_count,
+        })
+
+        items = self._scan(summary)
+        if self._rules["verify"]["enabled"] and items and not self._cancelled.is_set():
+            items = self._verify(items, summary)
+        if self._rules["copy"]["enabled"] and self._resolver and items and not self._cancelled.is_set():
+            items = self._copy(items, summary)
+        if (self._rules["register"]["enabled"] and self._shotgun is not None
+                and items and not self._cancelled.is_set()):
+            if "copy" in summary:
+                items = self._register(items, summary)
+            else:
+                # registering would publish the files where they were delivered
+                self._report({
+                    "event": "error", "stage": "register", "path": self._root,
+                    "message": "Nothing was copied into the project, so nothing is registered.",
+                })
+                items = []
+
+        summary["ingested"] = len(items)
+        summary["cancelled"] = self._cancelled.is_set()
+        summary["stats"] = self._stats.snapshot()
+        self._report({"event": "done", "summary": summary})
+        return summary
+
+    ############################################################################
+    # stages
+
+    def _scan(self, summary):
+        """
+        Scans the delivery and returns the items of this shard that pass the rules.
+        """
+        self._report({"event": "stage_start", "stage": "scan"})
+        rules = self._rules["scan"]
+        index = None
+        if rules["cache"] and self._cache_location:
+            index = ScanIndex(
+                os.path.join(self._cache_location, "scan_index.db"), rules["cache_max_mb"] * 1024 * 1024
+            )
+
+        items = []
+        manifests = self._manifest_paths = []
+        lock = threading.Lock()
+
+        def on_batch(batch):
+            accepted = [item for item in batch if self._accepts(item)]
+            # manifests are collected from every item, whatever the rules and
+            # shards, since any of them may cover the accepted items
+            found = scanned_manifests(batch)
+            with lock:
+                items.extend(accepted)
+                manifests.extend(found)
+                count = len(items)
+            self._report({"event": "progress", "stage": "scan", "items": count})
+
+        engine = ScanEngine(
+            self._root, on_batch, num_workers=rules["threads"], index=index,
+            error_callback=lambda path, e: self._report({
+                "event": "error", "stage": "scan", "path": path, "message": str(e)
+            }),
+        )
+        self._engine = engine
+        stage = self._stats.stage("scan")
+        stage.start(lambda: engine.stats)
+        try:
+            engine.start()
+            engine.wait()
+        finally:
+            self._engine = None
+            stage.stop()
+            if index is not None:
+                index.close()
+
+        # the scan engine delivers items in completion order. Sorting makes the
+        # order of all following stages deterministic.
+        items.sort(key=lambda item: item.path)
+        stats = engine.stats
+        stats["selected_items"] = len(items)
+        summary["scan"] = stats
+        self._report({"event": "stage_end", "stage": "scan", "stats": stats, "metrics": stage.snapshot()})
+        return items
+
+    def _verify(self, items, summary):
+        """
+        Verifies all items and returns the ones allowed to continue.
+        """
+        self._report({"event": "stage_start", "stage": "verify"})
+        rules = self._rules["verify"]
+        statuses = {}
+
+        def on_item(item, status, results):
+            statuses[id(item)] = status
+            self._report({"event": "item", "stage": "verify", "path": item.path, "status": status})
+
+        engine = VerifyEngine(
+            items,
+            algorithm=rules["algorithm"],
+            manifest_paths=sorted(self._manifest_paths),
+            num_workers=rules["workers"],
+            buffer_size=rules["read_buffer_mb"] * 1024 * 1024,
+            use_mmap=rules["use_mmap"],
+            use_processes=rules["processes"],
+            item_callback=on_item,
+            progress_callback=lambda progress: self._report(
+                {"event": "progress", "stage": "verify", "progress": progress}
+            ),
+        )
+        self._engine = engine
+        stage = self._stats.stage("verify")
+        stage.start(lambda: engine.progress)
+        try:
+            progress = engine.run()
+        finally:
+            self._engine = None
+            stage.stop()
+
+        summary["verify"] = progress
+        for path, message in engine.manifest.errors:
+            self._report({"event": "error", "stage": "verify", "path": path, "message": message})
+        if progress["process_pool_failed"]:
+            self._report({
+                "event": "error", "stage": "verify", "path": self._root,
+                "message": "Hashing worker processes failed, hashed in threads instead. Scripts "
+                           "running the pipeline must guard their entry point with if __name__ == \"__main__\".",
+            })
+        summary["verify"]["manifests"] = engine.manifest.sources
+        self._report({
+            "event": "stage_end", "stage": "verify", "stats": summary["verify"], "metrics": stage.snapshot()
+        })
+
+        if not rules["skip_failed"]:
+            return [item for item in items if id(item) in statuses]
+        return [
+            item for item in items
+            if statuses.get(id(item)) in (STATUS_OK, STATUS_UNVERIFIED)
+        ]
+
+    def _copy(self, items, summary):
+        """
+        Copies all items into place and returns the ones that were copied successfully.
+        """
+        self._report({"event": "stage_start", "stage": "copy"})
+        rules = self._rules["copy"]
+
+        journal = None
+        if self._cache_location:
+            # one journal per delivery and shard, so shards never share a file
+            key = hashlib.md5(
+                ("%s|%d/%d" % (self._root, self._shard_index, self._shard_count)).encode("utf-8")
+            ).hexdigest()
+            journal = CopyJournal(os.path.join(self._cache_location, "copy_journals", "%s.jsonl" % key))
+
+        statuses = {}
+
+        def on_item(item, status, errors):
+            statuses[id(item)] = status
+            self._report({"event": "item", "stage": "copy", "path": item.path, "status": status})
+            for path, message in errors:
+                self._report({"event": "error", "stage": "copy", "path": path, "message": message})
+
+        engine = CopyEngine(
+            items,
+            self._resolver,
+            journal=journal,
+            num_workers=rules["workers"],
+            bandwidth=rules["bandwidth_mb"] * 1024 * 1024,
+            chunk_size=rules["chunk_mb"] * 1024 * 1024,
+            item_callback=on_item,
+            progress_callback=lambda progress: self._report(
+                {"event": "progress", "stage": "copy", "progress": progress}
+            ),
+        )
+        self._engine = engine
+        stage = self._stats.stage("copy")
+        stage.start(lambda: engine.progress)
+        try:
+            progress = engine.run()
+        finally:
+            self._engine = None
+            stage.stop()
+
+        summary["copy"] = progress
+        self._report({"event": "stage_end", "stage": "copy", "stats": progress, "metrics": stage.snapshot()})
+        return [item for item in items if statuses.get(id(item), COPY_ERROR) != COPY_ERROR]
+
+    def _register(self, items, summary):
+        """
+        Registers all items in Shotgun and returns the ones registered successfully.
+        """
+        self._report({"event": "stage_start", "stage": "register"})
+        rules = self._rules["register"]
+        shotgun = ShotgunCallCounter(self._shotgun)
+        registrar = BatchRegistrar(
+            shotgun, chunk_size=rules["batch_size"], max_retries=rules["max_retries"]
+        )
+        stage = self._stats.stage("register")
+        stage.start(lambda: dict(
+            registrar.stats, items=len(items), queued=len(registrar), shotgun_calls=shotgun.call_count
+        ))
+        try:
+            published_file_type = find_or_create_published_file_type(
+                shotgun, self._published_file_entity_type, rules["published_file_type"]
+            )
+            registration = IngestRegistration(
+                registrar, self._context_fields, self._published_file_entity_type,
+                published_file_type, description="Ingested from %s" % self._root,
+                path_cache_fields=self._path_cache_fields,
+            )
+            path_for_item = getattr(self._resolver, "destination_path", None)
+            results = registration.register(items, path_for_item)
+        finally:
+            stage.stop()
+
+        registered = []
+        existing = 0
+        for item, status, version, publish, error in results:
+            if error is None:
+                registered.append(item)
+                existing += status == REGISTER_EXISTING
+                self._report({
+                    "event": "item", "stage": "register", "path": item.path, "status": status,
+                    "version": version["id"], "published_file": publish["id"],
+                })
+            else:
+                self._report({"event": "error", "stage": "register", "path": item.path, "message": str(error)})
+
+        stats = dict(registrar.stats)
+        stats["shotgun_calls"] = shotgun.call_count
+        stats["registered"] = len(registered)
+        stats["existing"] = existing
+        summary["register"] = stats
+        self._report({"event": "stage_end", "stage": "register", "stats": stats, "metrics": stage.snapshot()})
+        return registered
+
+    def _accepts(self, item):
+        """
+        True if an item belongs to this shard and passes the include and exclude rules.
+        """
+        name = item.name
+        if not any(fnmatch.fnmatch(name, pattern) for pattern in self._rules["include"]):
+            return False
+        if any(fnmatch.fnmatch(name, pattern) for pattern in self._rules["exclude"]):
+            return False
+        return self._shard_count == 1 or shard_of(item, self._root, self._shard_count) == self._shard_index
+
+
+def run_ingest(app, delivery_path, rules_path=None, shard_index=0, shard_count=1, stream=None):
+    """
+    Runs the ingest pipeline for a toolkit app instance, without any UI.
+
+    Destinations are resolved from the template named in the rules, or the app's
+    ingest_template setting, using the fields of the app's current context.
+    Items are registered against that context with the app's Shotgun connection.
+
+    :param app: Application instance.
+    :param delivery_path: Delivery folder to ingest.
+    :param rules_path: Optional JSON or YAML rule file.
+    :param shard_index: Shard of the delivery to process.
+    :param shard_count: Number of shards the delivery is split into.
+    :param stream: Stream progress is written to as line delimited JSON. Defaults to stdout.
+    :returns: Summary dictionary, as returned by IngestPipeline.run.
+    """
+    import sgtk
+
+    rules = load_rules(rules_path, app)
+
+    template_name = rules["copy"].get("template")
+    if template_name:
+        template = app.get_template_by_name(template_name)
+        if template is None:
+            raise sgtk.TankError("Unknown template '%s' in rule file %s" % (template_name, rules_path))
+    else:
+        template = app.get_template("ingest_template")
+
+    resolver = None
+    if template is not None:
+        resolver = TemplateDestinationResolver(template, app.context.as_template_fields(template))
+    elif rules["copy"]["enabled"]:
+        app.log_warning("No ingest template configured, files will be neither copied nor registered.")
+
+    path_cache_fields = None
+    if rules["register"]["enabled"] and resolver is not None:
+        path_cache_fields = path_cache_resolver(app.tk, app.shotgun)
+
+    context = app.context
+    pipeline = IngestPipeline(
+        delivery_path,
+        rules,
+        resolver=resolver,
+        shotgun=app.shotgun,
+        context_fields={"project": context.project, "entity": context.entity, "task": context.task},
+        published_file_entity_type=sgtk.util.get_published_file_entity_type(app.tk),
+        cache_location=app.cache_location,
+        reporter=JsonLinesReporter(stream),
+        shard_index=shard_index,
+        shard_count=shard_count,
+        path_cache_fields=path_cache_fields,
+    )
+    summary = pipeline.run()
+    pipeline.stats.log(app.log_debug, summary["stats"])
+    app.log_info(
+        "Ingested %d items from %s (shard %d of %d)" % (
+            summary["ingested"], delivery_path, shard_index + 1, shard_count
+        )
+    )
+    return summary
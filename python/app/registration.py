@@ -0,0 +1,553 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Batched registration of ingested items in Shotgun.
+
+Rather than creating every Version and published file with its own API call,
+creates and updates are queued up and sent through Shotgun's batch() call in
+chunks. Chunks lost to connection failures are retried after an exponential
+backoff, and chunks rejected by the server are split up to isolate the requests
+at fault.
+"""
+
+import os
+import time
+
+from .copier import VERSION_REGEX
+
+# errors raised when the connection to the server fails, as opposed to the
+# Fault raised when the server rejects a request. shotgun_api3 is only
+# available when running in toolkit.
+try:
+    from tank_vendor.shotgun_api3 import ProtocolError
+except ImportError:
+    TRANSPORT_ERRORS = (OSError,)
+else:
+    TRANSPORT_ERRORS = (OSError, ProtocolError)
+
+# item outcomes reported by IngestRegistration
+STATUS_REGISTERED = "registered"
+STATUS_EXISTING = "already registered"
+STATUS_FAILED = "failed"
+
+
+class PendingRequest(object):
+    """
+    A queued create or update. Once the registrar has been flushed, either
+    result or error is set.
+    """
+
+    def __init__(self, request, key_field=None):
+        self.request = request
+        self.key_field = key_field
+        self.result = None
+        self.error = None
+
+    @property
+    def done(self):
+        """
+        True once the request has been sent, successfully or not.
+        """
+        return self.result is not None or self.error is not None
+
+
+class BatchRegistrar(object):
+    """
+    Queues Shotgun creates and updates and sends them in batches.
+
+    Shotgun applies a batch as a single transaction. When the server rejects a
+    chunk, nothing of it has been applied, but sending it again would fail the
+    same way. Instead, the chunk is split in halves which are sent separately,
+    down to the single requests at fault, which are marked as failed.
+
+    When the connection fails, the server may or may not have applied the
+    chunk before the failure. Before the chunk is sent again, the creates it
+    holds are looked up by their key field: if they exist, the chunk was
+    applied and their results are taken from the lookup. Chunks with creates
+    queued without a key field cannot be checked, and are marked as failed
+    rather than risking creating the entities twice.
+    """
+
+    def __init__(self, shotgun, chunk_size=100, max_retries=3, backoff=1.0, max_backoff=30.0,
+                 retry_exceptions=TRANSPORT_ERRORS, sleep=time.sleep):
+        """
+        Constructor
+
+        :param shotgun: Shotgun API connection, or a MockShotgun.
+        :param chunk_size: Maximum number of requests sent in a single batch call.
+        :param max_retries: Number of times a failed chunk is sent again before
+                            its requests are marked as failed.
+        :param backoff: Seconds to wait before the first retry. The wait doubles
+                        with every further retry of the same chunk.
+        :param max_backoff: Upper limit of the wait between retries.
+        :param retry_exceptions: Exception types raised when the connection to the
+                                 server fails, after which a chunk is retried.
+                                 Other exceptions are taken as the server
+                                 rejecting the chunk.
+        :param sleep: Function used to wait between retries.
+        """
+        self._sg = shotgun
+        self._chunk_size = max(1, chunk_size)
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._retry_exceptions = retry_exceptions
+        self._sleep = sleep
+        self._queue = []
+
+        self.stats = {
+            "batch_calls": 0,
+            "requests": 0,
+            "retries": 0,
+            "splits": 0,
+            "failed": 0,
+        }
+
+    @property
+    def shotgun(self):
+        """
+        Shotgun connection the requests are sent to.
+        """
+        return self._sg
+
+    def __len__(self):
+        return len(self._queue)
+
+    def create(self, entity_type, data, return_fields=None, key_field=None):
+        """
+        Queues an entity create.
+
+        :param entity_type: Type of the entity to create.
+        :param data: Field values of the entity.
+        :param return_fields: Additional fields to return.
+        :param key_field: Field of data whose value no other entity of the type
+                          has, used to find out whether the entity was created
+                          when the connection failed during the batch call.
+        :returns: PendingRequest holding the created entity after the next flush.
+        """
+        request = {"request_type": "create", "entity_type": entity_type, "data": data}
+        if return_fields:
+            request["return_fields"] = return_fields
+        return self._enqueue(request, key_field)
+
+    def update(self, entity_type, entity_id, data):
+        """
+        Queues an entity update.
+
+        :returns: PendingRequest holding the update result after the next flush.
+        """
+        return self._enqueue({
+            "request_type": "update", "entity_type": entity_type,
+            "entity_id": entity_id, "data": data,
+        })
+
+    def flush(self):
+        """
+        Sends all queued requests, in chunks.
+
+        :returns: List of PendingRequests that failed after all retries.
+        """
+        queue, self._queue = self._queue, []
+        failed = []
+        for start in range(0, len(queue), self._chunk_size):
+            chunk = queue[start:start + self._chunk_size]
+            failed.extend(self._send_chunk(chunk))
+        return failed
+
+    def _enqueue(self, request, key_field=None):
+        pending = PendingRequest(request, key_field)
+        self._queue.append(pending)
+        return pending
+
+    def _send_chunk(self, chunk):
+        """
+        Sends a chunk of requests, retrying connection failures with exponential
+        backoff and splitting up chunks rejected by the server.
+
+        :returns: The requests of the chunk that ultimately failed.
+        """
+        attempt = 0
+        lost = None
+        while True:
+            try:
+                if lost is not None:
+                    # the last call failed in transit, possibly after the server
+                    # applied the chunk
+                    applied = self._find_applied(chunk)
+                    if applied:
+                        return []
+                    if applied is None:
+                        return self._fail(chunk, lost)
+                self.stats["batch_calls"] += 1
+                results = self._sg.batch([pending.request for pending in chunk])
+            except self._retry_exceptions as e:
+                lost = e
+                if attempt >= self._max_retries:
+                    return self._fail(chunk, e)
+                self._sleep(min(self._max_backoff, self._backoff * (2 ** attempt)))
+                attempt += 1
+                self.stats["retries"] += 1
+                continue
+            except Exception as e:
+                if len(chunk) == 1:
+                    return self._fail(chunk, e)
+                self.stats["splits"] += 1
+                half = len(chunk) // 2
+                return self._send_chunk(chunk[:half]) + self._send_chunk(chunk[half:])
+
+            self.stats["requests"] += len(chunk)
+            for pending, result in zip(chunk, results):
+                pending.result = result
+            return []
+
+    def _fail(self, chunk, error):
+        """
+        Marks the requests of a chunk as failed.
+
+        :returns: The chunk.
+        """
+        self.stats["failed"] += len(chunk)
+        for pending in chunk:
+            pending.error = error
+        return chunk
+
+    def _find_applied(self, chunk):
+        """
+        Finds out whether a chunk was applied by looking up its creates by their
+        key fields. As the chunk was applied as a whole or not at all, the
+        creates tell for the entire chunk. If it was applied, the results of
+        its requests are set.
+
+        :returns: True if the chunk was applied, False if it was not or holds no
+                  creates, as updates and deletes can be sent again, or None if
+                  it cannot be told, because a create has no key field or only
+                  some of the creates exist.
+        """
+        keyed = {}
+        for pending in chunk:
+            request = pending.request
+            if request["request_type"] == "create":
+                if not pending.key_field:
+                    return None
+                key = (request["entity_type"], pending.key_field)
+                keyed.setdefault(key, []).append(pending)
+        if not keyed:
+            return False
+
+        found = {}
+        for (entity_type, key_field), requests in keyed.items():
+            values = [pending.request["data"][key_field] for pending in requests]
+            for entity in self._sg.find(entity_type, [[key_field, "in", values]], [key_field]):
+                found[(entity_type, _hashable(entity[key_field]))] = entity["id"]
+        expected = sum(len(requests) for requests in keyed.values())
+        if not found:
+            return False
+        if len(found) != expected:
+            return None
+
+        for pending in chunk:
+            request = pending.request
+            if request["request_type"] == "create":
+                result = dict(request["data"])
+                result["type"] = request["entity_type"]
+                value = _hashable(request["data"][pending.key_field])
+                result["id"] = found[(request["entity_type"], value)]
+                for field in request.get("return_fields") or []:
+                    result.setdefault(field, None)
+            elif request["request_type"] == "update":
+                result = dict(request["data"])
+                result.update({"type": request["entity_type"], "id": request["entity_id"]})
+            else:
+                result = True
+            pending.result = result
+        self.stats["requests"] += len(chunk)
+        return True
+
+
+class IngestRegistration(object):
+    """
+    Registers ingested items as Versions with attached published files.
+
+    Versions are created first so that the published files can link to them.
+    Both rounds go through the BatchRegistrar, so registering N items costs
+    roughly 2 * N / chunk_size round trips instead of 2 * N.
+
+    Items registered before, by an earlier run of the same ingest, are looked
+    up by path first and not registered again.
+    """
+
+    # number of paths looked up per find call
+    LOOKUP_CHUNK_SIZE = 500
+
+    def __init__(self, registrar, context_fields, published_file_entity_type="PublishedFile",
+                 published_file_type=None, description="", path_cache_fields=None):
+        """
+        Constructor
+
+        :param registrar: BatchRegistrar to queue the requests with.
+        :param context_fields: Dictionary with the project, entity and task entity
+                               links to register against. Missing or None links
+                               are left out.
+        :param published_file_entity_type: Either PublishedFile or, for older sites,
+                                           TankPublishedFile.
+        :param published_file_type: Published file type entity link, or None.
+        :param description: Description stored on every Version and published file.
+        :param path_cache_fields: Optional callable returning the path_cache and
+                                  path_cache_storage fields of a published file
+                                  from its path, such as returned by
+                                  path_cache_resolver.
+        """
+        self._registrar = registrar
+        self._context_fields = context_fields
+        self._published_file_entity_type = published_file_entity_type
+        self._published_file_type = published_file_type
+        self._description = description
+        self._path_cache_fields = path_cache_fields
+
+    def register(self, items, path_for_item=None):
+        """
+        Creates a Version and a published file for every item, unless they exist
+        already. A Version registered at the path of an item, in the same
+        project, is reused, along with the published file linked to it.
+
+        :param items: List of ScanItems.
+        :param path_for_item: Optional callable returning the path to register for
+                              an item, such as its destination in the project. By
+                              default the scanned path is registered.
+        :returns: List of (item, status, version, published file, error) tuples,
+                  where status is one of the STATUS constants. On failure, error
+                  holds the exception and the entities are None.
+        """
+        path_for_item = path_for_item or (lambda item: item.path)
+        existing = self._find_existing([path_for_item(item) for item in items])
+
+        # the data of the published files is computed up front, so that items
+        # whose path cannot be registered fail before a Version is created.
+        errors = {}
+        publish_data = {}
+        for item in items:
+            try:
+                publish_data[id(item)] = self._publish_data(item, path_for_item(item))
+            except Exception as e:
+                errors[id(item)] = e
+
+        # every item has a path of its own, and every Version one published
+        # file, which identifies the entities should a batch call be lost.
+        versions = {}
+        for item in items:
+            if id(item) not in publish_data:
+                continue
+            version = existing.get(path_for_item(item), (None, None))[0]
+            if version is None:
+                data = self._version_data(item, path_for_item(item))
+                versions[id(item)] = self._registrar.create("Version", data, key_field="sg_path_to_frames")
+        self._registrar.flush()
+
+        publishes = {}
+        for item in items:
+            if id(item) not in publish_data:
+                continue
+            version, publish = existing.get(path_for_item(item), (None, None))
+            if publish is not None:
+                continue
+            if version is None:
+                pending = versions[id(item)]
+                if pending.error is not None:
+                    errors[id(item)] = pending.error
+                    continue
+                version = pending.result
+            data = publish_data[id(item)]
+            data["version"] = {"type": "Version", "id": version["id"]}
+            publishes[id(item)] = self._registrar.create(
+                self._published_file_entity_type, data, key_field="version"
+            )
+        self._registrar.flush()
+
+        results = []
+        for item in items:
+            publish = publishes.get(id(item))
+            if publish is not None and publish.error is not None:
+                errors[id(item)] = publish.error
+            if id(item) in errors:
+                results.append((item, STATUS_FAILED, None, None, errors[id(item)]))
+                continue
+            version, existing_publish = existing.get(path_for_item(item), (None, None))
+            if existing_publish is not None:
+                results.append((item, STATUS_EXISTING, version, existing_publish, None))
+                continue
+            if version is None:
+                version = versions[id(item)].result
+            results.append((item, STATUS_REGISTERED, version, publish.result, None))
+        return results
+
+    def _find_existing(self, paths):
+        """
+        Looks up the Versions registered at any of the given paths, in the project
+        registered against, and the published files linked to them.
+
+        :returns: Dictionary mapping paths to (version, published file) tuples.
+                  The published file is None if the Version has none.
+        """
+        shotgun = self._registrar.shotgun
+        filters = []
+        project = self._links().get("project")
+        if project:
+            filters.append(["project", "is", project])
+
+        versions = {}
+        paths = sorted(set(paths))
+        for start in range(0, len(paths), self.LOOKUP_CHUNK_SIZE):
+            chunk = paths[start:start + self.LOOKUP_CHUNK_SIZE]
+            for version in shotgun.find(
+                "Version", filters + [["sg_path_to_frames", "in", chunk]], ["code", "sg_path_to_frames"]
+            ):
+                versions[version["id"]] = version
+
+        publishes = {}
+        version_ids = sorted(versions)
+        for start in range(0, len(version_ids), self.LOOKUP_CHUNK_SIZE):
+            links = [{"type": "Version", "id": version_id}
+                     for version_id in version_ids[start:start + self.LOOKUP_CHUNK_SIZE]]
+            for publish in shotgun.find(
+                self._published_file_entity_type, [["version", "in", links]], ["code", "version"]
+            ):
+                publishes[publish["version"]["id"]] = publish
+
+        existing = {}
+        for version_id, version in versions.items():
+            path = version["sg_path_to_frames"]
+            publish = publishes.get(version_id)
+            # should the path have been registered more than once, a Version
+            # with a published file is preferred
+            if path not in existing or (publish is not None and existing[path][1] is None):
+                existing[path] = (version, publish)
+        return existing
+
+    def _links(self):
+        """
+        Returns the non-empty context links as entity dictionaries.
+        """
+        links = {}
+        for field in ("project", "entity", "task"):
+            value = self._context_fields.get(field)
+            if value:
+                links[field] = {"type": value["type"], "id": value["id"]}
+        return links
+
+    def _version_data(self, item, path):
+        """
+        Returns the create data for the Version of an item.
+        """
+        links = self._links()
+        data = {"code": _item_code(item), "description": self._description, "sg_path_to_frames": path}
+        data.update((k, v) for k, v in links.items() if k != "task")
+        if "task" in links:
+            data["sg_task"] = links["task"]
+        if item.is_sequence:
+            data["sg_first_frame"] = item.frames[0]
+            data["sg_last_frame"] = item.frames[-1]
+            data["frame_count"] = len(item.frames)
+            data["frame_range"] = "%d-%d" % (item.frames[0], item.frames[-1])
+        return data
+
+    def _publish_data(self, item, path):
+        """
+        Returns the create data for the published file of an item.
+        """
+        code = _item_code(item)
+        data = {
+            "code": code,
+            "name": code,
+            "description": self._description,
+            "path": {"local_path": path},
+        }
+        match = VERSION_REGEX.match(code)
+        if match:
+            data["name"] = match.group("name")
+            data["version_number"] = int(match.group("version"))
+        data.update(self._links())
+        if self._path_cache_fields:
+            data.update(self._path_cache_fields(path))
+        if self._published_file_type:
+            field = "tank_type" if self._published_file_entity_type == "TankPublishedFile" else "published_file_type"
+            data[field] = self._published_file_type
+        return data
+
+
+def find_or_create_published_file_type(shotgun, published_file_entity_type, code):
+    """
+    Returns the published file type entity with the given code, creating it if needed.
+
+    :param shotgun: Shotgun API connection.
+    :param published_file_entity_type: Either PublishedFile or TankPublishedFile.
+    :param code: Name of the published file type.
+    :returns: Entity link dictionary.
+    """
+    type_entity = "TankType" if published_file_entity_type == "TankPublishedFile" else "PublishedFileType"
+    entity = shotgun.find_one(type_entity, [["code", "is", code]])
+    if entity is None:
+        entity = shotgun.create(type_entity, {"code": code})
+    return {"type": entity["type"], "id": entity["id"]}
+
+
+def path_cache_resolver(tk, shotgun):
+    """
+    Returns a callable computing the path_cache and path_cache_storage fields of
+    a published file from its path, the way sgtk.util.register_publish does.
+    The path cache is the path relative to the parent folder of the project
+    root it is in, the storage the LocalStorage of that root.
+
+    The local storages are looked up once, here, so that the callable does not
+    make any Shotgun calls.
+
+    :param tk: Sgtk API instance.
+    :param shotgun: Shotgun API connection.
+    :returns: Callable accepting a path and returning a dictionary with the
+              path_cache and path_cache_storage fields. For paths outside of the
+              project roots, the dictionary is empty.
+    """
+    roots = dict((name, path.replace(os.sep, "/").rstrip("/")) for name, path in tk.roots.items())
+    storages = {}
+    if roots:
+        for storage in shotgun.find("LocalStorage", [["code", "in", list(roots)]], ["code"]):
+            storages[storage["code"]] = {"type": "LocalStorage", "id": storage["id"]}
+
+    def path_cache_fields(path):
+        norm_path = path.replace(os.sep, "/")
+        for name, root in roots.items():
+            if not norm_path.lower().startswith(root.lower() + "/"):
+                continue
+            if name not in storages:
+                raise ValueError("No local storage named '%s' in Shotgun" % name)
+            # the path cache starts with the project folder
+            path_cache = norm_path[len(os.path.dirname(root)):].lstrip("/")
+            return {"path_cache": path_cache, "path_cache_storage": storages[name]}
+        return {}
+
+    return path_cache_fields
+
+
+def _hashable(value):
+    """
+    Returns a value usable as a dictionary key, entity links by type and id.
+    """
+    if isinstance(value, dict):
+        return (value.get("type"), value.get("id"))
+    return value
+
+
+def _item_code(item):
+    """
+    Returns the display code of an item, its file name without frame token or extension.
+    """
+    if item.is_sequence:
+        return item.head.rstrip("._-")
+    return os.path.splitext(item.name)[0]
@@ -0,0 +1,224 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Persistent index of directory listings, used to speed up repeated scans.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from .scanner import ScanEntry
+
+
+class ScanIndex(object):
+    """
+    SQLite backed cache of directory listings.
+
+    Every listing is stored together with the mtime, inode and device of the
+    directory it was read from. Creating, removing or renaming anything inside
+    a directory updates its mtime, so as long as those three values are unchanged
+    the cached listing can be returned without touching the directory contents.
+
+    Note that rewriting an existing file in place does not change the mtime of
+    its directory. Sizes and mtimes of files that were modified that way are
+    not picked up until something else in the same directory changes.
+
+    Directories modified within the last racy_window seconds are not stored,
+    much like git treats "racily clean" files. Many file servers only keep
+    mtimes to the second, so a file added in the same second after a listing
+    was read would leave the mtime unchanged and the stored listing stale for
+    good. This matters while a delivery is still arriving: such directories
+    are simply listed again on the next scan, until they have settled.
+
+    Once the stored listings grow beyond the configured size, the least recently
+    used directories are evicted when the index is flushed.
+
+    The index can be shared between threads.
+    """
+
+    # number of stores after which pending changes are committed
+    COMMIT_INTERVAL = 200
+
+    def __init__(self, path, max_size=256 * 1024 * 1024, racy_window=2.0):
+        """
+        Constructor
+
+        :param path: Path to the SQLite database file. Missing parent folders
+                     are created.
+        :param max_size: Maximum number of bytes of listing data kept in the index.
+        :param racy_window: Listings of directories modified less than this many
+                            seconds ago, or with an mtime in the future, are not
+                            stored.
+        """
+        self._path = path
+        self._max_size = max_size
+        self._racy_window = racy_window
+        self._lock = threading.Lock()
+        self._pending_writes = 0
+        self._touched = set()
+
+        folder = os.path.dirname(path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS directories ("
+            " path TEXT PRIMARY KEY,"
+            " mtime_ns INTEGER NOT NULL,"
+            " inode INTEGER NOT NULL,"
+            " device INTEGER NOT NULL,"
+            " has_stats INTEGER NOT NULL,"
+            " entries BLOB NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " last_access REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS directories_last_access ON directories (last_access)"
+        )
+        self._conn.commit()
+
+    @property
+    def path(self):
+        """
+        Path to the SQLite database file.
+        """
+        return self._path
+
+    def lookup(self, path, st, need_stats=True):
+        """
+        Returns the cached listing of a directory, if it is still valid.
+
+        :param path: Directory path.
+        :param st: Current os.stat result for the directory.
+        :param need_stats: If True, listings stored without file sizes and
+                           mtimes are not considered valid.
+        :returns: List of ScanEntry objects, or None if the directory has
+                  to be listed again.
+        """
+        with self._lock:
+            if self._conn is None:
+                return None
+            row = self._conn.execute(
+                "SELECT mtime_ns, inode, device, has_stats, entries FROM directories WHERE path = ?",
+                (path,)
+            ).fetchone()
+            if row is None:
+                return None
+            mtime_ns, inode, device, has_stats, blob = row
+            if (mtime_ns, inode, device) != (st.st_mtime_ns, st.st_ino, st.st_dev):
+                return None
+            if need_stats and not has_stats:
+                return None
+            # access times are written in bulk on flush, to keep lookups read-only
+            self._touched.add(path)
+
+        data = json.loads(zlib.decompress(blob).decode("utf-8"))
+        return [ScanEntry(name, bool(is_dir), size, mtime) for name, is_dir, size, mtime in data]
+
+    def store(self, path, st, entries, has_stats=True):
+        """
+        Stores the listing of a directory.
+
+        :param path: Directory path.
+        :param st: os.stat result for the directory, taken before it was listed.
+        :param entries: List of ScanEntry objects.
+        :param has_stats: True if the entries carry file sizes and mtimes.
+        :returns: False if the directory was modified too recently for its
+                  listing to be trusted, and nothing was stored.
+        """
+        # the mtime is compared against the local clock, which also catches
+        # mtimes in the future written by a file server whose clock is ahead.
+        if st.st_mtime > time.time() - self._racy_window:
+            return False
+
+        data = [(e.name, int(e.is_dir), e.size, e.mtime) for e in entries]
+        blob = zlib.compress(json.dumps(data, separators=(",", ":")).encode("utf-8"))
+        with self._lock:
+            if self._conn is None:
+                return False
+            self._conn.execute(
+                "INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (path, st.st_mtime_ns, st.st_ino, st.st_dev, int(has_stats),
+                 sqlite3.Binary(blob), len(blob), time.time())
+            )
+            self._touched.discard(path)
+            self._pending_writes += 1
+            if self._pending_writes >= self.COMMIT_INTERVAL:
+                self._conn.commit()
+                self._pending_writes = 0
+        return True
+
+    def flush(self):
+        """
+        Commits pending changes, records access times and evicts the least
+        recently used listings if the index has grown beyond its size limit.
+        """
+        with self._lock:
+            if self._conn is None:
+                return
+            if self._touched:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE directories SET last_access = ? WHERE path = ?",
+                    [(now, path) for path in self._touched]
+                )
+                self._touched = set()
+            self._evict()
+            self._conn.commit()
+            self._pending_writes = 0
+
+    def clear(self):
+        """
+        Removes all cached listings.
+        """
+        with self._lock:
+            if self._conn is None:
+                return
+            self._conn.execute("DELETE FROM directories")
+            self._conn.commit()
+            self._touched = set()
+            self._pending_writes = 0
+
+    def close(self):
+        """
+        Flushes and closes the index. Further calls are ignored.
+        """
+        self.flush()
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _evict(self):
+        """
+        Deletes least recently used listings until the index fits its size
+        limit. Must be called with the lock held.
+        """
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM directories").fetchone()[0]
+        if total <= self._max_size:
+            return
+        excess = total - self._max_size
+        doomed = []
+        for path, size in self._conn.execute(
+            "SELECT path, size FROM directories ORDER BY last_access ASC"
+        ):
+            doomed.append((path,))
+            excess -= size
+            if excess <= 0:
+                break
+        self._conn.executemany("DELETE FROM directories WHERE path = ?", doomed)
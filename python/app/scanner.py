@@ -0,0 +1,517 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Streaming directory scanner for ingest deliveries.
+
+Directories are listed with os.scandir by a pool of worker threads. Files are
+collapsed into frame sequences one directory at a time, and the resulting items
+are handed to a callback in batches while the walk is still running. Nothing in
+this module depends on Qt or sgtk, so it can be driven from the dialog as well
+as from a plain python session.
+"""
+
+import os
+import re
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# matches "shot_v001.1001.exr" and "shot_v001_1001.dpx". The frame number has to be
+# separated from the rest of the name by a dot or an underscore, which stops
+# "shot_v001.exr" from being treated as frame 1 of "shot_v".
+FRAME_REGEX = re.compile(r"^(?P<head>.*[._])(?P<frame>\d+)(?P<tail>\.[^.]+)$")
+
+
+class ScanEntry(object):
+    """
+    A single directory entry, as seen by the scanner.
+    """
+    __slots__ = ("name", "is_dir", "size", "mtime")
+
+    def __init__(self, name, is_dir, size=0, mtime=0):
+        """
+        Constructor
+
+        :param name: File or directory name, without the parent path.
+        :param is_dir: True if the entry is a directory.
+        :param size: Size in bytes. Zero for directories or when not stat'ed.
+        :param mtime: Modification time as a float. Zero when not stat'ed.
+        """
+        self.name = name
+        self.is_dir = is_dir
+        self.size = size
+        self.mtime = mtime
+
+
+class ScanItem(object):
+    """
+    A single ingest item: either a plain file or a collapsed frame sequence.
+    """
+
+    def __init__(self, directory, head, tail, padding=0, frames=None, size=0, mtime=0):
+        """
+        Constructor
+
+        :param directory: Directory containing the file(s).
+        :param head: File name part before the frame number, or the full
+                     file name for a plain file.
+        :param tail: File name part after the frame number, including the extension.
+        :param padding: Frame number padding. Zero for plain files.
+        :param frames: Sorted list of frame numbers, or None for plain files.
+        :param size: Total size in bytes of all files in the item.
+        :param mtime: Newest modification time of all files in the item.
+        """
+        self.directory = directory
+        self.head = head
+        self.tail = tail
+        self.padding = padding
+        self.frames = frames
+        self.size = size
+        self.mtime = mtime
+
+    def __repr__(self):
+        return "<ScanItem %s>" % self.display_name
+
+    @property
+    def is_sequence(self):
+        """
+        True if this item is a frame sequence.
+        """
+        return self.frames is not None
+
+    @property
+    def name(self):
+        """
+        File name, with a %0Nd frame token for sequences.
+        """
+        if self.is_sequence:
+            return "%s%%0%dd%s" % (self.head, self.padding, self.tail)
+        return self.head
+
+    @property
+    def path(self):
+        """
+        Full path, with a %0Nd frame token for sequences.
+        """
+        return os.path.join(self.directory, self.name)
+
+    @property
+    def display_name(self):
+        """
+        File name, with the frame range appended for sequences.
+        """
+        if self.is_sequence:
+            return "%s [%d-%d]" % (self.name, self.frames[0], self.frames[-1])
+        return self.name
+
+    @property
+    def file_count(self):
+        """
+        Number of files on disk making up this item.
+        """
+        if self.is_sequence:
+            return len(self.frames)
+        return 1
+
+    @property
+    def missing_frames(self):
+        """
+        Frame numbers missing between the first and last frame of a sequence.
+        """
+        if not self.is_sequence:
+            return []
+        present = set(self.frames)
+        return [f for f in range(self.frames[0], self.frames[-1] + 1) if f not in present]
+
+    def frame_path(self, frame):
+        """
+        Returns the path to the file for a given frame of a sequence.
+        """
+        return os.path.join(self.directory, "%s%0*d%s" % (self.head, self.padding, frame, self.tail))
+
+    def files(self):
+        """
+        Generator yielding the full path of every file making up this item.
+        """
+        if self.is_sequence:
+            for frame in self.frames:
+                yield self.frame_path(frame)
+        else:
+            yield self.path
+
+
+def collapse_entries(directory, entries, min_sequence_length=2):
+    """
+    Collapses the file entries of a single directory into ScanItems.
+
+    :param directory: Directory the entries belong to.
+    :param entries: Iterable of ScanEntry objects. Directories are ignored.
+    :param min_sequence_length: Frame runs shorter than this are returned as
+                                individual files.
+    :returns: List of ScanItem objects, sorted by name.
+    """
+    groups = {}
+    items = []
+
+    for entry in entries:
+        if entry.is_dir:
+            continue
+        match = FRAME_REGEX.match(entry.name)
+        if match is None:
+            items.append(ScanItem(directory, entry.name, "", size=entry.size, mtime=entry.mtime))
+            continue
+        groups.setdefault((match.group("head"), match.group("tail")), []).append(
+            (match.group("frame"), entry)
+        )
+
+    for (head, tail), members in groups.items():
+        for padding, run in _split_padding(members):
+            if len(run) < min_sequence_length:
+                for _, entry in run:
+                    items.append(ScanItem(directory, entry.name, "", size=entry.size, mtime=entry.mtime))
+                continue
+            run.sort(key=lambda member: member[0])
+            frames = [frame for frame, _ in run]
+            size = sum(entry.size for _, entry in run)
+            mtime = max(entry.mtime for _, entry in run)
+            items.append(ScanItem(directory, head, tail, padding, frames, size, mtime))
+
+    items.sort(key=lambda item: item.name)
+    return items
+
+
+def _split_padding(members):
+    """
+    Splits the frames sharing a head and tail into runs of consistent padding.
+
+    Only frame numbers with leading zeros reveal their padding, so shot.0001.exr
+    and shot.001.exr end up in different runs. Numbers without a leading zero can
+    be written with any padding up to their length: they join the run with the
+    largest padding they fit, so that shot.9999.exr and shot.10000.exr stay in
+    one %04d sequence. Any left over form a run padded to the shortest of them,
+    which keeps shot.1.exr to shot.119.exr together.
+
+    :param members: List of (frame string, ScanEntry) tuples.
+    :returns: List of (padding, [(frame number, ScanEntry)]) tuples.
+    """
+    padded = {}
+    unpadded = []
+    for frame, entry in members:
+        if len(frame) > 1 and frame.startswith("0"):
+            padded.setdefault(len(frame), []).append((int(frame), entry))
+        else:
+            unpadded.append((frame, entry))
+
+    paddings = sorted(padded, reverse=True)
+    leftover = []
+    for frame, entry in unpadded:
+        padding = next((p for p in paddings if p <= len(frame)), None)
+        if padding is None:
+            leftover.append((frame, entry))
+        else:
+            padded[padding].append((int(frame), entry))
+
+    runs = list(padded.items())
+    if leftover:
+        runs.append((
+            min(len(frame) for frame, _ in leftover),
+            [(int(frame), entry) for frame, entry in leftover],
+        ))
+    return runs
+
+
+def list_directory(path, stat_files=True):
+    """
+    Lists a single directory using os.scandir.
+
+    :param path: Directory to list.
+    :param stat_files: If True, size and mtime are read for every file. On most
+                       network file systems this costs an extra round trip per file.
+    :returns: List of ScanEntry objects.
+    """
+    entries = []
+    with os.scandir(path) as it:
+        for dir_entry in it:
+            try:
+                is_dir = dir_entry.is_dir(follow_symlinks=False)
+                if is_dir or not stat_files:
+                    entries.append(ScanEntry(dir_entry.name, is_dir))
+                else:
+                    st = dir_entry.stat()
+                    entries.append(ScanEntry(dir_entry.name, False, st.st_size, st.st_mtime))
+            except OSError:
+                # the file was removed or became unreadable while we were listing
+                continue
+    return entries
+
+
+class ScanEngine(object):
+    """
+    Walks a delivery folder in the background and streams ScanItems to a callback.
+
+    Directories are distributed over a pool of worker threads. Each worker lists
+    one directory at a time, queues up any subdirectories and collapses the files
+    into sequence items. Items are buffered and handed to the batch callback
+    whenever batch_size items are waiting or batch_interval seconds have passed.
+
+    All callbacks are executed from worker threads. Callers that need to update
+    a UI are responsible for marshalling the data back to their main thread.
+    """
+
+    def __init__(self, root, batch_callback, finished_callback=None, error_callback=None,
+                 num_workers=8, batch_size=500, batch_interval=0.25,
+                 stat_files=True, min_sequence_length=2, ignore_hidden=True, index=None):
+        """
+        Constructor
+
+        :param root: Directory to scan.
+        :param batch_callback: Called with a list of ScanItems for every batch.
+        :param finished_callback: Called with the scan stats dictionary once the
+                                  walk has completed or was cancelled.
+        :param error_callback: Called with (path, exception) for directories
+                               that could not be listed.
+        :param num_workers: Number of worker threads listing directories.
+        :param batch_size: Maximum number of items buffered before a batch is emitted.
+        :param batch_interval: Maximum number of seconds items are buffered for.
+        :param stat_files: Whether to read size and mtime for every file.
+        :param min_sequence_length: Shortest frame run treated as a sequence.
+        :param ignore_hidden: Skip files and directories starting with a dot.
+        :param index: Optional ScanIndex. Directories that are unchanged since
+                      they were last indexed are not listed again.
+        """
+        self._root = os.path.abspath(root)
+        self._batch_callback = batch_callback
+        self._finished_callback = finished_callback
+        self._error_callback = error_callback
+        self._num_workers = max(1, num_workers)
+        self._batch_size = max(1, batch_size)
+        self._batch_interval = batch_interval
+        self._stat_files = stat_files
+        self._min_sequence_length = min_sequence_length
+        self._ignore_hidden = ignore_hidden
+        self._index = index
+
+        self._queue = queue.Queue()
+        self._cancelled = threading.Event()
+        self._stopping = threading.Event()
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._buffer = []
+        self._last_flush = 0
+        self._threads = []
+        self._flush_thread = None
+
+        self._stats = {
+            "directories": 0,
+            "cached_directories": 0,
+            "queued_directories": 0,
+            "max_queued_directories": 0,
+            "files": 0,
+            "items": 0,
+            "bytes": 0,
+            "errors": 0,
+            "start_time": 0,
+            "end_time": 0,
+            "cancelled": False,
+        }
+
+    @property
+    def root(self):
+        """
+        Directory being scanned.
+        """
+        return self._root
+
+    @property
+    def stats(self):
+        """
+        Copy of the current scan counters.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            # directories being listed or waiting to be listed
+            stats["queued_directories"] = self._pending
+        return stats
+
+    def is_running(self):
+        """
+        True while the walk has been started and has not yet finished.
+        """
+        return bool(self._threads) and not self._done.is_set()
+
+    def start(self):
+        """
+        Starts the walk in the background and returns immediately.
+        """
+        if self._threads:
+            raise RuntimeError("A scan engine can only be started once.")
+
+        self._stats["start_time"] = time.time()
+        self._last_flush = time.time()
+        self._pending = 1
+        self._queue.put(self._root)
+
+        # a separate thread makes sure buffered items are flushed on time, even
+        # while all workers are blocked listing slow directories.
+        self._flush_thread = threading.Thread(target=self._flush_loop, name="ingest-scan-flush")
+        self._flush_thread.daemon = True
+        self._flush_thread.start()
+
+        for idx in range(self._num_workers):
+            thread = threading.Thread(target=self._worker, name="ingest-scan-%d" % idx)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def cancel(self):
+        """
+        Requests the walk to stop. Directories currently being listed are finished,
+        nothing else is started.
+        """
+        self._cancelled.set()
+
+    def wait(self, timeout=None):
+        """
+        Blocks until the walk has finished.
+
+        :returns: True if the walk finished, False if the timeout expired.
+        """
+        return self._done.wait(timeout)
+
+    def _worker(self):
+        """
+        Worker thread main loop.
+        """
+        while True:
+            path = self._queue.get()
+            if path is None:
+                return
+            try:
+                if not self._cancelled.is_set():
+                    self._process_directory(path)
+            except Exception as e:
+                with self._lock:
+                    self._stats["errors"] += 1
+                if self._error_callback:
+                    self._error_callback(path, e)
+            finally:
+                self._directory_done()
+
+    def _process_directory(self, path):
+        """
+        Lists a directory, queues its subdirectories and buffers its items.
+        """
+        entries = self._list(path)
+        if self._ignore_hidden:
+            entries = [e for e in entries if not e.name.startswith(".")]
+
+        subdirs = [os.path.join(path, e.name) for e in entries if e.is_dir]
+        with self._lock:
+            self._pending += len(subdirs)
+            if self._pending > self._stats["max_queued_directories"]:
+                self._stats["max_queued_directories"] = self._pending
+        for subdir in subdirs:
+            self._queue.put(subdir)
+
+        items = collapse_entries(path, entries, self._min_sequence_length)
+
+        with self._lock:
+            self._stats["directories"] += 1
+            self._stats["files"] += len(entries) - len(subdirs)
+            self._stats["items"] += len(items)
+            self._stats["bytes"] += sum(item.size for item in items)
+            self._buffer.extend(items)
+            if len(self._buffer) < self._batch_size:
+                return
+            batch = self._take_buffer()
+        self._batch_callback(batch)
+
+    def _list(self, path):
+        """
+        Returns the ScanEntries for a directory, from the index if possible.
+        """
+        if self._index is None:
+            return list_directory(path, self._stat_files)
+
+        # the directory is stat'ed before it is listed, so that changes made
+        # while listing invalidate the stored entries on the next visit.
+        st = os.stat(path)
+        entries = self._index.lookup(path, st, self._stat_files)
+        if entries is not None:
+            with self._lock:
+                self._stats["cached_directories"] += 1
+            return entries
+
+        entries = list_directory(path, self._stat_files)
+        self._index.store(path, st, entries, self._stat_files)
+        return entries
+
+    def _directory_done(self):
+        """
+        Book keeping once a directory has been processed. The last directory
+        to finish shuts the workers down and emits the final batch.
+        """
+        with self._lock:
+            self._pending -= 1
+            finished = self._pending == 0
+        if not finished:
+            return
+
+        for _ in range(self._num_workers):
+            self._queue.put(None)
+
+        # stop the flush thread first so that the final batch is guaranteed to
+        # be the last one delivered before the finished callback.
+        self._stopping.set()
+        self._flush_thread.join()
+
+        if self._index is not None:
+            try:
+                self._index.flush()
+            except Exception as e:
+                if self._error_callback:
+                    self._error_callback(self._index.path, e)
+
+        with self._lock:
+            batch = self._take_buffer()
+            self._stats["end_time"] = time.time()
+            self._stats["cancelled"] = self._cancelled.is_set()
+            stats = dict(self._stats)
+        if batch:
+            self._batch_callback(batch)
+        self._done.set()
+        if self._finished_callback:
+            self._finished_callback(stats)
+
+    def _take_buffer(self):
+        """
+        Swaps out the item buffer. Must be called with the lock held.
+        """
+        batch = self._buffer
+        self._buffer = []
+        self._last_flush = time.time()
+        return batch
+
+    def _flush_loop(self):
+        """
+        Emits buffered items that have been waiting for longer than the batch interval.
+        """
+        while not self._stopping.wait(self._batch_interval):
+            with self._lock:
+                if not self._buffer or time.time() - self._last_flush < self._batch_interval:
+                    continue
+                batch = self._take_buffer()
+            self._batch_callback(batch)
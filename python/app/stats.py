@@ -0,0 +1,297 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Per-stage timers and counters of the ingest pipeline.
+
+The engines already keep counters of their own, updated under their own locks.
+Rather than adding bookkeeping to their hot paths, a stage is given a sampler,
+a callable returning the engine's counter dictionary, which is only called when
+a snapshot is taken. Rates and ratios are derived from the sampled counters.
+"""
+
+import collections
+import threading
+import time
+
+
+# counters the derived metrics of each stage are computed from
+STAGE_METRICS = {
+    "scan": {
+        "files": "files", "bytes": "bytes",
+        "queue": "queued_directories", "max_queue": "max_queued_directories",
+        "hits": "cached_directories", "lookups": "directories",
+    },
+    "verify": {
+        "files": "files_done", "bytes": "bytes_done",
+        "queue": "in_flight", "max_queue": "max_in_flight",
+    },
+    "copy": {
+        "files": "files_done", "bytes": "bytes_copied",
+        "queue": "in_flight", "max_queue": "max_in_flight",
+        # files found complete from a previous run
+        "hits": "skipped", "lookups": "files_done",
+    },
+    "register": {
+        "queue": "queued",
+    },
+    "thumbnails": {
+        "queue": "pending", "max_queue": "max_pending",
+        "hits": "cache_hits", "lookups": "requests",
+    },
+}
+
+
+def format_size(num_bytes):
+    """
+    Returns a human readable representation of a byte count.
+    """
+    for unit in ("B", "KB", "MB", "GB", "TB"):
+        if num_bytes < 1024 or unit == "TB":
+            break
+        num_bytes /= 1024.0
+    if unit == "B":
+        return "%d B" % num_bytes
+    return "%.1f %s" % (num_bytes, unit)
+
+
+class ShotgunCallCounter(object):
+    """
+    Wraps a Shotgun API connection, counting every call to its public methods.
+    Everything else is passed through to the connection unchanged.
+    """
+
+    def __init__(self, shotgun):
+        """
+        Constructor
+
+        :param shotgun: Shotgun API connection, or a MockShotgun.
+        """
+        self._sg = shotgun
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    @property
+    def calls(self):
+        """
+        Dictionary with the number of calls of every method called so far.
+        """
+        with self._lock:
+            return dict(self._calls)
+
+    @property
+    def call_count(self):
+        """
+        Total number of calls made so far.
+        """
+        with self._lock:
+            return sum(self._calls.values())
+
+    def __getattr__(self, name):
+        attr = getattr(self._sg, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+
+        def counted(*args, **kwargs):
+            with self._lock:
+                self._calls[name] = self._calls.get(name, 0) + 1
+            return attr(*args, **kwargs)
+        return counted
+
+
+class StageStats(object):
+    """
+    Wall clock time and sampled counters of a single pipeline stage.
+    """
+
+    def __init__(self, name):
+        """
+        Constructor
+
+        :param name: Stage name, one of the keys of STAGE_METRICS or any other name.
+        """
+        self.name = name
+        self._sampler = None
+        self._counters = {}
+        self._start_time = 0
+        self._end_time = 0
+
+    @property
+    def running(self):
+        """
+        True between start() and stop().
+        """
+        return bool(self._start_time) and not self._end_time
+
+    @property
+    def elapsed(self):
+        """
+        Seconds the stage has been running for.
+        """
+        if not self._start_time:
+            return 0.0
+        return (self._end_time or time.time()) - self._start_time
+
+    def start(self, sampler=None):
+        """
+        Starts timing the stage, resetting any previous run.
+
+        :param sampler: Callable returning a dictionary of the stage's counters,
+                        such as the stats or progress property of an engine.
+        """
+        self._sampler = sampler
+        self._counters = {}
+        self._start_time = time.time()
+        self._end_time = 0
+
+    def stop(self, counters=None):
+        """
+        Stops timing the stage. The counters are sampled one final time, after
+        which the sampler is released.
+
+        :param counters: Final counters, if available. Saves calling the sampler.
+        """
+        if counters is None:
+            counters = self._sample()
+        self._counters = dict(counters)
+        self._sampler = None
+        self._end_time = time.time()
+
+    def snapshot(self):
+        """
+        Returns the current counters of the stage along with derived metrics.
+
+        :returns: Dictionary with the stage name, whether it is running, elapsed
+                  seconds, the raw counters and, where the stage provides the
+                  counters needed, files_per_second, bytes_per_second,
+                  queue_depth, max_queue_depth and cache_hit_rate.
+        """
+        counters = self._sample() if self.running else dict(self._counters)
+        elapsed = self.elapsed
+        result = {
+            "stage": self.name,
+            "running": self.running,
+            "elapsed": elapsed,
+            "counters": counters,
+        }
+
+        metrics = STAGE_METRICS.get(self.name, {})
+        for key, name in (("files", "files_per_second"), ("bytes", "bytes_per_second")):
+            value = counters.get(metrics.get(key))
+            if value is not None:
+                result[name] = value / elapsed if elapsed > 0 else 0.0
+        for key, name in (("queue", "queue_depth"), ("max_queue", "max_queue_depth")):
+            value = counters.get(metrics.get(key))
+            if value is not None:
+                result[name] = value
+        lookups = counters.get(metrics.get("lookups"))
+        if lookups:
+            result["cache_hit_rate"] = float(counters.get(metrics["hits"], 0)) / lookups
+        return result
+
+    def _sample(self):
+        """
+        Calls the sampler, keeping the last counters if there is none.
+        """
+        sampler = self._sampler
+        if sampler is None:
+            return dict(self._counters)
+        counters = dict(sampler())
+        self._counters = counters
+        return counters
+
+
+class PipelineStats(object):
+    """
+    Collection of the stages of an ingest, in the order they were first started.
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self._stages = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def stage(self, name):
+        """
+        Returns the StageStats of a stage, creating it on first use.
+        """
+        with self._lock:
+            stage = self._stages.get(name)
+            if stage is None:
+                stage = self._stages[name] = StageStats(name)
+            return stage
+
+    def clear(self):
+        """
+        Forgets all stages.
+        """
+        with self._lock:
+            self._stages.clear()
+
+    def snapshot(self):
+        """
+        Returns the snapshots of all stages, and the number of Shotgun calls per
+        registered item if items have been registered. Calls are taken from the
+        register stage's shotgun_calls counter, which counts every API call,
+        such as kept by a ShotgunCallCounter, or else its batch_calls counter.
+        """
+        with self._lock:
+            stages = list(self._stages.values())
+        result = {"stages": [stage.snapshot() for stage in stages]}
+        for stage in result["stages"]:
+            if stage["stage"] == "register" and stage["counters"].get("items"):
+                counters = stage["counters"]
+                calls = counters.get("shotgun_calls", counters.get("batch_calls", 0))
+                result["shotgun_calls_per_item"] = float(calls) / counters["items"]
+        return result
+
+    def format_lines(self, snapshot=None, stages=None):
+        """
+        Returns one human readable line per stage.
+
+        :param snapshot: Snapshot to format. Defaults to a new snapshot.
+        :param stages: Names of the stages to format. Defaults to all stages.
+        """
+        snapshot = snapshot or self.snapshot()
+        lines = []
+        for stage in snapshot["stages"]:
+            if stages is not None and stage["stage"] not in stages:
+                continue
+            parts = ["%.1fs" % stage["elapsed"]]
+            if "files_per_second" in stage:
+                parts.append("%.0f files/s" % stage["files_per_second"])
+            if "bytes_per_second" in stage:
+                parts.append("%s/s" % format_size(stage["bytes_per_second"]))
+            if "queue_depth" in stage:
+                queue = "queue %d" % stage["queue_depth"]
+                if "max_queue_depth" in stage:
+                    queue += " (peak %d)" % stage["max_queue_depth"]
+                parts.append(queue)
+            if "cache_hit_rate" in stage:
+                parts.append("%.0f%% cache hits" % (stage["cache_hit_rate"] * 100))
+            if stage["stage"] == "register" and "shotgun_calls_per_item" in snapshot:
+                parts.append("%.3f Shotgun calls per item" % snapshot["shotgun_calls_per_item"])
+            if stage["running"]:
+                parts.append("running")
+            lines.append("%s: %s" % (stage["stage"], ", ".join(parts)))
+        return lines
+
+    def log(self, log_method, snapshot=None, stages=None):
+        """
+        Writes the stats to a logger, one line per stage.
+
+        :param log_method: Logging method, such as app.log_info or app.log_debug.
+        :param snapshot: Snapshot to log. Defaults to a new snapshot.
+        :param stages: Names of the stages to log. Defaults to all stages.
+        """
+        for line in self.format_lines(snapshot, stages):
+            log_method("Ingest stats - %s" % line)
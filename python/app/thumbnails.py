@@ -0,0 +1,510 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Background thumbnail generation for scanned ingest items.
+
+Thumbnails of the middle frame of every item are rendered by a small pool of
+worker threads, using whichever decoder is available locally: the Pillow or
+OpenImageIO python modules, or the ffmpeg or oiiotool executables. Results are
+kept in a disk cache keyed by a fingerprint of the source file's content.
+"""
+
+import collections
+import hashlib
+import os
+import shutil
+import subprocess
+import threading
+import uuid
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import OpenImageIO
+except ImportError:
+    OpenImageIO = None
+
+# number of bytes read from the start and the end of a file to fingerprint it
+FINGERPRINT_BYTES = 64 * 1024
+
+
+def content_key(path, size):
+    """
+    Returns a cache key for a thumbnail of a file.
+
+    Hashing entire frames would cost as much as verifying them, so the key is
+    computed from the file size and its first and last FINGERPRINT_BYTES bytes.
+    Image headers and trailing scanlines or chunk tables differ between any two
+    real frames, so this identifies the content well in practice.
+
+    :param path: Source file.
+    :param size: Thumbnail width in pixels.
+    """
+    hasher = hashlib.sha1()
+    with open(path, "rb") as fh:
+        file_size = os.fstat(fh.fileno()).st_size
+        hasher.update(("%d:%d:" % (file_size, size)).encode("ascii"))
+        hasher.update(fh.read(FINGERPRINT_BYTES))
+        if file_size > 2 * FINGERPRINT_BYTES:
+            fh.seek(-FINGERPRINT_BYTES, os.SEEK_END)
+            hasher.update(fh.read(FINGERPRINT_BYTES))
+    return hasher.hexdigest()
+
+
+def thumbnail_source(item):
+    """
+    Returns the file a thumbnail of an item is rendered from: the middle frame
+    of a sequence, or the file itself.
+    """
+    if item.is_sequence:
+        return item.frame_path(item.frames[len(item.frames) // 2])
+    return item.path
+
+
+################################################################################
+# decoders
+
+class PillowDecoder(object):
+    """
+    Renders thumbnails with the Pillow python module.
+    """
+    name = "pillow"
+    extensions = (".jpg", ".jpeg", ".png", ".tif", ".tiff", ".tga", ".bmp", ".gif", ".webp")
+
+    @classmethod
+    def is_available(cls):
+        return Image is not None
+
+    def render(self, src, dst, size):
+        image = Image.open(src)
+        image.thumbnail((size, size))
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGB")
+        image.save(dst, "PNG")
+
+
+class OpenImageIODecoder(object):
+    """
+    Renders thumbnails with the OpenImageIO python module.
+    """
+    name = "openimageio"
+    extensions = (".exr", ".dpx", ".cin", ".tif", ".tiff", ".jpg", ".jpeg", ".png", ".tga", ".hdr")
+
+    @classmethod
+    def is_available(cls):
+        return OpenImageIO is not None
+
+    def render(self, src, dst, size):
+        source = OpenImageIO.ImageBuf(src)
+        spec = source.spec()
+        if spec.width <= 0:
+            raise RuntimeError("Could not read %s: %s" % (src, source.geterror()))
+        width = min(size, spec.width)
+        height = max(1, int(round(spec.height * width / float(spec.width))))
+        roi = OpenImageIO.ROI(0, width, 0, height, 0, 1, 0, min(3, spec.nchannels))
+        resized = OpenImageIO.ImageBufAlgo.resize(source, roi=roi)
+        if not resized.write(dst, "uint8"):
+            raise RuntimeError("Could not write %s: %s" % (dst, resized.geterror()))
+
+
+class _ExecutableDecoder(object):
+    """
+    Base class for decoders running an executable found on the PATH.
+    """
+    executable = None
+
+    @classmethod
+    def is_available(cls):
+        return shutil.which(cls.executable) is not None
+
+    def render(self, src, dst, size):
+        command = self.command(shutil.which(self.executable), src, dst, size)
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        _, stderr = process.communicate()
+        if process.returncode != 0 or not os.path.exists(dst):
+            raise RuntimeError(
+                "%s failed on %s: %s" % (self.executable, src, stderr.decode("utf-8", "replace").strip())
+            )
+
+
+class FfmpegDecoder(_ExecutableDecoder):
+    """
+    Renders thumbnails by running ffmpeg.
+    """
+    name = "ffmpeg"
+    executable = "ffmpeg"
+    extensions = (".exr", ".dpx", ".tif", ".tiff", ".jpg", ".jpeg", ".png", ".tga",
+                  ".mov", ".mp4", ".mxf", ".avi")
+
+    def command(self, executable, src, dst, size):
+        return [
+            executable, "-v", "error", "-y", "-i", src,
+            "-vf", "scale='min(%d,iw)':-2" % size, "-frames:v", "1", dst,
+        ]
+
+
+class OiiotoolDecoder(_ExecutableDecoder):
+    """
+    Renders thumbnails by running oiiotool.
+    """
+    name = "oiiotool"
+    executable = "oiiotool"
+    extensions = OpenImageIODecoder.extensions
+
+    def command(self, executable, src, dst, size):
+        return [executable, src, "--fit", "%dx%d" % (size, size), "-d", "uint8", "-o", dst]
+
+
+# decoders in order of preference
+DECODERS = (OpenImageIODecoder, PillowDecoder, FfmpegDecoder, OiiotoolDecoder)
+
+
+def available_decoders():
+    """
+    Returns instances of all decoders available in this environment, most preferred first.
+    """
+    return [decoder() for decoder in DECODERS if decoder.is_available()]
+
+
+################################################################################
+# cache
+
+class ThumbnailCache(object):
+    """
+    Size limited folder of rendered thumbnails, keyed by content_key.
+
+    The modification time of a cached file is bumped whenever it is used, so
+    that the least recently used thumbnails can be evicted first. Once the
+    cache outgrows its size limit, thumbnails are evicted down to a fraction of
+    it, so that the cache folder is not walked again on every further put.
+
+    The size of the cache is only computed by the first put, which runs on a
+    worker thread, rather than up front where the cache is created.
+    """
+
+    # fraction of the size limit the cache is evicted down to
+    LOW_WATER_MARK = 0.8
+
+    def __init__(self, folder, max_size=512 * 1024 * 1024):
+        """
+        Constructor
+
+        :param folder: Folder holding the cache. Created if needed.
+        :param max_size: Maximum number of bytes kept in the cache.
+        """
+        self._folder = folder
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._evicting = False
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        # computed by the first put
+        self._size = None
+
+    @property
+    def folder(self):
+        """
+        Folder holding the cache.
+        """
+        return self._folder
+
+    def path(self, key):
+        """
+        Returns the path a thumbnail with the given key is stored at.
+        """
+        return os.path.join(self._folder, key[:2], key + ".png")
+
+    def get(self, key):
+        """
+        Returns the path to a cached thumbnail, or None if it is not cached.
+        """
+        path = self.path(key)
+        try:
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def put(self, key, src):
+        """
+        Moves a rendered thumbnail into the cache.
+
+        :param key: Cache key.
+        :param src: Rendered thumbnail file. It is moved, not copied.
+        :returns: Path to the cached thumbnail.
+        """
+        path = self.path(key)
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                if not os.path.isdir(folder):
+                    raise
+        size = os.path.getsize(src)
+        os.replace(src, path)
+        with self._lock:
+            if self._size is None:
+                # the walk includes the thumbnail just moved in
+                self._size = sum(entry_size for _, _, entry_size in self._entries())
+            else:
+                self._size += size
+            over = self._size > self._max_size and not self._evicting
+        if over:
+            self.evict()
+        return path
+
+    def evict(self):
+        """
+        Removes the least recently used thumbnails until the cache is down to
+        its low water mark. Does nothing if another thread is already evicting.
+        """
+        with self._lock:
+            if self._evicting:
+                return
+            self._evicting = True
+        try:
+            # the folder is walked without holding the lock, so that puts from
+            # other threads are not held up meanwhile
+            entries = sorted(self._entries())
+            total = sum(size for _, _, size in entries)
+            target = self._max_size * self.LOW_WATER_MARK
+            for _, path, size in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+            with self._lock:
+                self._size = total
+        finally:
+            self._evicting = False
+
+    def _entries(self):
+        """
+        Yields (mtime, path, size) for every cached thumbnail.
+        """
+        for folder, _, file_names in os.walk(self._folder):
+            for file_name in file_names:
+                path = os.path.join(folder, file_name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield st.st_mtime, path, st.st_size
+
+
+################################################################################
+# worker pool
+
+class ThumbnailPool(object):
+    """
+    Renders thumbnails on a bounded pool of worker threads.
+
+    Requests for items currently visible in the UI are always served before
+    other requests, regardless of the order they were made in. Requests that
+    are not visible are dropped, oldest first, once more than max_pending are
+    waiting, so scrolling through a long list never builds up a backlog.
+
+    Results are delivered by calling the callback from a worker thread with
+    (item, thumbnail path), or (item, None) if no thumbnail could be rendered.
+    """
+
+    def __init__(self, cache, callback, decoders=None, num_workers=2, size=256, max_pending=500):
+        """
+        Constructor
+
+        :param cache: ThumbnailCache to store rendered thumbnails in.
+        :param callback: Called with (item, path) for every finished request.
+        :param decoders: Decoders to render with, most preferred first. Defaults
+                         to all decoders available in this environment.
+        :param num_workers: Number of worker threads.
+        :param size: Maximum width and height of the thumbnails, in pixels.
+        :param max_pending: Maximum number of queued requests for items that are
+                            not visible.
+        """
+        self._cache = cache
+        self._callback = callback
+        self._decoders = available_decoders() if decoders is None else decoders
+        self._size = size
+        self._max_pending = max_pending
+
+        self._condition = threading.Condition()
+        self._pending = collections.OrderedDict()
+        self._visible = set()
+        self._in_flight = set()
+        self._stopped = False
+        self._stats = {
+            "requests": 0,
+            "cache_hits": 0,
+            "rendered": 0,
+            "failed": 0,
+            "dropped": 0,
+            "max_pending": 0,
+        }
+
+        self._threads = []
+        for idx in range(max(1, num_workers) if self._decoders else 0):
+            thread = threading.Thread(target=self._worker, name="ingest-thumbnail-%d" % idx)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    @property
+    def decoders(self):
+        """
+        Decoders used by this pool.
+        """
+        return list(self._decoders)
+
+    @property
+    def stats(self):
+        """
+        Copy of the request counters, along with the number of pending and
+        in flight requests.
+        """
+        with self._condition:
+            stats = dict(self._stats)
+            stats["pending"] = len(self._pending)
+            stats["in_flight"] = len(self._in_flight)
+        return stats
+
+    def request(self, item, visible=True):
+        """
+        Queues an item for a thumbnail. Requests for items that are already
+        queued or being rendered are ignored, apart from updating their visibility.
+        """
+        if not self._threads:
+            return
+        with self._condition:
+            if visible:
+                self._visible.add(id(item))
+            if id(item) in self._in_flight or id(item) in self._pending:
+                return
+            self._pending[id(item)] = item
+            self._stats["requests"] += 1
+            self._trim()
+            self._stats["max_pending"] = max(self._stats["max_pending"], len(self._pending))
+            self._condition.notify()
+
+    def set_visible(self, items):
+        """
+        Declares which items are currently visible. Any pending requests for
+        them are served first; requests for all other items lose their priority.
+        """
+        with self._condition:
+            self._visible = set(id(item) for item in items)
+            self._trim()
+
+    def clear(self):
+        """
+        Drops all pending requests.
+        """
+        with self._condition:
+            self._pending.clear()
+            self._visible.clear()
+
+    def stop(self):
+        """
+        Drops all pending requests and shuts the workers down once their current
+        thumbnail is finished.
+        """
+        with self._condition:
+            self._pending.clear()
+            self._stopped = True
+            self._condition.notify_all()
+
+    def _trim(self):
+        """
+        Drops the oldest invisible requests beyond max_pending. Must be called
+        with the condition held.
+        """
+        excess = len(self._pending) - self._max_pending
+        if excess <= 0:
+            return
+        for item_id in [i for i in self._pending if i not in self._visible][:excess]:
+            del self._pending[item_id]
+            self._stats["dropped"] += 1
+
+    def _next(self):
+        """
+        Blocks until a request is available and returns its item, visible items
+        first. Returns None once the pool has been stopped.
+        """
+        with self._condition:
+            while not self._pending and not self._stopped:
+                self._condition.wait()
+            if self._stopped:
+                return None
+            item_id = next((i for i in self._pending if i in self._visible), None)
+            if item_id is None:
+                item_id = next(iter(self._pending))
+            item = self._pending.pop(item_id)
+            self._in_flight.add(item_id)
+            return item
+
+    def _worker(self):
+        """
+        Worker thread main loop.
+        """
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            try:
+                path, cached = self._render(item)
+            except Exception:
+                path, cached = None, False
+            with self._condition:
+                if cached:
+                    self._stats["cache_hits"] += 1
+                elif path:
+                    self._stats["rendered"] += 1
+                else:
+                    self._stats["failed"] += 1
+                self._in_flight.discard(id(item))
+                self._visible.discard(id(item))
+            self._callback(item, path)
+
+    def _render(self, item):
+        """
+        Returns the cached thumbnail of an item, rendering it first if needed.
+
+        :returns: Tuple of (thumbnail path or None, whether it came from the cache).
+        """
+        src = thumbnail_source(item)
+        key = content_key(src, self._size)
+        path = self._cache.get(key)
+        if path:
+            return path, True
+
+        extension = os.path.splitext(src)[1].lower()
+        # rendering next to the cache keeps the final move on the same file system
+        tmp_path = os.path.join(self._cache.folder, "tmp-%s.png" % uuid.uuid4().hex)
+        for decoder in self._decoders:
+            if extension not in decoder.extensions:
+                continue
+            try:
+                decoder.render(src, tmp_path, self._size)
+                return self._cache.put(key, tmp_path), False
+            except Exception:
+                # try the next decoder, it may support this particular flavour
+                # of the format
+                continue
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        return None, False
@@ -11,8 +11,10 @@ from tank.platform.qt import QtCore, QtGui
 class Ui_Dialog(object):
     def setupUi(self, Dialog):
         Dialog.setObjectName("Dialog")
-        Dialog.resize(431, 392)
-        self.horizontalLayout = QtGui.QHBoxLayout(Dialog)
+        Dialog.resize(820, 560)
+        self.verticalLayout = QtGui.QVBoxLayout(Dialog)
+        self.verticalLayout.setObjectName("verticalLayout")
+        self.horizontalLayout = QtGui.QHBoxLayout()
         self.horizontalLayout.setObjectName("horizontalLayout")
         self.logo_example = QtGui.QLabel(Dialog)
         self.logo_example.setText("")
@@ -20,7 +22,7 @@ class Ui_Dialog(object):
         self.logo_example.setObjectName("logo_example")
         self.horizontalLayout.addWidget(self.logo_example)
         self.context = QtGui.QLabel(Dialog)
-        sizePolicy = QtGui.QSizePolicy(QtGui.QSizePolicy.Expanding, QtGui.QSizePolicy.Expanding)
+        sizePolicy = QtGui.QSizePolicy(QtGui.QSizePolicy.Expanding, QtGui.QSizePolicy.Preferred)
         sizePolicy.setHorizontalStretch(0)
         sizePolicy.setVerticalStretch(0)
         sizePolicy.setHeightForWidth(self.context.sizePolicy().hasHeightForWidth())
@@ -28,6 +30,50 @@ class Ui_Dialog(object):
         self.context.setAlignment(QtCore.Qt.AlignLeading|QtCore.Qt.AlignLeft|QtCore.Qt.AlignVCenter)
         self.context.setObjectName("context")
         self.horizontalLayout.addWidget(self.context)
+        self.verticalLayout.addLayout(self.horizontalLayout)
+        self.path_layout = QtGui.QHBoxLayout()
+        self.path_layout.setObjectName("path_layout")
+        self.delivery_path = QtGui.QLineEdit(Dialog)
+        self.delivery_path.setObjectName("delivery_path")
+        self.path_layout.addWidget(self.delivery_path)
+        self.browse_button = QtGui.QPushButton(Dialog)
+        self.browse_button.setObjectName("browse_button")
+        self.path_layout.addWidget(self.browse_button)
+        self.scan_button = QtGui.QPushButton(Dialog)
+        self.scan_button.setObjectName("scan_button")
+        self.path_layout.addWidget(self.scan_button)
+        self.verify_button = QtGui.QPushButton(Dialog)
+        self.verify_button.setEnabled(False)
+        self.verify_button.setObjectName("verify_button")
+        self.path_layout.addWidget(self.verify_button)
+        self.ingest_button = QtGui.QPushButton(Dialog)
+        self.ingest_button.setEnabled(False)
+        self.ingest_button.setObjectName("ingest_button")
+        self.path_layout.addWidget(self.ingest_button)
+        self.stats_button = QtGui.QPushButton(Dialog)
+        self.stats_button.setCheckable(True)
+        self.stats_button.setObjectName("stats_button")
+        self.path_layout.addWidget(self.stats_button)
+        self.verticalLayout.addLayout(self.path_layout)
+        self.filter = QtGui.QLineEdit(Dialog)
+        self.filter.setObjectName("filter")
+        self.verticalLayout.addWidget(self.filter)
+        self.results = QtGui.QTreeView(Dialog)
+        self.results.setRootIsDecorated(False)
+        self.results.setUniformRowHeights(True)
+        self.results.setSortingEnabled(True)
+        self.results.setObjectName("results")
+        self.verticalLayout.addWidget(self.results)
+        self.stats_panel = QtGui.QPlainTextEdit(Dialog)
+        self.stats_panel.setVisible(False)
+        self.stats_panel.setMaximumSize(QtCore.QSize(16777215, 120))
+        self.stats_panel.setReadOnly(True)
+        self.stats_panel.setObjectName("stats_panel")
+        self.verticalLayout.addWidget(self.stats_panel)
+        self.status = QtGui.QLabel(Dialog)
+        self.status.setText("")
+        self.status.setObjectName("status")
+        self.verticalLayout.addWidget(self.status)
 
         self.retranslateUi(Dialog)
         QtCore.QMetaObject.connectSlotsByName(Dialog)
@@ -35,5 +81,12 @@ class Ui_Dialog(object):
     def retranslateUi(self, Dialog):
         Dialog.setWindowTitle(QtGui.QApplication.translate("Dialog", "The Current Sgtk Environment", None, QtGui.QApplication.UnicodeUTF8))
         self.context.setText(QtGui.QApplication.translate("Dialog", "Your Current Context: ", None, QtGui.QApplication.UnicodeUTF8))
+        self.delivery_path.setPlaceholderText(QtGui.QApplication.translate("Dialog", "Delivery folder to ingest", None, QtGui.QApplication.UnicodeUTF8))
+        self.browse_button.setText(QtGui.QApplication.translate("Dialog", "Browse...", None, QtGui.QApplication.UnicodeUTF8))
+        self.scan_button.setText(QtGui.QApplication.translate("Dialog", "Scan", None, QtGui.QApplication.UnicodeUTF8))
+        self.verify_button.setText(QtGui.QApplication.translate("Dialog", "Verify", None, QtGui.QApplication.UnicodeUTF8))
+        self.ingest_button.setText(QtGui.QApplication.translate("Dialog", "Ingest", None, QtGui.QApplication.UnicodeUTF8))
+        self.stats_button.setText(QtGui.QApplication.translate("Dialog", "Stats", None, QtGui.QApplication.UnicodeUTF8))
+        self.filter.setPlaceholderText(QtGui.QApplication.translate("Dialog", "Filter by name or folder", None, QtGui.QApplication.UnicodeUTF8))
 
 from . import resources_rc
@@ -0,0 +1,584 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Checksum verification of scanned ingest items.
+
+Files are hashed by a pool of worker processes and the digests are compared
+against any manifest the vendor delivered alongside the files, either as MD5
+sidecar files or as ASC-MHL hash lists.
+"""
+
+import importlib.util
+import multiprocessing
+import os
+import re
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+from concurrent import futures
+
+from . import hashing
+# re-exported, these used to live in this module
+from .hashing import (
+    HASHLIB_ALGORITHMS, XXHASH_ALGORITHMS, ALGORITHMS, available_algorithms, new_hasher, hash_file
+)
+
+# verification outcomes, per file and per item
+STATUS_OK = "ok"
+STATUS_UNVERIFIED = "unverified"
+STATUS_MISMATCH = "mismatch"
+STATUS_ERROR = "error"
+
+# ASC-MHL element names mapped to our algorithm names
+MHL_ALGORITHMS = {
+    "md5": "md5",
+    "sha1": "sha1",
+    "xxhash64be": "xxh64",
+    "xxh64": "xxh64",
+    "xxh3": "xxh3_64",
+    "xxh128": "xxh128",
+}
+
+# "d41d8cd98f00b204e9800998ecf8427e  file.exr", with an optional * for binary mode
+MD5SUM_REGEX = re.compile(r"^(?P<digest>[0-9a-fA-F]{32})\s+\*?(?P<name>.+)$")
+# "MD5 (file.exr) = d41d8cd98f00b204e9800998ecf8427e", as written by BSD md5
+MD5_BSD_REGEX = re.compile(r"^MD5\s*\((?P<name>.+)\)\s*=\s*(?P<digest>[0-9a-fA-F]{32})$")
+
+# name the hashing module is loaded under in worker processes, and in this
+# process for tasks sent to them. Modules loaded through toolkit's import_module
+# have names that cannot be imported again elsewhere, so the module is loaded
+# by its file path under a fixed, unique name instead.
+WORKER_HASHING_MODULE = "tk_multi_ingestapp_hashing"
+
+# run in every worker process before it receives its first task
+_WORKER_BOOTSTRAP = """
+import importlib.util, sys
+if %(name)r not in sys.modules:
+    spec = importlib.util.spec_from_file_location(%(name)r, %(path)r)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    sys.modules[%(name)r] = module
+"""
+
+
+################################################################################
+# manifests
+
+class Manifest(object):
+    """
+    Expected digests for a set of files, gathered from vendor manifests.
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self._digests = {}
+        self.sources = []
+        self.errors = []
+
+    def __len__(self):
+        return len(self._digests)
+
+    def add(self, path, algorithm, digest):
+        """
+        Records an expected digest for a file.
+
+        :param path: Absolute path of the file.
+        :param algorithm: Algorithm name, as listed in ALGORITHMS.
+        :param digest: Expected hex digest.
+        """
+        key = os.path.normcase(os.path.normpath(path))
+        self._digests.setdefault(key, {})[algorithm] = digest.strip().lower()
+
+    def update(self, other):
+        """
+        Adds the expected digests, sources and errors of another Manifest.
+        """
+        for key, digests in other._digests.items():
+            self._digests.setdefault(key, {}).update(digests)
+        self.sources.extend(other.sources)
+        self.errors.extend(other.errors)
+
+    def get(self, path):
+        """
+        Returns a dictionary of algorithm name to expected digest for a file.
+        The dictionary is empty if the file is not part of any manifest.
+        """
+        return self._digests.get(os.path.normcase(os.path.normpath(path)), {})
+
+    def load_md5(self, path):
+        """
+        Reads an md5sum style sidecar file.
+
+        Both the GNU ("<digest>  <name>") and BSD ("MD5 (<name>) = <digest>")
+        formats are understood. A sidecar that only contains a digest, such as
+        "shot.0001.exr.md5", applies to the file it is named after.
+        """
+        folder = os.path.dirname(path)
+        with open(path, "r") as fh:
+            lines = [line.strip() for line in fh if line.strip()]
+
+        if len(lines) == 1 and re.match(r"^[0-9a-fA-F]{32}$", lines[0]):
+            self.add(path[:-len(".md5")], "md5", lines[0])
+        else:
+            for line in lines:
+                match = MD5SUM_REGEX.match(line) or MD5_BSD_REGEX.match(line)
+                if match:
+                    self.add(os.path.join(folder, match.group("name")), "md5", match.group("digest"))
+        self.sources.append(path)
+
+    def load_mhl(self, path):
+        """
+        Reads an ASC-MHL hash list. Both the original MHL format, where paths are
+        relative to the folder holding the .mhl file, and ASC-MHL version 2, where
+        the .mhl files live in an "ascmhl" folder next to the delivered files,
+        are supported.
+        """
+        folder = os.path.dirname(path)
+        if os.path.basename(folder).lower() == "ascmhl":
+            folder = os.path.dirname(folder)
+
+        tree = ElementTree.parse(path)
+        for hash_element in tree.iter():
+            if _local_name(hash_element.tag) != "hash":
+                continue
+            file_name = None
+            digests = []
+            for child in hash_element:
+                tag = _local_name(child.tag)
+                if tag in ("file", "path"):
+                    file_name = (child.text or "").strip()
+                elif tag == "xxhash64" and child.text:
+                    # MHL v1 stores this one as a decimal number
+                    digests.append(("xxh64", "%016x" % int(child.text.strip())))
+                elif tag in MHL_ALGORITHMS and child.text:
+                    digests.append((MHL_ALGORITHMS[tag], child.text))
+            if file_name:
+                for algorithm, digest in digests:
+                    self.add(os.path.join(folder, file_name), algorithm, digest)
+        self.sources.append(path)
+
+
+def _local_name(tag):
+    """
+    Strips the namespace from an ElementTree tag.
+    """
+    return tag.rsplit("}", 1)[-1].lower()
+
+
+def is_manifest(path):
+    """
+    True if a file is an MD5 sidecar or an MHL file, judging by its extension.
+    """
+    return path.lower().endswith((".md5", ".mhl"))
+
+
+def scanned_manifests(items):
+    """
+    Returns the paths of the MD5 sidecars and MHL files among scanned items.
+
+    Deliveries are scanned before they are verified anyway, so picking the
+    manifests out of the scan results saves walking the delivery a second time.
+    """
+    return [item.path for item in items if not item.is_sequence and is_manifest(item.name)]
+
+
+def load_manifests(paths):
+    """
+    Builds a Manifest from a list of MD5 sidecars and MHL files.
+
+    :param paths: Manifest files to read.
+    :returns: Manifest instance. Manifests that cannot be parsed are skipped
+              and listed in its errors attribute as (path, message) tuples.
+    """
+    manifest = Manifest()
+    for path in paths:
+        try:
+            if path.lower().endswith(".md5"):
+                manifest.load_md5(path)
+            elif path.lower().endswith(".mhl"):
+                manifest.load_mhl(path)
+        except Exception as e:
+            manifest.errors.append((path, str(e)))
+    return manifest
+
+
+def find_manifest(root):
+    """
+    Builds a Manifest from all MD5 sidecars and MHL files found below a folder.
+
+    This walks the whole folder. When the folder has been scanned already, pass
+    the scanned_manifests to load_manifests instead.
+
+    :param root: Delivery folder to search.
+    :returns: Manifest instance, see load_manifests.
+    """
+    paths = []
+    for folder, _, file_names in os.walk(root):
+        paths.extend(os.path.join(folder, name) for name in file_names if is_manifest(name))
+    return load_manifests(paths)
+
+
+################################################################################
+# verification
+
+class VerifyResult(object):
+    """
+    Verification outcome for a single file.
+    """
+
+    def __init__(self, path, size, digests, expected, status, error=None):
+        self.path = path
+        self.size = size
+        self.digests = digests
+        self.expected = expected
+        self.status = status
+        self.error = error
+
+
+def _compare(digests, expected):
+    """
+    Returns the verification status of a file given its computed and expected digests.
+    """
+    common = [name for name in expected if name in digests]
+    if not common:
+        return STATUS_UNVERIFIED
+    for name in common:
+        if digests[name] != expected[name]:
+            return STATUS_MISMATCH
+    return STATUS_OK
+
+
+def _item_status(statuses):
+    """
+    Folds the statuses of the files of an item into a status for the item.
+    """
+    for status in (STATUS_ERROR, STATUS_MISMATCH, STATUS_UNVERIFIED):
+        if status in statuses:
+            return status
+    return STATUS_OK
+
+
+class VerifyEngine(object):
+    """
+    Hashes every file of a list of scan items and compares the results with a manifest.
+
+    Hashing runs in a thread pool by default: hashlib and xxhash release the GIL
+    while digesting large buffers, so threads scale reasonably, and they are
+    the only safe option inside a DCC. Headless callers can opt into a pool of
+    worker processes instead. Those are never forked, since forking a process
+    whose other threads hold locks can deadlock the child. They are started
+    through a fork server or spawned, which re-imports the caller's __main__
+    module in every worker: scripts using worker processes must guard their
+    entry point with if __name__ == "__main__". Should the worker processes die
+    or fail to start, the remaining files are hashed in threads instead, and the
+    progress dictionary's process_pool_failed flag is set.
+
+    The engine is driven from its own background thread. All callbacks are
+    executed from that thread.
+    """
+
+    def __init__(self, items, algorithm="md5", manifest=None, manifest_paths=None, num_workers=0,
+                 buffer_size=8 * 1024 * 1024, use_mmap=True,
+                 item_callback=None, progress_callback=None, finished_callback=None,
+                 progress_interval=0.5, use_processes=False):
+        """
+        Constructor
+
+        :param items: List of ScanItems to verify.
+        :param algorithm: Hash algorithm to compute for every file. Algorithms
+                          found in the manifest for a file are computed as well,
+                          in the same read pass.
+        :param manifest: Optional Manifest with expected digests.
+        :param manifest_paths: Optional list of manifest files, read on the
+                               engine's thread before hashing starts. Their
+                               digests are added to those of manifest.
+        :param num_workers: Number of hashing threads or processes. Zero uses one per core.
+        :param buffer_size: Number of bytes hashed at a time.
+        :param use_mmap: Map large files into memory instead of reading them.
+        :param item_callback: Called with (item, status, results) once every file
+                              of an item has been hashed.
+        :param progress_callback: Called with a copy of the progress dictionary
+                                  at most every progress_interval seconds.
+        :param finished_callback: Called with the final progress dictionary.
+        :param progress_interval: Seconds between progress callbacks.
+        :param use_processes: Hash in worker processes rather than threads, if
+                              this python interpreter can start them. Only use
+                              this outside of a DCC, where sys.executable is a
+                              python interpreter rather than the DCC itself.
+        """
+        new_hasher(algorithm)
+
+        self._items = items
+        self._algorithm = algorithm
+        self._manifest = manifest or Manifest()
+        self._manifest_paths = manifest_paths or []
+        self._num_workers = num_workers or multiprocessing.cpu_count()
+        self._buffer_size = buffer_size
+        self._use_mmap = use_mmap
+        self._item_callback = item_callback
+        self._progress_callback = progress_callback
+        self._finished_callback = finished_callback
+        self._progress_interval = progress_interval
+        self._use_processes = use_processes
+
+        self._cancelled = threading.Event()
+        self._done = threading.Event()
+        self._thread = None
+
+        self._progress = {
+            "files_total": sum(item.file_count for item in items),
+            "bytes_total": sum(item.size for item in items),
+            "files_done": 0,
+            "bytes_done": 0,
+            "bytes_per_second": 0.0,
+            "in_flight": 0,
+            "max_in_flight": 0,
+            "ok": 0,
+            "unverified": 0,
+            "mismatch": 0,
+            "error": 0,
+            "start_time": 0,
+            "end_time": 0,
+            "cancelled": False,
+            "process_pool_failed": False,
+        }
+
+    @property
+    def progress(self):
+        """
+        Copy of the current progress counters.
+        """
+        return dict(self._progress)
+
+    @property
+    def manifest(self):
+        """
+        Manifest the files are compared against. Manifest files passed to the
+        constructor are only included once the engine is running.
+        """
+        return self._manifest
+
+    def start(self):
+        """
+        Starts verification in the background and returns immediately.
+        """
+        if self._thread:
+            raise RuntimeError("A verify engine can only be started once.")
+        self._thread = threading.Thread(target=self._run, name="ingest-verify")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def run(self):
+        """
+        Runs verification in the calling thread and returns the final progress dictionary.
+        """
+        self._run()
+        return self.progress
+
+    def cancel(self):
+        """
+        Requests verification to stop. Files already being hashed are finished.
+        """
+        self._cancelled.set()
+
+    def wait(self, timeout=None):
+        """
+        Blocks until verification has finished.
+
+        :returns: True if verification finished, False if the timeout expired.
+        """
+        return self._done.wait(timeout)
+
+    def is_running(self):
+        """
+        True while verification has been started and has not yet finished.
+        """
+        return self._thread is not None and not self._done.is_set()
+
+    def _create_executor(self):
+        """
+        Returns the pool to hash with, along with the task function to submit to it.
+        """
+        if self._use_processes and _can_start_processes():
+            methods = multiprocessing.get_all_start_methods()
+            method = "forkserver" if "forkserver" in methods else "spawn"
+            try:
+                module = _worker_hashing_module()
+                executor = futures.ProcessPoolExecutor(
+                    self._num_workers,
+                    mp_context=multiprocessing.get_context(method),
+                    initializer=exec,
+                    initargs=(_WORKER_BOOTSTRAP % {
+                        "name": WORKER_HASHING_MODULE, "path": hashing.__file__
+                    }, {}),
+                )
+                return executor, module.hash_task
+            except (OSError, ValueError, ImportError):
+                pass
+        return futures.ThreadPoolExecutor(self._num_workers), hashing.hash_task
+
+    def _run(self):
+        """
+        Feeds all files to the pool and collects the results.
+        """
+        if self._manifest_paths:
+            loaded = load_manifests(self._manifest_paths)
+            self._manifest.update(loaded)
+
+        progress = self._progress
+        progress["start_time"] = time.time()
+        last_report = 0
+        # bounding the number of files in flight keeps memory flat on huge
+        # deliveries, while leaving enough queued work to keep every worker busy.
+        max_in_flight = self._num_workers * 4
+
+        pending = {}
+        remaining = {}
+        results = {}
+        files = self._iter_files()
+        exhausted = False
+
+        executor, task = self._create_executor()
+        try:
+            while True:
+                while not exhausted and len(pending) < max_in_flight and not self._cancelled.is_set():
+                    try:
+                        item, path = next(files)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    algorithms = set([self._algorithm])
+                    algorithms.update(a for a in self._manifest.get(path) if a in available_algorithms())
+                    args = (path, sorted(algorithms), self._buffer_size, self._use_mmap)
+                    try:
+                        future = executor.submit(task, *args)
+                    except futures.BrokenExecutor:
+                        executor, task = self._fall_back_to_threads(executor, pending)
+                        future = executor.submit(task, *args)
+                    pending[future] = (item, args)
+                    if id(item) not in remaining:
+                        remaining[id(item)] = item.file_count
+                        results[id(item)] = []
+
+                progress["in_flight"] = len(pending)
+                progress["max_in_flight"] = max(progress["max_in_flight"], len(pending))
+                if not pending:
+                    break
+
+                done, _ = futures.wait(
+                    list(pending), timeout=self._progress_interval,
+                    return_when=futures.FIRST_COMPLETED
+                )
+                broken = False
+                for future in done:
+                    try:
+                        output = future.result()
+                    except futures.BrokenExecutor:
+                        # left in pending, to be hashed again
+                        broken = True
+                        continue
+                    item = pending.pop(future)[0]
+                    result = self._make_result(*output)
+                    progress["files_done"] += 1
+                    progress["bytes_done"] += result.size
+                    progress[result.status] += 1
+                    results[id(item)].append(result)
+                    remaining[id(item)] -= 1
+                    if remaining[id(item)] == 0:
+                        item_results = results.pop(id(item))
+                        del remaining[id(item)]
+                        if self._item_callback:
+                            status = _item_status(set(r.status for r in item_results))
+                            self._item_callback(item, status, item_results)
+                if broken:
+                    executor, task = self._fall_back_to_threads(executor, pending)
+
+                now = time.time()
+                elapsed = now - progress["start_time"]
+                if elapsed > 0:
+                    progress["bytes_per_second"] = progress["bytes_done"] / elapsed
+                if self._progress_callback and now - last_report >= self._progress_interval:
+                    last_report = now
+                    self._progress_callback(dict(progress))
+        finally:
+            executor.shutdown(wait=not self._cancelled.is_set())
+            progress["end_time"] = time.time()
+            progress["in_flight"] = 0
+            progress["cancelled"] = self._cancelled.is_set()
+            self._done.set()
+
+        if self._finished_callback:
+            self._finished_callback(dict(progress))
+
+    def _fall_back_to_threads(self, executor, pending):
+        """
+        Replaces a broken process pool with a thread pool, and submits the files
+        that were pending in the process pool to it again.
+
+        :param executor: The broken process pool.
+        :param pending: Dictionary of future to (item, task arguments), updated
+                        with the futures of the thread pool.
+        :returns: Tuple of the thread pool and the task function to submit to it.
+        """
+        executor.shutdown(wait=False)
+        self._progress["process_pool_failed"] = True
+        executor = futures.ThreadPoolExecutor(self._num_workers)
+        task = hashing.hash_task
+        for future, (item, args) in list(pending.items()):
+            del pending[future]
+            pending[executor.submit(task, *args)] = (item, args)
+        return executor, task
+
+    def _iter_files(self):
+        """
+        Yields (item, path) for every file of every item.
+        """
+        for item in self._items:
+            for path in item.files():
+                yield item, path
+
+    def _make_result(self, path, size, digests, error):
+        """
+        Builds a VerifyResult from the output of a hashing task.
+        """
+        expected = self._manifest.get(path)
+        if error:
+            return VerifyResult(path, size, digests, expected, STATUS_ERROR, error)
+        return VerifyResult(path, size, digests, expected, _compare(digests, expected))
+
+
+def _can_start_processes():
+    """
+    True if worker processes can be started from this interpreter.
+
+    Spawned and fork server processes run sys.executable. Inside a DCC that is
+    the DCC's own binary rather than a python interpreter.
+    """
+    name = os.path.basename(sys.executable or "").lower()
+    return name.startswith("python")
+
+
+def _worker_hashing_module():
+    """
+    Returns the hashing module as loaded under WORKER_HASHING_MODULE, loading it
+    by path first if needed. Task functions taken from it can be pickled by
+    reference, and resolve in worker processes once _WORKER_BOOTSTRAP has run.
+    """
+    module = sys.modules.get(WORKER_HASHING_MODULE)
+    if module is None:
+        spec = importlib.util.spec_from_file_location(WORKER_HASHING_MODULE, hashing.__file__)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        sys.modules[WORKER_HASHING_MODULE] = module
+    return module
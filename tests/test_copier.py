@@ -0,0 +1,136 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Tests of the file copy, the copy journal and the destination resolver.
+
+Usage: python -m pytest tests
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "python"))
+
+from app import copier  # noqa: E402
+from app.copier import copy_file, CopyJournal, TemplateDestinationResolver  # noqa: E402
+from app.scanner import ScanItem  # noqa: E402
+
+SIZE = 100000
+
+
+def _source(tmpdir):
+    src = str(tmpdir.join("src.bin"))
+    with open(src, "wb") as fh:
+        fh.write(os.urandom(SIZE))
+    return src
+
+
+def _read(path):
+    with open(path, "rb") as fh:
+        return fh.read()
+
+
+############################################################################
+# copy_file
+
+
+def test_short_copy_falls_back_to_the_next_method(tmpdir, monkeypatch):
+    if not hasattr(os, "copy_file_range"):
+        pytest.skip("copy_file_range is not available")
+    src = _source(tmpdir)
+    dst = str(tmpdir.join("out", "dst.bin"))
+    copy_file_range = os.copy_file_range
+    calls = []
+
+    def short_copy_file_range(*args):
+        # the first call copies a chunk, the next ones report the end of the file
+        calls.append(args)
+        if len(calls) > 1:
+            return 0
+        return copy_file_range(*args)
+
+    monkeypatch.setattr(os, "copy_file_range", short_copy_file_range)
+    counts = []
+    assert copy_file(src, dst, chunk_size=4096, chunk_callback=counts.append) == SIZE
+    assert _read(dst) == _read(src)
+    assert not os.path.exists(dst + ".part")
+    # the bytes of the abandoned copy are given back
+    assert counts[:3] == [0, 4096, -4096]
+    assert sum(counts) == SIZE
+
+
+def test_short_copy_of_every_method_fails(tmpdir, monkeypatch):
+    src = _source(tmpdir)
+    dst = str(tmpdir.join("dst.bin"))
+    copy_buffered = copier._copy_buffered
+
+    def short_copy(src_fd, dst_fd, size, chunk_size, after_chunk):
+        # as if the source was truncated while being copied
+        return copy_buffered(src_fd, dst_fd, size, chunk_size, after_chunk) // 2
+
+    monkeypatch.delattr(os, "copy_file_range", raising=False)
+    monkeypatch.delattr(os, "sendfile", raising=False)
+    monkeypatch.setattr(copier, "_copy_buffered", short_copy)
+    with pytest.raises(IOError):
+        copy_file(src, dst)
+    assert not os.path.exists(dst)
+    assert not os.path.exists(dst + ".part")
+
+
+############################################################################
+# CopyJournal
+
+
+def test_journal_drops_a_torn_last_line(tmpdir):
+    src = _source(tmpdir)
+    src_stat = os.stat(src)
+    path = str(tmpdir.join("journal.jsonl"))
+    journal = CopyJournal(path)
+    journal.record(src, "/project/a.bin", src_stat)
+    journal.close()
+    # a run interrupted half way through writing a record
+    with open(path, "a") as fh:
+        fh.write('{"src": "%s", "dst": "/pro' % src)
+
+    journal = CopyJournal(path)
+    assert len(journal) == 1
+    journal.record(src, "/project/b.bin", src_stat)
+    journal.close()
+
+    journal = CopyJournal(path)
+    assert len(journal) == 2
+    journal.close()
+
+
+############################################################################
+# TemplateDestinationResolver
+
+
+class _Template(object):
+    keys = {"name": None, "version": None, "extension": None}
+
+
+@pytest.mark.parametrize("head, name, version", [
+    ("shot_v003.mov", "shot", 3),
+    ("shot.v001.mov", "shot", 1),
+    ("shot-V12_.mov", "shot", 12),
+    ("plate_v001_v002.mov", "plate_v001", 2),
+    ("cut_rev3.mov", "cut_rev3", None),
+    ("dev2.mov", "dev2", None),
+    ("v001.mov", "v001", None),
+])
+def test_version_is_only_parsed_after_a_separator(head, name, version):
+    fields = TemplateDestinationResolver(_Template()).fields_for_item(ScanItem("/delivery", head, ""))
+    assert fields["name"] == name
+    assert fields.get("version") == version
+    assert fields["extension"] == "mov"
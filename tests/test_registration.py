@@ -0,0 +1,282 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Tests of the batched Shotgun registration, run against a MockShotgun.
+
+Usage: python -m pytest tests
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "python"))
+
+from app.mock_shotgun import MockShotgun, MockShotgunError, MockTransportError  # noqa: E402
+from app.registration import (  # noqa: E402
+    BatchRegistrar, IngestRegistration, path_cache_resolver,
+    STATUS_REGISTERED, STATUS_EXISTING, STATUS_FAILED,
+)
+from app.scanner import ScanItem  # noqa: E402
+
+PROJECT = {"type": "Project", "id": 1}
+
+
+def _registrar(shotgun, **kwargs):
+    """
+    Returns a BatchRegistrar recording its waits rather than sleeping.
+    """
+    sleeps = []
+    kwargs.setdefault("backoff", 1.0)
+    registrar = BatchRegistrar(shotgun, sleep=sleeps.append, **kwargs)
+    return registrar, sleeps
+
+
+def _create_versions(registrar, count, prefix="shot"):
+    return [
+        registrar.create(
+            "Version", {"code": "%s%02d" % (prefix, idx), "sg_path_to_frames": "/%s/%02d" % (prefix, idx)},
+            key_field="sg_path_to_frames",
+        )
+        for idx in range(count)
+    ]
+
+
+def _items():
+    return [
+        ScanItem("/delivery", "plate_v001.", ".exr", 4, [1001, 1002, 1003], 3000),
+        ScanItem("/delivery", "ref_v002.mov", "", size=1000),
+        ScanItem("/delivery", "notes.pdf", "", size=10),
+    ]
+
+
+def _destination(item):
+    return item.path.replace("/delivery", "/project/shots")
+
+
+############################################################################
+# BatchRegistrar
+
+
+def test_requests_are_sent_in_chunks():
+    shotgun = MockShotgun()
+    registrar, _ = _registrar(shotgun, chunk_size=3)
+    pending = _create_versions(registrar, 7)
+    assert len(registrar) == 7
+
+    assert registrar.flush() == []
+    assert len(registrar) == 0
+    assert shotgun.calls == {"batch": 3}
+    assert registrar.stats["batch_calls"] == 3
+    assert registrar.stats["requests"] == 7
+    assert sorted(p.result["id"] for p in pending) == sorted(e["id"] for e in shotgun.entities("Version"))
+
+
+def test_connection_failures_are_retried_with_backoff():
+    shotgun = MockShotgun()
+    registrar, sleeps = _registrar(shotgun, chunk_size=10, max_retries=3)
+    pending = _create_versions(registrar, 4)
+    shotgun.fail_next(2)
+
+    assert registrar.flush() == []
+    # one wait per failed batch call, doubling every time
+    assert sleeps == [1.0, 2.0]
+    assert registrar.stats["retries"] == 2
+    assert len(shotgun.entities("Version")) == 4
+    assert all(p.done and p.error is None for p in pending)
+
+
+def test_backoff_is_capped():
+    shotgun = MockShotgun()
+    registrar, sleeps = _registrar(shotgun, max_retries=4, backoff=10.0, max_backoff=15.0)
+    _create_versions(registrar, 1)
+    shotgun.fail_next(4)
+
+    assert registrar.flush() == []
+    assert sleeps == [10.0, 15.0, 15.0, 15.0]
+
+
+def test_chunk_fails_once_retries_are_exhausted():
+    shotgun = MockShotgun()
+    registrar, sleeps = _registrar(shotgun, chunk_size=2, max_retries=2)
+    pending = _create_versions(registrar, 4)
+    # the first chunk fails for good, the second goes through
+    shotgun.fail_next(5)
+
+    failed = registrar.flush()
+    assert failed == pending[:2]
+    assert all(isinstance(p.error, MockTransportError) for p in failed)
+    assert registrar.stats["failed"] == 2
+    assert [e["code"] for e in shotgun.entities("Version")] == ["shot02", "shot03"]
+
+
+def test_chunk_applied_before_the_connection_failed_is_not_sent_again():
+    shotgun = MockShotgun()
+    registrar, _ = _registrar(shotgun)
+    pending = _create_versions(registrar, 3)
+    shotgun.fail_next(1, after_commit=True)
+
+    assert registrar.flush() == []
+    assert shotgun.calls == {"batch": 1, "find": 1}
+    versions = shotgun.entities("Version")
+    assert len(versions) == 3
+    assert sorted(p.result["id"] for p in pending) == sorted(e["id"] for e in versions)
+    assert pending[0].result["code"] == "shot00"
+
+
+def test_unkeyed_creates_are_not_sent_again_after_a_connection_failure():
+    shotgun = MockShotgun()
+    registrar, _ = _registrar(shotgun)
+    pending = registrar.create("Version", {"code": "shot"})
+    shotgun.fail_next(1, after_commit=True)
+
+    assert registrar.flush() == [pending]
+    assert len(shotgun.entities("Version")) == 1
+
+
+def test_rejected_chunk_is_rolled_back_and_split():
+    shotgun = MockShotgun()
+    registrar, sleeps = _registrar(shotgun, chunk_size=8)
+    pending = _create_versions(registrar, 3)
+    bad = registrar.update("Version", 999, {"code": "missing"})
+    pending.extend(_create_versions(registrar, 3, prefix="other"))
+
+    failed = registrar.flush()
+    assert failed == [bad]
+    assert "does not exist" in str(bad.error)
+    # rejections are not retried, the chunk is split down to the bad request
+    assert sleeps == []
+    assert registrar.stats["retries"] == 0
+    assert registrar.stats["splits"] > 0
+    assert registrar.stats["failed"] == 1
+    assert len(shotgun.entities("Version")) == 6
+    assert all(p.error is None for p in pending)
+
+
+def test_rejected_batch_is_rolled_back():
+    shotgun = MockShotgun()
+    requests = [
+        {"request_type": "create", "entity_type": "Version", "data": {"code": "shot"}},
+        {"request_type": "update", "entity_type": "Version", "entity_id": 999, "data": {"code": "missing"}},
+    ]
+    with pytest.raises(MockShotgunError):
+        shotgun.batch(requests)
+    assert shotgun.entities("Version") == []
+
+
+############################################################################
+# IngestRegistration
+
+
+def test_published_files_link_to_their_versions():
+    shotgun = MockShotgun()
+    registrar, _ = _registrar(shotgun, chunk_size=2)
+    publish_type = {"type": "PublishedFileType", "id": 7}
+    registration = IngestRegistration(
+        registrar, {"project": PROJECT, "task": {"type": "Task", "id": 3}},
+        published_file_type=publish_type, description="Ingested",
+    )
+    items = _items()
+
+    results = registration.register(items, _destination)
+    assert [r[1] for r in results] == [STATUS_REGISTERED] * 3
+    # one round of batches for the Versions, one for the published files
+    assert shotgun.calls["batch"] == 4
+
+    versions = dict((v["id"], v) for v in shotgun.entities("Version"))
+    for item, status, version, publish, error in results:
+        assert error is None
+        assert publish["version"] == {"type": "Version", "id": version["id"]}
+        assert versions[version["id"]]["sg_path_to_frames"] == _destination(item)
+        assert publish["path"] == {"local_path": _destination(item)}
+        assert publish["published_file_type"] == publish_type
+        assert publish["project"] == PROJECT
+
+    plate_version, plate_publish = results[0][2], results[0][3]
+    assert versions[plate_version["id"]]["sg_task"] == {"type": "Task", "id": 3}
+    assert versions[plate_version["id"]]["frame_range"] == "1001-1003"
+    assert plate_publish["name"] == "plate"
+    assert plate_publish["version_number"] == 1
+
+
+def test_registered_items_are_not_registered_again():
+    shotgun = MockShotgun()
+    registrar, _ = _registrar(shotgun)
+    registration = IngestRegistration(registrar, {"project": PROJECT})
+    items = _items()
+    first = registration.register(items, _destination)
+
+    shotgun.reset_counters()
+    second = registration.register(items, _destination)
+    assert [r[1] for r in second] == [STATUS_EXISTING] * 3
+    assert [r[3]["id"] for r in second] == [r[3]["id"] for r in first]
+    assert "batch" not in shotgun.calls
+    assert len(shotgun.entities("Version")) == 3
+    assert len(shotgun.entities("PublishedFile")) == 3
+
+
+def test_version_without_published_file_only_gets_the_published_file():
+    shotgun = MockShotgun()
+    registrar, _ = _registrar(shotgun)
+    registration = IngestRegistration(registrar, {"project": PROJECT})
+    items = _items()
+    first = registration.register(items, _destination)
+    shotgun.batch([{"request_type": "delete", "entity_type": "PublishedFile", "entity_id": first[1][3]["id"]}])
+
+    second = registration.register(items, _destination)
+    assert [r[1] for r in second] == [STATUS_EXISTING, STATUS_REGISTERED, STATUS_EXISTING]
+    assert second[1][2]["id"] == first[1][2]["id"]
+    assert second[1][3]["version"] == {"type": "Version", "id": first[1][2]["id"]}
+    assert len(shotgun.entities("Version")) == 3
+    assert len(shotgun.entities("PublishedFile")) == 3
+
+
+def test_failed_versions_get_no_published_file():
+    shotgun = MockShotgun()
+    registrar, _ = _registrar(shotgun, max_retries=0)
+    registration = IngestRegistration(registrar, {"project": PROJECT})
+    # the find for existing entities goes through, the Version batch fails
+    shotgun_find = shotgun.find
+
+    def find(*args, **kwargs):
+        results = shotgun_find(*args, **kwargs)
+        if args[0] == "Version" and not shotgun.entities("Version"):
+            shotgun.fail_next(1)
+        return results
+
+    shotgun.find = find
+    results = registration.register(_items(), _destination)
+    assert [r[1] for r in results] == [STATUS_FAILED] * 3
+    assert all(isinstance(r[4], MockTransportError) for r in results)
+    assert shotgun.entities("PublishedFile") == []
+
+
+def test_path_cache_is_registered():
+    class Tk(object):
+        roots = {"primary": "/project", "secondary": "/other/project"}
+
+    shotgun = MockShotgun()
+    storage = shotgun.create("LocalStorage", {"code": "primary"})
+    registrar, _ = _registrar(shotgun)
+    registration = IngestRegistration(
+        registrar, {"project": PROJECT}, path_cache_fields=path_cache_resolver(Tk(), shotgun)
+    )
+    items = _items()[:2]
+    paths = {items[0].path: "/project/shots/plate_v001.%04d.exr", items[1].path: "/other/project/ref_v002.mov"}
+
+    results = registration.register(items, lambda item: paths[item.path])
+    publish = results[0][3]
+    assert publish["path_cache"] == "project/shots/plate_v001.%04d.exr"
+    assert publish["path_cache_storage"] == {"type": "LocalStorage", "id": storage["id"]}
+    # no local storage for the second root: the item fails before anything is created
+    assert results[1][1] == STATUS_FAILED
+    assert len(shotgun.entities("Version")) == 1